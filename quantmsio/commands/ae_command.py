@@ -1,7 +1,7 @@
 import click
 
 from quantmsio.core.ae import AbsoluteExpressionHander
-from quantmsio.utils.file_utils import extract_protein_list
+from quantmsio.utils.protein_filter import ProteinFilter
 
 
 @click.command(
@@ -52,12 +52,11 @@ def convert_ibaq_absolute(
     :param delete_existing: Delete existing files in the output folder
     :return: none
     """
-    protein_list = extract_protein_list(protein_file) if protein_file else None
-    protein_str = "|".join(protein_list) if protein_list else None
+    protein_filter = ProteinFilter.from_file(protein_file)
     ae_handler = AbsoluteExpressionHander()
     if project_file:
         ae_handler.load_project_file(project_file)
-    ae_handler.load_ibaq_file(ibaq_file, protein_str)
+    ae_handler.load_ibaq_file(ibaq_file, protein_filter)
     ae_handler.load_sdrf_file(sdrf_file)
     ae_handler.convert_ibaq_to_quantms(
         output_folder=output_folder,
@@ -1,7 +1,7 @@
 import click
 
 from quantmsio.core.de import DifferentialExpressionHandler
-from quantmsio.utils.file_utils import extract_protein_list
+from quantmsio.utils.protein_filter import ProteinFilter
 
 
 @click.command(
@@ -58,12 +58,11 @@ def convert_msstats_differential(
 
     if msstats_file is None or sdrf_file is None or output_folder is None:
         raise click.UsageError("Please provide all the required parameters")
-    protein_list = extract_protein_list(protein_file) if protein_file else None
-    protein_str = "|".join(protein_list) if protein_list else None
+    protein_filter = ProteinFilter.from_file(protein_file)
     de_handler = DifferentialExpressionHandler()
     if project_file:
         de_handler.load_project_file(project_file)
-    de_handler.load_msstats_file(msstats_file, protein_str)
+    de_handler.load_msstats_file(msstats_file, protein_filter)
     de_handler.load_sdrf_file(sdrf_file)
     de_handler.set_fdr_threshold(fdr_threshold=fdr_threshold)
     de_handler.convert_msstats_to_quantms(
@@ -1,6 +1,7 @@
 import os
 import click
 from quantmsio.core.diann import DiaNNConvert
+from quantmsio.core.duckdb import DUCKDB_CACHE_SIZE
 from quantmsio.core.project import create_uuid_filename
 
 
@@ -10,7 +11,7 @@ from quantmsio.core.project import create_uuid_filename
 )
 @click.option(
     "--report_path",
-    help="the diann report file path",
+    help="the diann report file path (tsv or report.parquet)",
     required=True,
 )
 @click.option("--qvalue_threshold", help="qvalue_threshold", required=True, default=0.05)
@@ -48,6 +49,21 @@ from quantmsio.core.project import create_uuid_filename
     "--duckdb_max_memory", help="The maximum amount of memory allocated by the DuckDB engine (e.g 4GB)", required=False
 )
 @click.option("--duckdb_threads", help="The number of threads for the DuckDB engine (e.g 4)", required=False)
+@click.option(
+    "--duckdb_cache_dir",
+    help="Folder where the DuckDB databases of the reports are kept and reused by later conversions",
+    required=False,
+)
+@click.option(
+    "--duckdb_cache_size",
+    help="Size cap of the DuckDB cache folder, the least recently used databases are removed beyond it (e.g 100GB)",
+    default=DUCKDB_CACHE_SIZE,
+)
+@click.option(
+    "--duckdb_direct_view",
+    help="Query the report file in place instead of loading it into DuckDB, parquet reports always are",
+    is_flag=True,
+)
 @click.option(
     "--file_num",
     help="The number of files being processed at the same time",
@@ -64,6 +80,9 @@ def diann_convert_to_parquet(
     partitions: str,
     duckdb_max_memory: str,
     duckdb_threads: int,
+    duckdb_cache_dir: str,
+    duckdb_cache_size: str,
+    duckdb_direct_view: bool,
     file_num: int,
 ):
     """
@@ -76,6 +95,9 @@ def diann_convert_to_parquet(
     output_prefix_file: Prefix of the Json file needed to generate the file name
     duckdb_max_memory: The maximum amount of memory allocated by the DuckDB engine (e.g 4GB)
     duckdb_threads: The number of threads for the DuckDB engine (e.g 4)
+    duckdb_cache_dir: Folder where the DuckDB databases of the reports are kept and reused
+    duckdb_cache_size: Size cap of the DuckDB cache folder (e.g 100GB)
+    duckdb_direct_view: Query the report file in place instead of loading it into DuckDB
     file_num: The number of files being processed at the same time
     """
     if report_path is None or mzml_info_folder is None or output_folder is None or sdrf_path is None:
@@ -94,6 +116,9 @@ def diann_convert_to_parquet(
         sdrf_path=sdrf_path,
         duckdb_max_memory=duckdb_max_memory,
         duckdb_threads=duckdb_threads,
+        cache_dir=duckdb_cache_dir,
+        cache_size=duckdb_cache_size,
+        direct_view=duckdb_direct_view,
     )
     if not partitions:
         dia_nn.write_feature_to_file(
@@ -122,7 +147,7 @@ def diann_convert_to_parquet(
 )
 @click.option(
     "--report_path",
-    help="the diann report file path",
+    help="the diann report file path (tsv or report.parquet)",
     required=True,
 )
 @click.option(
@@ -139,6 +164,21 @@ def diann_convert_to_parquet(
     "--duckdb_max_memory", help="The maximum amount of memory allocated by the DuckDB engine (e.g 4GB)", required=False
 )
 @click.option("--duckdb_threads", help="The number of threads for the DuckDB engine (e.g 4)", required=False)
+@click.option(
+    "--duckdb_cache_dir",
+    help="Folder where the DuckDB databases of the reports are kept and reused by later conversions",
+    required=False,
+)
+@click.option(
+    "--duckdb_cache_size",
+    help="Size cap of the DuckDB cache folder, the least recently used databases are removed beyond it (e.g 100GB)",
+    default=DUCKDB_CACHE_SIZE,
+)
+@click.option(
+    "--duckdb_direct_view",
+    help="Query the report file in place instead of loading it into DuckDB, parquet reports always are",
+    is_flag=True,
+)
 @click.option(
     "--file_num",
     help="The number of files being processed at the same time",
@@ -150,6 +190,9 @@ def diann_pg_convert_to_parquet(
     output_prefix_file: str,
     duckdb_max_memory: str,
     duckdb_threads: int,
+    duckdb_cache_dir: str,
+    duckdb_cache_size: str,
+    duckdb_direct_view: bool,
     file_num: int,
 ):
     if report_path is None  is None or output_folder is None:
@@ -168,6 +211,9 @@ def diann_pg_convert_to_parquet(
         sdrf_path=None,
         duckdb_max_memory=duckdb_max_memory,
         duckdb_threads=duckdb_threads,
+        cache_dir=duckdb_cache_dir,
+        cache_size=duckdb_cache_size,
+        direct_view=duckdb_direct_view,
     )
     dia_nn.write_pg_matrix_to_file(
         output_path= pg_output_path,
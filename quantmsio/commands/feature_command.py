@@ -1,5 +1,6 @@
 import click
 
+from quantmsio.core.duckdb import DUCKDB_CACHE_SIZE
 from quantmsio.core.feature import Feature
 from quantmsio.core.project import create_uuid_filename
 
@@ -49,6 +50,26 @@ from quantmsio.core.project import create_uuid_filename
     "--duckdb_max_memory", help="The maximum amount of memory allocated by the DuckDB engine (e.g 4GB)", required=False
 )
 @click.option("--duckdb_threads", help="The number of threads for the DuckDB engine (e.g 4)", required=False)
+@click.option(
+    "--duckdb_cache_dir",
+    help="Folder where the DuckDB databases of the reports are kept and reused by later conversions",
+    required=False,
+)
+@click.option(
+    "--duckdb_cache_size",
+    help="Size cap of the DuckDB cache folder, the least recently used databases are removed beyond it (e.g 100GB)",
+    default=DUCKDB_CACHE_SIZE,
+)
+@click.option(
+    "--duckdb_direct_view",
+    help="Query the report file in place instead of loading it into DuckDB",
+    is_flag=True,
+)
+@click.option(
+    "--duckdb_mode",
+    help="Join the mzTab psms, peptides and proteins to the msstats rows inside DuckDB",
+    is_flag=True,
+)
 def convert_feature_file(
     sdrf_file: str,
     msstats_file: str,
@@ -60,6 +81,10 @@ def convert_feature_file(
     output_prefix_file: str,
     duckdb_max_memory: str,
     duckdb_threads: int,
+    duckdb_cache_dir: str,
+    duckdb_cache_size: str,
+    duckdb_direct_view: bool,
+    duckdb_mode: bool,
 ):
     """
     Convert a msstats/mztab file to a parquet file. The parquet file will contain the features and the metadata.
@@ -72,11 +97,22 @@ def convert_feature_file(
     :param output_prefix_file: Prefix of the Json file needed to generate the file name
     :param duckdb_max_memory: The maximum amount of memory allocated by the DuckDB engine (e.g 4GB)
     :param duckdb_threads: The number of threads for the DuckDB engine (e.g 4)
+    :param duckdb_cache_dir: Folder where the DuckDB databases of the reports are kept and reused
+    :param duckdb_cache_size: Size cap of the DuckDB cache folder (e.g 100GB)
+    :param duckdb_direct_view: Query the report file in place instead of loading it into DuckDB
+    :param duckdb_mode: Join the mzTab psms, peptides and proteins to the msstats rows inside DuckDB
     """
 
     if sdrf_file is None or msstats_file is None or mztab_file is None or output_folder is None:
         raise click.UsageError("Please provide all the required parameters")
-    feature_manager = Feature(mzTab_path=mztab_file, sdrf_path=sdrf_file, msstats_in_path=msstats_file)
+    feature_manager = Feature(
+        mzTab_path=mztab_file,
+        sdrf_path=sdrf_file,
+        msstats_in_path=msstats_file,
+        cache_dir=duckdb_cache_dir,
+        cache_size=duckdb_cache_size,
+        direct_view=duckdb_direct_view,
+    )
     if not output_prefix_file:
         output_prefix_file = "feature"
     filename = create_uuid_filename(output_prefix_file, ".feature.parquet")
@@ -88,6 +124,7 @@ def convert_feature_file(
             protein_file=protein_file,
             duckdb_max_memory=duckdb_max_memory,
             duckdb_threads=duckdb_threads,
+            duckdb_mode=duckdb_mode,
         )
     else:
         partitions = partitions.split(",")
@@ -99,4 +136,5 @@ def convert_feature_file(
             protein_file=protein_file,
             duckdb_max_memory=duckdb_max_memory,
             duckdb_threads=duckdb_threads,
+            duckdb_mode=duckdb_mode,
         )
@@ -33,12 +33,24 @@ from quantmsio.operate.plots import plot_peptidoform_charge_venn, plot_sequence_
     help="Prefix of the parquet file needed to generate the file name",
     required=False,
 )
+@click.option(
+    "--workers",
+    help="The number of processes converting shards of the PSM section at the same time",
+    default=1,
+)
+@click.option(
+    "--split_shards",
+    help="Keep one parquet file per shard instead of merging them into a single file",
+    is_flag=True,
+)
 def convert_psm_file(
     mztab_file: str,
     output_folder: str,
     chunksize: int,
     protein_file: str,
     output_prefix_file: str,
+    workers: int,
+    split_shards: bool,
 ):
     """
     convert mztab psm section to a parquet file. The parquet file will contain the features and the metadata.
@@ -46,6 +58,8 @@ def convert_psm_file(
     :param output_folder: Folder where the Json file will be generated
     :param chunksize: Read batch size
     :param output_prefix_file: Prefix of the Json file needed to generate the file name
+    :param workers: The number of processes converting shards of the PSM section at the same time
+    :param split_shards: Keep one parquet file per shard instead of merging them into a single file
     """
 
     if mztab_file is None or output_folder is None:
@@ -56,7 +70,16 @@ def convert_psm_file(
 
     psm_manager = Psm(mzTab_path=mztab_file)
     output_path = output_folder + "/" + create_uuid_filename(output_prefix_file, ".psm.parquet")
-    psm_manager.write_psm_to_file(output_path=output_path, chunksize=chunksize, protein_file=protein_file)
+    if workers > 1:
+        psm_manager.write_psm_to_file_parallel(
+            output_path=output_path,
+            workers=workers,
+            chunksize=chunksize,
+            protein_file=protein_file,
+            merge=not split_shards,
+        )
+    else:
+        psm_manager.write_psm_to_file(output_path=output_path, chunksize=chunksize, protein_file=protein_file)
 
 
 @click.command("compare-set-psms", short_help="plot venn for a set of Psms parquet")
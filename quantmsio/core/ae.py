@@ -60,7 +60,7 @@ class AbsoluteExpressionHander:
         self.project_manager = ProjectHandler()
         self.project_manager.load_project_info(project_file)
 
-    def load_ibaq_file(self, path, protein_str=None):
+    def load_ibaq_file(self, path, protein_filter=None):
         usecols = ["ProteinName", "SampleID", "Condition", "Ibaq", "IbaqLog"]
         ibaq_columns = get_ibaq_columns(path)
         for col in usecols:
@@ -68,8 +68,8 @@ class AbsoluteExpressionHander:
                 raise Exception(f"Not found {col} in ibaq file")
         ibaqs = pd.read_csv(path, usecols=usecols, sep="\t")
         ibaqs.rename(columns=AbsoluteExpressionHander.LABEL_MAP, inplace=True)
-        if protein_str:
-            ibaqs = ibaqs[ibaqs["protein"].str.contains(f"{protein_str}", na=False)]
+        if protein_filter:
+            ibaqs = protein_filter.filter(ibaqs, "protein")
         self.ae_file_path = path
         self.ibaq_df = ibaqs
 
@@ -22,6 +22,40 @@ PEP = [
     "opt_global_MS:1001493_score",
 ]
 
+# null markers of the mzTab sections, the same ones pandas uses by default
+MZTAB_NULL_VALUES = [
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+]
+MZTAB_INT_COLUMNS = {"charge", "PSM_ID", "unique", "opt_global_cv_MS:1002217_decoy_peptide"}
+MZTAB_FLOAT_COLUMNS = set(
+    [
+        "retention_time",
+        "exp_mass_to_charge",
+        "calc_mass_to_charge",
+        "opt_global_q-value",
+        "opt_global_consensus_support",
+    ]
+    + PEP
+)
+
 MSSTATS_MAP = {
     "ProteinName": "pg_accessions",
     "Reference": "reference_file_name",
@@ -75,10 +75,11 @@ class DifferentialExpressionHandler:
         self.msstats_df = None
         self.de_file_path = None
 
-    def load_msstats_file(self, msstats_file_path: str, protein_str: str = None):
+    def load_msstats_file(self, msstats_file_path: str, protein_filter=None):
         """
         Load a MSstats differential file
         :param msstats_file_path: MSstats differential file path
+        :param protein_filter: ProteinFilter on the protein column
         :return: none
         """
         self.de_file_path = msstats_file_path
@@ -89,8 +90,8 @@ class DifferentialExpressionHandler:
         self.msstats_df = pd.read_csv(msstats_file_path, sep="\t")
         # Rename columns to a lower case
         self.msstats_df.columns = self.msstats_df.columns.str.lower()
-        if protein_str:
-            self.msstats_df = self.msstats_df[self.msstats_df["protein"].str.contains(f"{protein_str}", na=False)]
+        if protein_filter:
+            self.msstats_df = protein_filter.filter(self.msstats_df, "protein")
 
     def load_project_file(self, project_file: str):
         """
@@ -1,68 +1,144 @@
 import time
 import logging
-import numpy as np
 import pandas as pd
 import os
+import numpy as np
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
-import concurrent.futures
-from pathlib import Path
-from collections import defaultdict
-from pyopenms import AASequence
-from pyopenms.Constants import PROTON_MASS_U
-from quantmsio.operate.tools import get_ahocorasick
-from quantmsio.utils.file_utils import close_file, extract_protein_list, save_slice_file
-from quantmsio.core.sdrf import SDRFHandler
-from quantmsio.core.mztab import MzTab
+from quantmsio.operate.tools import ModificationParser
+from quantmsio.utils.file_utils import close_file, ParquetPartitionWriter
+from quantmsio.utils.protein_filter import ProteinFilter
+from quantmsio.utils.arrow_utils import struct_list_array, to_pandas_column
+from quantmsio.utils.mass_utils import calculated_mz, get_peptidoform_masses
+from quantmsio.core.sdrf import SDRFHandler, map_sample_accessions
 from quantmsio.core.feature import Feature
-from quantmsio.core.duckdb import DuckDB
-from quantmsio.utils.pride_utils import generate_scan_number
-from quantmsio.core.common import DIANN_MAP, DIANN_USECOLS, DIANN_PG_MAP, DIANN_PG_USECOLS, PG_SCHEMA
+from quantmsio.core.duckdb import DuckDB, sql_literal
+from quantmsio.utils.pride_utils import generate_scan_numbers
+from quantmsio.core.common import DIANN_MAP, DIANN_USECOLS, DIANN_PG_MAP, DIANN_PG_USECOLS, PG_SCHEMA, FEATURE_SCHEMA
+
+MS_INFO_SUFFIX = "_ms_info.parquet"
+
+
+def index_ms_info_files(mzml_info_folder: str) -> dict:
+    """
+    Scan the ms_info folder once and map every run to its ms_info file. The run is the file name without the
+    _ms_info.parquet suffix, so a run never matches the file of another run ending with its name.
+    :param mzml_info_folder: folder of the ms_info files
+    :return: dict run -> {"path", "size", "rows"}, rows is the number of spectra read from the parquet footer
+    """
+    ms_info_index = {}
+    with os.scandir(mzml_info_folder) as entries:
+        for entry in entries:
+            if entry.name.endswith(MS_INFO_SUFFIX) and entry.is_file():
+                ms_info_index[entry.name[: -len(MS_INFO_SUFFIX)]] = {
+                    "path": entry.path,
+                    "size": entry.stat().st_size,
+                    "rows": pq.read_metadata(entry.path).num_rows,
+                }
+    return dict(sorted(ms_info_index.items()))
+
+
+def plan_run_batches(ms_info_index: dict, file_num: int) -> list:
+    """
+    Group the runs into batches with similar numbers of spectra. A batch is closed once it holds file_num runs or
+    as many spectra as file_num runs on average, so large runs get smaller batches.
+    :param ms_info_index: see index_ms_info_files
+    :param file_num: maximum number of runs per batch
+    :return: list of lists of runs
+    """
+    total = sum(info["rows"] for info in ms_info_index.values())
+    target = total * file_num / max(len(ms_info_index), 1)
+    batches = []
+    batch = []
+    rows = 0
+    for run, info in ms_info_index.items():
+        batch.append(run)
+        rows += info["rows"]
+        if rows >= target or len(batch) >= file_num:
+            batches.append(batch)
+            batch = []
+            rows = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def runs_predicate(runs: list) -> str:
+    """
+    SQL predicate of the report rows of a group of runs. DuckDB does not push IN lists down to the parquet
+    reader, the range of the runs is, so the row groups of the other runs are skipped in reports sorted by run.
+    :param runs: A list of ms_runs
+    :return: SQL expression
+    """
+    runs = sorted(runs)
+    return '"Run" IN ({}) AND "Run" BETWEEN {} AND {}'.format(
+        ", ".join(sql_literal(run) for run in runs), sql_literal(runs[0]), sql_literal(runs[-1])
+    )
 
-DIANN_SQL = ", ".join([f'"{name}"' for name in DIANN_USECOLS])
-DIANN_PG_SQL = ", ".join([f'"{name}"' for name in DIANN_PG_USECOLS])
 
 class DiaNNConvert(DuckDB):
+    # the report columns read by the conversions, parquet reports are only scanned for these columns
+    REPORT_COLUMNS = list(dict.fromkeys(DIANN_USECOLS + DIANN_PG_USECOLS + ["Precursor.Id"]))
 
-    def __init__(self, diann_report, sdrf_path=None, duckdb_max_memory="16GB", duckdb_threads=4):
-        super(DiaNNConvert, self).__init__(diann_report, duckdb_max_memory, duckdb_threads)
+    def __init__(self, diann_report, sdrf_path=None, duckdb_max_memory="16GB", duckdb_threads=4, **duckdb_options):
+        super(DiaNNConvert, self).__init__(diann_report, duckdb_max_memory, duckdb_threads, **duckdb_options)
         if sdrf_path:
             self._sdrf = SDRFHandler(sdrf_path)
             self._mods_map = self._sdrf.get_mods_dict()
-            self._automaton = get_ahocorasick(self._mods_map)
+            self._modification_parser = ModificationParser(self._mods_map)
             self._sample_map = self._sdrf.get_sample_map_run()
 
-    def get_report_from_database(self, runs: list, sql:str = DIANN_SQL) -> pd.DataFrame:
+    def get_batch_sql(self, runs: list, qvalue_threshold: float = None, protein_filter: ProteinFilter = None) -> str:
+        """
+        Query of the report rows of a group of runs, with the columns renamed as in DIANN_MAP. The rows without
+        protein group, above the q-value threshold or rejected by the protein filter are dropped by DuckDB, they
+        never reach python. report_row keeps the order of the rows in the report.
+        :param runs: A list of ms_runs
+        :param qvalue_threshold: only the rows with a lower q-value are kept
+        :param protein_filter: ProteinFilter on the protein groups
+        :return: SQL query
+        """
+        columns = ", ".join(f'"{col}" AS "{name}"' for col, name in DIANN_MAP.items())
+        where = [runs_predicate(runs), '"Protein.Group" IS NOT NULL']
+        if qvalue_threshold is not None:
+            where.append('"Q.Value" < {}'.format(float(qvalue_threshold)))
+        if protein_filter:
+            where.append(protein_filter.sql_predicate("Protein.Group"))
+        return "SELECT {}, row_number() OVER () AS report_row FROM report WHERE {}".format(columns, " AND ".join(where))
+
+    def get_report_from_database(
+        self, runs: list, qvalue_threshold: float = None, protein_filter: ProteinFilter = None
+    ) -> pa.Table:
         """
-        This function loads the report from the duckdb database for a group of ms_runs.
+        This function loads the report from the duckdb database for a group of ms_runs, see get_batch_sql.
         :param runs: A list of ms_runs
-        :return: The report
+        :param qvalue_threshold: only the rows with a lower q-value are kept
+        :param protein_filter: ProteinFilter on the protein groups
+        :return: arrow table with the report columns renamed as in DIANN_MAP
         """
         s = time.time()
-        database = self._duckdb.query(
-            """
-            select {}
-            from report
-            where Run IN {}
-            """.format(
-                sql, tuple(runs)
+        report = self._duckdb.execute(
+            "SELECT * EXCLUDE (report_row) FROM ({}) ORDER BY report_row".format(
+                self.get_batch_sql(runs, qvalue_threshold, protein_filter)
             )
-        )
-        report = database.df()
+        ).arrow()
         et = time.time() - s
         logging.info("Time to load report {} seconds".format(et))
         return report
 
-    def get_masses_and_modifications_map(self):
+    def get_modified_sequences(self) -> list:
         database = self._duckdb.query(
             """
             select DISTINCT "Modified.Sequence" from report
             """
         )
-        report = database.df()
-        uniq_p = report["Modified.Sequence"].values
-        masses_map = {k: AASequence.fromString(k).getMonoWeight() for k in uniq_p}
-        modifications_map = {k: AASequence.fromString(k).toString() for k in uniq_p}
+        return database.df()["Modified.Sequence"].tolist()
+
+    def get_masses_and_modifications_map(self):
+        peptidoforms = get_peptidoform_masses().lookup(self.get_modified_sequences())
+        masses_map = {k: mass for k, (mass, _) in peptidoforms.items()}
+        modifications_map = {k: notation for k, (_, notation) in peptidoforms.items()}
 
         return masses_map, modifications_map
 
@@ -87,95 +163,176 @@ class DiaNNConvert(DuckDB):
         logging.info("Time to load peptide map {} seconds".format(et))
         return best_ref_map
 
-    def get_peptide_count(self, df):
-        peptide_count = defaultdict(int)
-        for proteins in df["pg_accessions"]:
-            for protein in proteins.split(";"):
-                peptide_count[protein] += 1
-        return peptide_count
+    def get_pg_matrix_from_database(self, runs: list) -> pa.Table:
+        """
+        Protein groups of a group of runs in a single DuckDB aggregation. DIA-NN repeats the protein group values
+        on every precursor, the first precursor of every protein group and run is kept with the number of
+        precursors of the group.
+        :param runs: A list of ms_runs
+        :return: arrow table with run, the columns of DIANN_PG_MAP and precursors, sorted by run
+        """
+        s = time.time()
+        columns = ", ".join(f'"{col}" AS "{name}"' for col, name in DIANN_PG_MAP.items() if col != "Run")
+        pg_matrix = self._duckdb.execute(
+            f"""
+            WITH batch AS (
+                SELECT "Run" AS run, {columns}, row_number() OVER () AS report_row
+                FROM report
+                WHERE {runs_predicate(runs)} AND "Protein.Group" IS NOT NULL
+            ),
+            groups AS (
+                SELECT min(report_row) AS report_row, count(*) AS precursors
+                FROM batch
+                GROUP BY run, pg_accessions
+            )
+            SELECT
+                b.run,
+                split_part(b.run, '.', 1) AS reference_file_name,
+                b.* EXCLUDE (run, report_row),
+                g.precursors
+            FROM batch b JOIN groups g ON b.report_row = g.report_row
+            ORDER BY b.run, b.report_row
+            """
+        ).arrow()
+        et = time.time() - s
+        logging.info("Time to load protein groups {} seconds".format(et))
+        return pg_matrix
 
-    def generate_pg_matrix(self, report):
-        peptide_count = self.get_peptide_count(report)
-        report.drop_duplicates(subset=["pg_accessions"],inplace=True)
-        report["gg_accessions"] = report["gg_accessions"].str.split(";")
-        report["pg_names"] = report["pg_names"].str.split(";")
-        report["reference_file_name"] = report["reference_file_name"].apply(lambda x: x.split(".")[0])
-        report["pg_accessions"] = report["pg_accessions"].str.split(";")
-        report.loc[:,"peptides"] = report["pg_accessions"].apply(
-            lambda proteins: [{
-                "protein_name": protein, 
-                "peptide_count": peptide_count[protein]
-            } for protein in proteins]
-        )
-        report.loc[:, "is_decoy"] = 0
-        report.loc[:, "additional_intensities"] = report[["normalize_intensity","lfq"]].apply(
-            lambda rows: [
-                {
-                    "intensity_name": name,
-                    "intensity_value": rows[name]
-                } for name in ["normalize_intensity","lfq"]
-            ],
-            axis=1,
+    @staticmethod
+    def generate_pg_matrix(pg_matrix: pa.Table) -> pa.Table:
+        """
+        Build the PG_SCHEMA table of the protein groups of get_pg_matrix_from_database. The peptide count of a
+        protein is the number of precursors of the run whose protein group holds it, the proteins of all the
+        groups are counted at once with an arrow group by, and the nested columns are assembled in arrow.
+        :param pg_matrix: protein groups
+        :return: arrow table
+        """
+        size = pg_matrix.num_rows
+        pg_matrix = pg_matrix.combine_chunks()
+        proteins = pc.split_pattern(pg_matrix.column("pg_accessions").chunk(0), ";")
+        parents = pc.list_parent_indices(proteins)
+        members = pa.table(
+            {
+                "run": pg_matrix.column("run").take(parents),
+                "protein": pc.list_flatten(proteins),
+                "precursors": pg_matrix.column("precursors").take(parents),
+                "member": pa.array(np.arange(len(parents))),
+            }
         )
-        report.loc[:, "additional_scores"] = report["qvalue"].apply(
-            lambda value: [{
-                "score_name": "qvalue",
-                "score_value": value
-            }]
+        counts = members.group_by(["run", "protein"]).aggregate([("precursors", "sum")])
+        members = members.join(counts, ["run", "protein"]).sort_by("member")
+        peptides_type = PG_SCHEMA.field("peptides").type
+        offsets = np.concatenate([[0], np.cumsum(pc.list_value_length(proteins).to_numpy())])
+        peptide_counts = members.column("precursors_sum").combine_chunks().cast(pa.int32())
+        peptides = pa.ListArray.from_arrays(
+            pa.array(offsets, type=pa.int32()),
+            pa.StructArray.from_arrays(
+                [members.column("protein").combine_chunks(), peptide_counts], fields=list(peptides_type.value_type)
+            ),
         )
-        report.loc[:, "contaminant"] = None
-        report.loc[:, "anchor_protein"] = None
-        return report
+        columns = {
+            "pg_accessions": proteins,
+            "pg_names": pc.split_pattern(pg_matrix.column("pg_names"), ";"),
+            "gg_accessions": pc.split_pattern(pg_matrix.column("gg_accessions"), ";"),
+            "reference_file_name": pg_matrix.column("reference_file_name"),
+            "global_qvalue": pg_matrix.column("global_qvalue"),
+            "intensity": pg_matrix.column("intensity"),
+            "additional_intensities": struct_list_array(
+                [
+                    {"intensity_name": name, "intensity_value": pg_matrix.column(name)}
+                    for name in ["normalize_intensity", "lfq"]
+                ],
+                PG_SCHEMA.field("additional_intensities").type,
+                size,
+            ),
+            "is_decoy": pa.repeat(pa.scalar(0, pa.int32()), size),
+            "contaminant": pa.nulls(size, pa.int32()),
+            "peptides": peptides,
+            "anchor_protein": pa.nulls(size, pa.string()),
+            "additional_scores": struct_list_array(
+                [{"score_name": "qvalue", "score_value": pg_matrix.column("qvalue")}],
+                PG_SCHEMA.field("additional_scores").type,
+                size,
+            ),
+        }
+        return pa.Table.from_arrays([columns[field.name].cast(field.type) for field in PG_SCHEMA], schema=PG_SCHEMA)
 
-    def main_report_df(self, qvalue_threshold: float, mzml_info_folder: str, file_num: int, protein_str: str = None):
-        def intergrate_msg(n):
-            nonlocal report
-            nonlocal mzml_info_folder
-            files = list(Path(mzml_info_folder).glob(f"*{n}_ms_info.parquet"))
-            if not files:
-                raise ValueError(f"Could not find {n} info file in {dir}")
-            target = pd.read_parquet(
-                files[0],
-                columns=["rt", "scan", "observed_mz"],
+    def get_report_with_ms_info(
+        self, runs: list, ms_info_index: dict, qvalue_threshold: float, protein_filter: ProteinFilter = None
+    ) -> pa.Table:
+        """
+        Load the report rows of a group of runs with the scan and the observed mz of the spectrum of ms_info
+        closest to their retention time, the earlier one on ties. Every spectrum carries the next one of its run,
+        so a single DuckDB ASOF join on the previous spectrum finds the closest one.
+        :param runs: A list of ms_runs
+        :param ms_info_index: see index_ms_info_files, only the files of the runs are read
+        :param qvalue_threshold: only the rows with a lower q-value are kept
+        :param protein_filter: ProteinFilter on the protein groups
+        :return: arrow table with the report columns renamed as in DIANN_MAP, sorted by run and retention time
+        """
+        s = time.time()
+        paths = ", ".join(sql_literal(ms_info_index[run]["path"]) for run in runs)
+        report = self._duckdb.execute(
+            f"""
+            WITH batch AS ({self.get_batch_sql(runs, qvalue_threshold, protein_filter)}),
+            ms_info AS (
+                SELECT
+                    regexp_extract(filename, '([^/\\\\]*)_ms_info\\.parquet$', 1) AS run,
+                    rt / 60 AS rt,
+                    scan,
+                    observed_mz
+                FROM read_parquet([{paths}], filename=true, union_by_name=true)
+            ),
+            spectra AS (
+                SELECT
+                    run,
+                    rt,
+                    scan,
+                    observed_mz,
+                    lead(rt) OVER w AS next_rt,
+                    lead(scan) OVER w AS next_scan,
+                    lead(observed_mz) OVER w AS next_observed_mz
+                FROM ms_info
+                WINDOW w AS (PARTITION BY run ORDER BY rt)
+                UNION ALL
+                -- the rows before the first spectrum of their run only have a next spectrum
+                SELECT run, '-infinity'::DOUBLE, NULL, NULL, min(rt), arg_min(scan, rt), arg_min(observed_mz, rt)
+                FROM ms_info
+                GROUP BY run
             )
-            group = report[report["run"] == n].copy()
-            group.sort_values(by="rt", inplace=True)
-            target["rt"] = target["rt"] / 60
-            res = pd.merge_asof(group, target, on="rt", direction="nearest")
-            return res
+            SELECT
+                b.* EXCLUDE (report_row),
+                CASE WHEN m.next_rt IS NULL OR b.rt - m.rt <= m.next_rt - b.rt THEN m.scan ELSE m.next_scan END AS scan,
+                CASE WHEN m.next_rt IS NULL OR b.rt - m.rt <= m.next_rt - b.rt
+                    THEN m.observed_mz ELSE m.next_observed_mz END AS observed_mz
+            FROM batch b ASOF LEFT JOIN spectra m ON b.run = m.run AND b.rt >= m.rt
+            ORDER BY b.run, b.rt, b.report_row
+            """
+        ).arrow()
+        et = time.time() - s
+        logging.info("Time to load report {} seconds".format(et))
+        return report
 
-        masses_map, modifications_map = self.get_masses_and_modifications_map()
+    def main_report_df(
+        self, qvalue_threshold: float, mzml_info_folder: str, file_num: int, protein_filter: ProteinFilter = None
+    ):
+        # parse the peptidoforms left to AASequence at once, the batches then read them from memory
+        peptidoform_masses = get_peptidoform_masses()
+        peptidoform_masses.lookup(self.get_modified_sequences())
 
-        info_list = [
-            mzml.replace("_ms_info.parquet", "")
-            for mzml in os.listdir(mzml_info_folder)
-            if mzml.endswith("_ms_info.parquet")
-        ]
-        info_list = [info_list[i : i + file_num] for i in range(0, len(info_list), file_num)]
-        for refs in info_list:
-            report = self.get_report_from_database(refs)
-            report.rename(columns=DIANN_MAP, inplace=True)
-            report.dropna(subset=["pg_accessions"], inplace=True)
-            if protein_str:
-                report = report[report["pg_accessions"].str.contains(f"{protein_str}", na=False)]
-            # restrict
-            report = report[report["qvalue"] < qvalue_threshold]
-            usecols = report.columns.to_list() + [
-                "scan",
-                "observed_mz",
-            ]
-            with concurrent.futures.ThreadPoolExecutor(100) as executor:
-                results = executor.map(intergrate_msg, refs)
-            report = np.vstack([result.values for result in results])
-            report = pd.DataFrame(report, columns=usecols)
+        ms_info_index = index_ms_info_files(mzml_info_folder)
+        if not ms_info_index:
+            raise ValueError(f"Could not find any ms_info file in {mzml_info_folder}")
+        for refs in plan_run_batches(ms_info_index, file_num):
+            report = self.get_report_with_ms_info(refs, ms_info_index, qvalue_threshold, protein_filter)
+            if report.num_rows == 0:
+                continue
+            report = report.to_pandas()
 
             # cal value and mod
-            mass_vector = report["peptidoform"].map(masses_map)
-            report["calculated_mz"] = (mass_vector + (PROTON_MASS_U * report["precursor_charge"].values)) / report[
-                "precursor_charge"
-            ].values
-
-            report["peptidoform"] = report["peptidoform"].map(modifications_map)
+            masses, notations = peptidoform_masses.get_masses_and_notations(report["peptidoform"])
+            report["calculated_mz"] = calculated_mz(masses, report["precursor_charge"].values)
+            report["peptidoform"] = notations
 
             yield report
 
@@ -184,62 +341,65 @@ class DiaNNConvert(DuckDB):
         Perform some transformations in the report dataframe to help with the generation of the psm and feature files.
         :param report: The report dataframe
         """
-        select_mods = list(self._mods_map.keys())
-        report["reference_file_name"] = report["reference_file_name"].apply(lambda x: x.split(".")[0])
-        report[["peptidoform", "modifications"]] = report[["peptidoform"]].apply(
-            lambda row: MzTab.generate_modifications_details(
-                row["peptidoform"], self._mods_map, self._automaton, select_mods
-            ),
-            axis=1,
-            result_type="expand",
-        )
+        # a batch only holds a few runs, the names and samples are resolved once per run and gathered by row
+        codes, references = pd.factorize(report["reference_file_name"])
+        references = [reference.split(".")[0] for reference in references]
+        report["reference_file_name"] = pd.Categorical.from_codes(codes, references).astype(object)
+        self._modification_parser.transform(report)
         report.loc[:, "channel"] = "LFQ"
-        report.loc[:, "intensities"] = report[["reference_file_name", "channel", "intensity"]].apply(
-            lambda rows: [
-                {
-                    "sample_accession": self._sample_map[rows["reference_file_name"] + "-" + rows["channel"]],
-                    "channel": rows["channel"],
-                    "intensity": rows["intensity"],
-                }
-            ],
-            axis=1,
+        sample_accessions = pa.array(
+            map_sample_accessions(pd.Series(references) + "-LFQ", self._sample_map), type=pa.string()
+        ).take(pa.array(codes))
+        report["intensities"] = to_pandas_column(
+            struct_list_array(
+                [{"sample_accession": sample_accessions, "channel": "LFQ", "intensity": report["intensity"]}],
+                FEATURE_SCHEMA.field("intensities").type,
+                len(report),
+            ),
+            report.index,
         )
         report.loc[:, "is_decoy"] = "0"
-        report.loc[:, "unique"] = report["pg_accessions"].apply(lambda x: "0" if ";" in str(x) else "1")
-        report["scan"] = report["scan"].apply(generate_scan_number)
+        report["unique"] = np.where(report["pg_accessions"].str.contains(";", regex=False, na=False), "0", "1")
+        report["scan"] = generate_scan_numbers(report["scan"]).to_numpy(zero_copy_only=False)
         report["mp_accessions"] = report["mp_accessions"].str.split(";")
         report["pg_accessions"] = report["pg_accessions"].str.split(";")
         report.loc[:, "anchor_protein"] = report["pg_accessions"].str[0]
         report.loc[:, "gg_names"] = report["gg_names"].str.split(",")
-        report.loc[:, "additional_intensities"] = report[
-            ["reference_file_name", "channel", "normalize_intensity", "lfq"]
-        ].apply(
-            lambda rows: [
+        additional_intensities_type = FEATURE_SCHEMA.field("additional_intensities").type
+        additional_intensity = struct_list_array(
+            [{"intensity_name": name, "intensity_value": report[name]} for name in ["normalize_intensity", "lfq"]],
+            additional_intensities_type.value_type.field("additional_intensity").type,
+            len(report),
+        )
+        additional_intensities = struct_list_array(
+            [
                 {
-                    "sample_accession": self._sample_map[rows["reference_file_name"] + "-" + rows["channel"]],
-                    "channel": rows["channel"],
-                    "additional_intensity": [
-                        {"intensity_name": "normalize_intensity", "intensity_value": rows["normalize_intensity"]},
-                        {"intensity_name": "lfq", "intensity_value": rows["lfq"]},
-                    ],
+                    "sample_accession": sample_accessions,
+                    "channel": "LFQ",
+                    "additional_intensity": additional_intensity,
                 }
             ],
-            axis=1,
+            additional_intensities_type,
+            len(report),
         )
-        report.loc[:, "additional_scores"] = report[["qvalue", "pg_qvalue", "global_qvalue"]].apply(
-            lambda row: [
-                {"score_name": "qvalue", "score_value": row["qvalue"]},
-                {"score_name": "pg_qvalue", "score_value": row["pg_qvalue"]},
-                {"score_name": "global_qvalue", "score_value": row["global_qvalue"]},
-            ],
-            axis=1,
+        report["additional_intensities"] = to_pandas_column(additional_intensities, report.index)
+        additional_scores = struct_list_array(
+            [{"score_name": name, "score_value": report[name]} for name in ["qvalue", "pg_qvalue", "global_qvalue"]],
+            FEATURE_SCHEMA.field("additional_scores").type,
+            len(report),
         )
-        report.loc[:, "cv_params"] = report[["precursor_quantification_score"]].apply(
-            lambda rows: [
-                {"cv_name": "precursor_quantification_score", "cv_value": str(rows["precursor_quantification_score"])}
+        report["additional_scores"] = to_pandas_column(additional_scores, report.index)
+        cv_params = struct_list_array(
+            [
+                {
+                    "cv_name": "precursor_quantification_score",
+                    "cv_value": report["precursor_quantification_score"].astype(str),
+                }
             ],
-            axis=1,
+            FEATURE_SCHEMA.field("cv_params").type,
+            len(report),
         )
+        report["cv_params"] = to_pandas_column(cv_params, report.index)
         report.loc[:, "scan_reference_file_name"] = None
         report.loc[:, "gg_accessions"] = None
         report.loc[:, "ion_mobility"] = None
@@ -247,9 +407,9 @@ class DiaNNConvert(DuckDB):
         report.loc[:, "stop_ion_mobility"] = None
 
     def generate_feature(
-        self, qvalue_threshold: float, mzml_info_folder: str, file_num: int = 50, protein_str: str = None
+        self, qvalue_threshold: float, mzml_info_folder: str, file_num: int = 50, protein_filter: ProteinFilter = None
     ):
-        for report in self.main_report_df(qvalue_threshold, mzml_info_folder, file_num, protein_str):
+        for report in self.main_report_df(qvalue_threshold, mzml_info_folder, file_num, protein_filter):
             s = time.time()
             self.add_additional_msg(report)
             Feature.convert_to_parquet_format(report)
@@ -258,20 +418,17 @@ class DiaNNConvert(DuckDB):
             yield report
 
     def write_pg_matrix_to_file(self, output_path:str,file_num=20):
-        info_list = self.get_unique_references("Run")
+        info_list = sorted(self.get_unique_references("Run"))
         info_list = [info_list[i : i + file_num] for i in range(0, len(info_list), file_num)]
         pqwriter = None
         for refs in info_list:
-            report = self.get_report_from_database(refs, DIANN_PG_SQL)
-            report.rename(columns=DIANN_PG_MAP, inplace=True)
-            report.dropna(subset=["pg_accessions"], inplace=True)
-            for ref in refs:
-                df = report[report["reference_file_name"] == ref].copy()
-                df = self.generate_pg_matrix(df)
-                pg_parquet = pa.Table.from_pandas(df, schema=PG_SCHEMA)
-                if not pqwriter:
-                    pqwriter = pq.ParquetWriter(output_path, pg_parquet.schema)
-                pqwriter.write_table(pg_parquet)
+            pg_matrix = self.get_pg_matrix_from_database(refs)
+            if pg_matrix.num_rows == 0:
+                continue
+            pg_parquet = self.generate_pg_matrix(pg_matrix)
+            if not pqwriter:
+                pqwriter = pq.ParquetWriter(output_path, pg_parquet.schema)
+            pqwriter.write_table(pg_parquet)
         close_file(pqwriter=pqwriter)
         self.destroy_duckdb_database()
     def write_feature_to_file(
@@ -282,10 +439,9 @@ class DiaNNConvert(DuckDB):
         file_num: int = 50,
         protein_file=None,
     ):
-        protein_list = extract_protein_list(protein_file) if protein_file else None
-        protein_str = "|".join(protein_list) if protein_list else None
+        protein_filter = ProteinFilter.from_file(protein_file)
         pqwriter = None
-        for report in self.generate_feature(qvalue_threshold, mzml_info_folder, file_num, protein_str):
+        for report in self.generate_feature(qvalue_threshold, mzml_info_folder, file_num, protein_filter):
             feature = Feature.transform_feature(report)
             if not pqwriter:
                 pqwriter = pq.ParquetWriter(output_path, feature.schema)
@@ -303,12 +459,11 @@ class DiaNNConvert(DuckDB):
         file_num: int = 50,
         protein_file=None,
     ):
-        pqwriters = {}
-        protein_list = extract_protein_list(protein_file) if protein_file else None
-        protein_str = "|".join(protein_list) if protein_list else None
-        for report in self.generate_feature(qvalue_threshold, mzml_info_folder, file_num, protein_str):
+        pqwriters = ParquetPartitionWriter(output_folder, filename, partitions)
+        protein_filter = ProteinFilter.from_file(protein_file)
+        for report in self.generate_feature(qvalue_threshold, mzml_info_folder, file_num, protein_filter):
             for key, df in Feature.slice(report, partitions):
                 feature = Feature.transform_feature(df)
-                pqwriters = save_slice_file(feature, pqwriters, output_folder, key, filename)
+                pqwriters.write_table(key, feature)
         close_file(pqwriters=pqwriters)
         self.destroy_duckdb_database()
@@ -1,17 +1,220 @@
 import duckdb
+import hashlib
 import time
 import logging
 import os
 from quantmsio.core.project import create_uuid_filename
 
+# default size cap of a DuckDB cache folder
+DUCKDB_CACHE_SIZE = "100GB"
+# bytes hashed at the start and at the end of a report to fingerprint it
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+SIZE_UNITS = {"B": 1, "KB": 1000, "MB": 1000**2, "GB": 1000**3, "TB": 1000**4}
+
+
+def parse_size(size) -> int:
+    """
+    :param size: number of bytes, or a string with a unit as DuckDB memory limits, e.g. 500MB or 100GB
+    :return: number of bytes
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    value = size.strip().upper().replace("IB", "B")
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if value.endswith(unit):
+            return int(float(value[: -len(unit)]) * SIZE_UNITS[unit])
+    return int(float(value))
+
+
+def get_report_fingerprint(report_path: str) -> str:
+    """
+    Fingerprint of a report from its path, size, modification time and the hash of its first and last blocks.
+    Hashing the whole report would cost as much as ingesting it.
+    :param report_path: report file path
+    :return: hex digest
+    """
+    stat = os.stat(report_path)
+    digest = hashlib.sha256()
+    digest.update(f"{os.path.abspath(report_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8"))
+    with open(report_path, "rb") as f:
+        digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+        if stat.st_size > FINGERPRINT_BLOCK_SIZE:
+            f.seek(max(stat.st_size - FINGERPRINT_BLOCK_SIZE, FINGERPRINT_BLOCK_SIZE))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def evict_duckdb_cache(cache_dir: str, cache_size, keep: str = None):
+    """
+    Remove the least recently used databases of a cache folder until it fits in cache_size.
+    :param cache_dir: cache folder
+    :param cache_size: size cap, see parse_size
+    :param keep: database that is never removed, e.g. the one in use
+    """
+    databases = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith(".duckdb") and os.path.isfile(path):
+            stat = os.stat(path)
+            databases.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in databases)
+    limit = parse_size(cache_size)
+    for _, size, path in sorted(databases):
+        if total <= limit:
+            break
+        if keep and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            logging.info("Evicted {} from the duckdb cache".format(path))
+        except OSError as e:
+            logging.warning("Can not evict {} from the duckdb cache: {}".format(path, e))
+
+
+def is_parquet_report(report_path: str) -> bool:
+    """
+    Parquet reports, e.g. the report.parquet of the recent DIA-NN versions, are queried in place.
+    """
+    return report_path.lower().endswith(".parquet")
+
+
+def sql_literal(value) -> str:
+    """
+    SQL literal of a python value, for the values inlined in queries.
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def sql_identifier(name: str) -> str:
+    """
+    Quoted SQL identifier of a column name, e.g. the DIA-NN columns with dots.
+    """
+    return '"{}"'.format(name.replace('"', '""'))
+
 
 class DuckDB:
+    # column the report table is sorted by when it is ingested, the rows of a value keep their order
+    REPORT_ORDER = None
+    # columns of the report used by the subclass, the other columns are never read, None reads all of them
+    REPORT_COLUMNS = None
 
-    def __init__(self, report_path, duckdb_max_memory="16GB", duckdb_threads=4):
+    def __init__(
+        self,
+        report_path,
+        duckdb_max_memory="16GB",
+        duckdb_threads=4,
+        cache_dir=None,
+        cache_size=DUCKDB_CACHE_SIZE,
+        direct_view=False,
+    ):
+        """
+        :param report_path: report file (tsv, csv or parquet)
+        :param duckdb_max_memory: memory limit of DuckDB
+        :param duckdb_threads: number of DuckDB threads
+        :param cache_dir: folder where the ingested reports are kept and reused by later runs, by default every
+            run ingests the report into a temporary database
+        :param cache_size: size cap of cache_dir, the least recently used databases are removed beyond it
+        :param direct_view: query the report file in place through a view instead of ingesting it. Parquet
+            reports are always queried in place, DuckDB only reads the columns and the row groups a query needs
+        """
         self._report_path = report_path
-        self._duckdb_name = create_uuid_filename("report-duckdb", ".db")
+        self._cache_dir = cache_dir
+        self._cache_size = cache_size
+        self._direct_view = direct_view
+        # database file removed by destroy_duckdb_database, None for cached databases and views
+        self._duckdb_name = None
         self._duckdb = self.create_duckdb_from_diann_report(duckdb_max_memory, duckdb_threads)
 
+    @property
+    def connection(self) -> duckdb.DuckDBPyConnection:
+        """
+        Connection to the database of the report, for the queries and the tables of other classes joined to the
+        report table. It is closed by destroy_duckdb_database.
+        """
+        return self._duckdb
+
+    def get_report_sql(self) -> str:
+        """
+        Query of the report rows, subclasses add the columns derived from the report.
+        """
+        columns = ", ".join(sql_identifier(col) for col in self.REPORT_COLUMNS) if self.REPORT_COLUMNS else "*"
+        return "SELECT {} FROM '{}'".format(columns, self._report_path.replace("'", "''"))
+
+    def get_cache_path(self) -> str:
+        """
+        Database of the report in the cache folder. The name depends on the report fingerprint and on the way the
+        report is ingested, so the databases of different subclasses do not collide.
+        """
+        digest = hashlib.sha256()
+        digest.update(get_report_fingerprint(self._report_path).encode("utf-8"))
+        digest.update(f"{self.get_report_sql()}|{self.REPORT_ORDER}".encode("utf-8"))
+        return os.path.join(self._cache_dir, "report-{}.duckdb".format(digest.hexdigest()[:32]))
+
+    def ingest_report(self, database):
+        """
+        Load the report into the report table of the database, in a single pass. With REPORT_ORDER the rows are
+        sorted while they are ingested, the rows of a value keep their order in the report.
+        """
+        sql = self.get_report_sql()
+        if self.REPORT_ORDER:
+            sql = (
+                "SELECT * EXCLUDE (report_row) FROM (SELECT *, row_number() OVER () AS report_row FROM ({})) "
+                "ORDER BY {}, report_row".format(sql, self.REPORT_ORDER)
+            )
+        database.execute("CREATE TABLE report AS {}".format(sql))
+
+    def open_database(self, path: str = ":memory:", read_only: bool = False):
+        """
+        Connect to a database with the memory and thread limits, they also bound the ingestion of the report.
+        """
+        database = duckdb.connect(path, read_only=read_only)
+        database.execute("SET enable_progress_bar=true")
+        if self._max_memory is not None:
+            database.execute("SET max_memory='{}'".format(self._max_memory))
+        if self._worker_threads is not None:
+            database.execute("SET worker_threads='{}'".format(self._worker_threads))
+        return database
+
+    def connect(self):
+        """
+        Open the database of the report: a view over the report in direct view mode or for parquet reports, the
+        cached database if the report was already ingested in the cache folder, otherwise a new database.
+        """
+        if self._direct_view or is_parquet_report(self._report_path):
+            database = self.open_database()
+            database.execute("CREATE VIEW report AS {}".format(self.get_report_sql()))
+            return database
+        if not self._cache_dir:
+            self._duckdb_name = create_uuid_filename("report-duckdb", ".db")
+            database = self.open_database(self._duckdb_name)
+            self.ingest_report(database)
+            return database
+        os.makedirs(self._cache_dir, exist_ok=True)
+        cache_path = self.get_cache_path()
+        if os.path.exists(cache_path):
+            logging.info("Reuse the duckdb database {}".format(cache_path))
+        else:
+            # other processes only see complete databases
+            tmp_path = create_uuid_filename(cache_path, ".tmp")
+            database = self.open_database(tmp_path)
+            try:
+                self.ingest_report(database)
+                database.close()
+                os.replace(tmp_path, cache_path)
+            finally:
+                for path in [tmp_path, tmp_path + ".wal"]:
+                    if os.path.exists(path):
+                        os.remove(path)
+        # the modification time records the last use for the eviction
+        os.utime(cache_path)
+        evict_duckdb_cache(self._cache_dir, self._cache_size, keep=cache_path)
+        return self.open_database(cache_path, read_only=True)
+
     def create_duckdb_from_diann_report(self, max_memory, worker_threads):
         """
         This function creates a duckdb database from a diann report for fast performance queries. The database
@@ -21,19 +224,13 @@ class DuckDB:
         """
         s = time.time()
 
-        database = duckdb.connect(self._duckdb_name)
-        database.execute("SET enable_progress_bar=true")
-
-        if max_memory is not None:
-            database.execute("SET max_memory='{}'".format(max_memory))
-        if worker_threads is not None:
-            database.execute("SET worker_threads='{}'".format(worker_threads))
+        self._max_memory = max_memory
+        self._worker_threads = worker_threads
+        database = self.connect()
 
         msg = database.execute("SELECT * FROM duckdb_settings() where name in ('worker_threads', 'max_memory')").df()
         logging.info("duckdb uses {} threads.".format(str(msg["value"][0])))
         logging.info("duckdb uses {} of memory.".format(str(msg["value"][1])))
-
-        database.execute("CREATE TABLE report AS SELECT * FROM '{}'".format(self._report_path))
         et = time.time() - s
         logging.info("Time to create duckdb database {} seconds".format(et))
         return database
@@ -67,16 +264,21 @@ class DuckDB:
         return report
 
     def query_field(self, field: str, querys: list, columns: list = None):
-
-        proteins_key = [f"{field} LIKE '%{p}%'" for p in querys]
-        query_key = " OR ".join(proteins_key)
+        """
+        Rows of the report whose field is one of querys, the values are inlined in the IN list as SQL literals.
+        :param field: column to match
+        :param querys: values of the column
+        :param columns: columns to return
+        :return: pandas DataFrame
+        """
         cols = ", ".join(columns) if columns and isinstance(columns, list) else "*"
-        database = self._duckdb.sql(f"SELECT {cols} FROM report WHERE {query_key}")
-        return database.df()
+        values = ", ".join(sql_literal(query) for query in querys)
+        return self._duckdb.execute(f"SELECT {cols} FROM report WHERE {field} IN ({values})").df()
 
     def destroy_duckdb_database(self):
-        if self._duckdb_name and self._duckdb:
+        if self._duckdb:
             self._duckdb.close()
+            self._duckdb = None
+        if self._duckdb_name:
             os.remove(self._duckdb_name)
             self._duckdb_name = None
-            self._duckdb = None
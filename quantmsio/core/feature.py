@@ -1,88 +1,272 @@
+import os
+import shutil
+import tempfile
+import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
-from quantmsio.operate.tools import get_ahocorasick, get_protein_accession
-from quantmsio.utils.file_utils import extract_protein_list, save_slice_file, close_file
+from quantmsio.operate.tools import ModificationParser, get_protein_accession
+from quantmsio.utils.file_utils import ParquetPartitionWriter, close_file
+from quantmsio.utils.protein_filter import ProteinFilter
+from quantmsio.utils.arrow_utils import dataframe_to_table, join_table_columns, table_to_dataframe
 from quantmsio.core.mztab import MzTab
-from quantmsio.core.psm import Psm
+from quantmsio.core.psm import Psm, select_best_rows
 from quantmsio.core.sdrf import SDRFHandler
 from quantmsio.core.msstats_in import MsstatsIN
 from quantmsio.core.common import FEATURE_SCHEMA
 
+PSM_KEYS = ["reference_file_name", "peptidoform", "precursor_charge"]
+PSM_FEATURES = [
+    "posterior_error_probability",
+    "calculated_mz",
+    "observed_mz",
+    "mp_accessions",
+    "is_decoy",
+    "additional_scores",
+    "cv_params",
+]
+
+# types of the psms staged for DuckDB, scores keep their full precision for the selection of the best psm
+PSM_STAGE_SCHEMA = pa.schema(
+    [
+        ("reference_file_name", pa.string()),
+        ("peptidoform", pa.string()),
+        ("precursor_charge", pa.int64()),
+        ("posterior_error_probability", pa.float64()),
+        ("calculated_mz", pa.float64()),
+        ("observed_mz", pa.float64()),
+        ("mp_accessions", pa.string()),
+        ("is_decoy", pa.float64()),
+        FEATURE_SCHEMA.field("additional_scores").remove_metadata(),
+        FEATURE_SCHEMA.field("cv_params").remove_metadata(),
+        ("psm_row", pa.int64()),
+    ]
+)
+PEP_STAGE_SCHEMA = pa.schema(
+    [
+        ("peptidoform", pa.string()),
+        ("precursor_charge", pa.int64()),
+        ("score", pa.float64()),
+        ("scan_reference_file_name", pa.string()),
+        ("scan", pa.string()),
+        ("pep_row", pa.int64()),
+    ]
+)
+PROTEIN_STAGE_SCHEMA = pa.schema([("ambiguity_members", pa.string()), ("score", pa.float64())])
+
+FEATURE_SQL = """
+SELECT m.* EXCLUDE (msstats_row), {psm_columns}, q.pg_global_qvalue, s.scan_reference_file_name, s.scan
+FROM ({msstats_sql}) m
+LEFT JOIN best_psm p
+    ON m.reference_file_name = p.reference_file_name
+    AND m.peptidoform = p.peptidoform
+    AND m.precursor_charge = p.precursor_charge
+LEFT JOIN protein_qvalue q ON p.mp_accessions = q.ambiguity_members
+LEFT JOIN best_scan s ON m.peptidoform = s.peptidoform AND m.precursor_charge = s.precursor_charge
+ORDER BY m.msstats_row
+"""
+
+
+def select_best_psms(df, keys=PSM_KEYS, score="posterior_error_probability"):
+    """
+    Keep the row with the lowest score of every key, the first one when several rows have the same score.
+    :param df: psm dataframe
+    :param keys: columns identifying a feature
+    :param score: column to minimize
+    :return: dataframe with one row per key
+    """
+    return select_best_rows(df, keys, score)
+
 
 class Feature(MzTab):
-    def __init__(self, mzTab_path, sdrf_path, msstats_in_path):
+    def __init__(self, mzTab_path, sdrf_path, msstats_in_path, **duckdb_options):
+        """
+        :param duckdb_options: cache_dir, cache_size and direct_view options of the DuckDB database of the msstats
+            report, see DuckDB
+        """
         super(Feature, self).__init__(mzTab_path)
+        self._duckdb_options = duckdb_options
         self._msstats_in = msstats_in_path
         self._sdrf_path = sdrf_path
-        self._ms_runs = self.extract_ms_runs()
-        self._protein_global_qvalue_map = self.get_protein_map()
-        self._score_names = self.get_score_names()
+        self._ms_runs = self.metadata.ms_runs
+        self._protein_global_qvalue_map = self.metadata.get_protein_map()
+        self._score_names = self.metadata.score_names
         self.experiment_type = SDRFHandler(sdrf_path).get_experiment_type_from_sdrf()
-        self._mods_map = self.get_mods_map()
-        self._automaton = get_ahocorasick(self._mods_map)
+        self._mods_map = self.metadata.mods_map
+        self._modification_parser = ModificationParser(self._mods_map)
 
-    def extract_psm_msg(self, chunksize=2000000, protein_str=None):
+    def extract_psm_msg(self, chunksize=2000000, protein_filter=None):
+        """
+        :return: arrow table with the best psm (lowest posterior error probability) of every
+            (reference_file_name, peptidoform, precursor_charge), and arrow table with the best scan of the
+            peptides, see Psm.extract_from_pep
+        """
         P = Psm(self.mztab_path)
-        pep_dict = P.extract_from_pep(chunksize=100000)
-        map_dict = {}
-        for psm in P.iter_psm_table(chunksize, protein_str):
-            for key, df in psm.groupby(["reference_file_name", "peptidoform", "precursor_charge"]):
-                df.reset_index(drop=True, inplace=True)
-                temp_df = df.iloc[df["posterior_error_probability"].idxmin()]
-                if key not in map_dict:
-                    map_dict[key] = [None for _ in range(7)]
-                pep_value = temp_df["posterior_error_probability"]
-                if map_dict[key][0] is None or float(map_dict[key][0]) > float(pep_value):
-                    map_dict[key][0] = pep_value
-                    map_dict[key][1] = temp_df["calculated_mz"]
-                    map_dict[key][2] = temp_df["observed_mz"]
-                    map_dict[key][3] = temp_df["mp_accessions"]
-                    map_dict[key][4] = temp_df["is_decoy"]
-                    map_dict[key][5] = temp_df["additional_scores"]
-                    map_dict[key][6] = temp_df["cv_params"]
-        return map_dict, pep_dict
-
-    def transform_msstats_in(self, file_num=10, protein_str=None, duckdb_max_memory="16GB", duckdb_threads=4):
-        Msstats = MsstatsIN(self._msstats_in, self._sdrf_path, duckdb_max_memory, duckdb_threads)
-        for msstats in Msstats.generate_msstats_in(file_num, protein_str):
-            yield msstats
-        Msstats.destroy_duckdb_database()
-
-    def merge_msstats_and_psm(self, msstats, map_dict):
-        map_features = [
-            "posterior_error_probability",
-            "calculated_mz",
-            "observed_mz",
-            "mp_accessions",
-            "is_decoy",
-            "additional_scores",
-            "cv_params",
-        ]
-
-        def merge_psm(rows, index):
-            key = (rows["reference_file_name"], rows["peptidoform"], rows["precursor_charge"])
-            if key in map_dict:
-                return map_dict[key][index]
-            else:
-                return None
-
-        for i, feature in enumerate(map_features):
-            msstats.loc[:, feature] = msstats[["reference_file_name", "peptidoform", "precursor_charge"]].apply(
-                lambda rows: merge_psm(rows, i),
-                axis=1,
-            )
-
-    def generate_feature(self, file_num=10, protein_str=None, duckdb_max_memory="16GB", duckdb_threads=4):
-        for msstats in self.generate_feature_report(file_num, protein_str, duckdb_max_memory, duckdb_threads):
+        pep_table = P.extract_from_pep(chunksize=100000)
+        best_psms = None
+        for psm in P.iter_psm_table(chunksize, protein_filter):
+            psm = select_best_psms(psm[PSM_KEYS + PSM_FEATURES])
+            if best_psms is not None:
+                # the psms of the previous chunks come first, they are kept on ties
+                psm = select_best_psms(pd.concat([best_psms, psm], ignore_index=True))
+            best_psms = psm
+        if best_psms is None:
+            return FEATURE_SCHEMA.empty_table().select(PSM_KEYS + PSM_FEATURES), pep_table
+        return dataframe_to_table(best_psms, preserve_index=False), pep_table
+
+    def transform_msstats_in(self, file_num=10, protein_filter=None, duckdb_max_memory="16GB", duckdb_threads=4):
+        Msstats = MsstatsIN(
+            self._msstats_in, self._sdrf_path, duckdb_max_memory, duckdb_threads, **self._duckdb_options
+        )
+        try:
+            for msstats in Msstats.generate_msstats_in(file_num, protein_filter):
+                yield msstats
+        finally:
+            Msstats.destroy_duckdb_database()
+
+    def stage_mztab_in_duckdb(self, database, folder, chunksize=2000000, protein_filter=None):
+        """
+        Create the DuckDB temporary tables joined to the msstats rows in duckdb mode:
+            best_psm: best psm (lowest posterior error probability) of every feature key, as extract_psm_msg
+            best_scan: best scan of every (peptidoform, precursor_charge), as extract_from_pep
+            protein_qvalue: best search engine score of every protein group, as get_protein_map
+        The PSM, PEP and PRT sections are streamed to parquet files in folder, the selections run in DuckDB as
+        window functions and aggregations, so they are bounded by the memory limit of the database.
+        :param database: DuckDB connection
+        :param folder: folder for the staged parquet files
+        :param chunksize: rows parsed per chunk of the mzTab sections
+        :param protein_filter: ProteinFilter on the psm accessions
+        """
+        P = Psm(self.mztab_path, self.index)
+        psm_path = os.path.join(folder, "psm.parquet")
+        with pq.ParquetWriter(psm_path, PSM_STAGE_SCHEMA) as writer:
+            offset = 0
+            for psm in P.iter_psm_table(chunksize, protein_filter):
+                psm = psm[PSM_KEYS + PSM_FEATURES].reset_index(drop=True)
+                psm["psm_row"] = np.arange(offset, offset + len(psm))
+                offset += len(psm)
+                writer.write_table(dataframe_to_table(psm, schema=PSM_STAGE_SCHEMA, preserve_index=False))
+        database.execute(
+            f"""
+            CREATE TEMP TABLE best_psm AS
+            SELECT * EXCLUDE (psm_row) FROM read_parquet('{psm_path}')
+            WHERE reference_file_name IS NOT NULL AND peptidoform IS NOT NULL AND precursor_charge IS NOT NULL
+            QUALIFY row_number() OVER (
+                PARTITION BY reference_file_name, peptidoform, precursor_charge
+                ORDER BY posterior_error_probability NULLS LAST, psm_row
+            ) = 1
+            """
+        )
+        pep_path = os.path.join(folder, "pep.parquet")
+        with pq.ParquetWriter(pep_path, PEP_STAGE_SCHEMA) as writer:
+            offset = 0
+            for pep in P.iter_pep_table(chunksize):
+                pep = pd.DataFrame(
+                    {
+                        "peptidoform": pep["opt_global_cv_MS:1000889_peptidoform_sequence"].values,
+                        "precursor_charge": pep["charge"].values,
+                        "score": pep["best_search_engine_score[1]"].values,
+                        "scan_reference_file_name": pep["spectra_ref"].values,
+                        "scan": pep["scan_number"].values,
+                        "pep_row": np.arange(offset, offset + len(pep)),
+                    }
+                )
+                offset += len(pep)
+                writer.write_table(pa.Table.from_pandas(pep, schema=PEP_STAGE_SCHEMA, preserve_index=False))
+        database.execute(
+            f"""
+            CREATE TEMP TABLE best_scan AS
+            SELECT peptidoform, precursor_charge, scan_reference_file_name, scan FROM read_parquet('{pep_path}')
+            WHERE peptidoform IS NOT NULL AND precursor_charge IS NOT NULL
+            QUALIFY row_number() OVER (
+                PARTITION BY peptidoform, precursor_charge ORDER BY score NULLS LAST, pep_row
+            ) = 1
+            """
+        )
+        protein_path = os.path.join(folder, "protein.parquet")
+        with pq.ParquetWriter(protein_path, PROTEIN_STAGE_SCHEMA) as writer:
+            for table in self.iter_section_tables("PRH", ["ambiguity_members", "best_search_engine_score[1]"]):
+                table = table.select(["ambiguity_members", "best_search_engine_score[1]"])
+                writer.write_table(table.rename_columns(PROTEIN_STAGE_SCHEMA.names).cast(PROTEIN_STAGE_SCHEMA))
+        database.execute(
+            f"""
+            CREATE TEMP TABLE protein_qvalue AS
+            SELECT ambiguity_members, min(score) AS pg_global_qvalue FROM read_parquet('{protein_path}')
+            WHERE ambiguity_members IS NOT NULL
+            GROUP BY ambiguity_members
+            """
+        )
+        for path in [psm_path, pep_path, protein_path]:
+            os.remove(path)
+
+    def generate_feature_report_duckdb(
+        self, file_num=10, protein_filter=None, duckdb_max_memory="16GB", duckdb_threads=4
+    ):
+        """
+        Same features as generate_feature_report, but the best psm selection, the best scan lookup, the protein
+        q-values and their join with the msstats rows run inside the DuckDB database of the msstats report.
+        :param file_num: number of runs per batch
+        :param protein_filter: ProteinFilter on the protein accessions
+        :param duckdb_max_memory: memory limit of DuckDB, it spills to disk beyond it
+        :param duckdb_threads: number of DuckDB threads
+        :return: generator of msstats dataframes, one per batch of runs
+        """
+        Msstats = MsstatsIN(
+            self._msstats_in, self._sdrf_path, duckdb_max_memory, duckdb_threads, **self._duckdb_options
+        )
+        folder = tempfile.mkdtemp(prefix="feature-duckdb-")
+        try:
+            self.stage_mztab_in_duckdb(Msstats.connection, folder, protein_filter=protein_filter)
+            psm_columns = ", ".join(f"p.{col}" for col in PSM_FEATURES)
+            runs = Msstats.get_runs()
+            for i in range(0, len(runs), file_num):
+                msstats_sql = Msstats.get_msstats_sql(runs[i : i + file_num], protein_filter)
+                sql = FEATURE_SQL.format(psm_columns=psm_columns, msstats_sql=msstats_sql)
+                table = Msstats.connection.execute(sql).arrow()
+                if table.num_rows == 0:
+                    continue
+                msstats = table_to_dataframe(table)
+                Msstats.transform_msstats_in(msstats)
+                Msstats.transform_experiment(msstats)
+                self.add_feature_msg(msstats)
+                self.convert_to_parquet_format(msstats)
+                yield msstats
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+            Msstats.destroy_duckdb_database()
+
+    @staticmethod
+    def merge_msstats_and_psm(msstats, psm_table):
+        """
+        Add the attributes of the best psm of every (reference_file_name, peptidoform, precursor_charge) with one
+        hash join, rows without psm get nulls.
+        :param msstats: msstats dataframe
+        :param psm_table: best psms, see extract_psm_msg
+        :return: msstats dataframe with the psm columns
+        """
+        return join_table_columns(msstats, psm_table, PSM_KEYS, PSM_FEATURES)
+
+    def generate_feature(
+        self, file_num=10, protein_filter=None, duckdb_max_memory="16GB", duckdb_threads=4, duckdb_mode=False
+    ):
+        for msstats in self.iter_feature_reports(
+            file_num, protein_filter, duckdb_max_memory, duckdb_threads, duckdb_mode
+        ):
             feature = self.transform_feature(msstats)
             yield feature
 
-    def generate_feature_report(self, file_num=10, protein_str=None, duckdb_max_memory="16GB", duckdb_threads=4):
-        map_dict, pep_dict = self.extract_psm_msg(2000000, protein_str)
-        for msstats in self.transform_msstats_in(file_num, protein_str, duckdb_max_memory, duckdb_threads):
-            self.merge_msstats_and_psm(msstats, map_dict)
-            self.add_additional_msg(msstats, pep_dict)
+    def iter_feature_reports(
+        self, file_num=10, protein_filter=None, duckdb_max_memory="16GB", duckdb_threads=4, duckdb_mode=False
+    ):
+        if duckdb_mode:
+            return self.generate_feature_report_duckdb(file_num, protein_filter, duckdb_max_memory, duckdb_threads)
+        return self.generate_feature_report(file_num, protein_filter, duckdb_max_memory, duckdb_threads)
+
+    def generate_feature_report(self, file_num=10, protein_filter=None, duckdb_max_memory="16GB", duckdb_threads=4):
+        psm_table, pep_table = self.extract_psm_msg(2000000, protein_filter)
+        for msstats in self.transform_msstats_in(file_num, protein_filter, duckdb_max_memory, duckdb_threads):
+            msstats = self.merge_msstats_and_psm(msstats, psm_table)
+            msstats = self.add_additional_msg(msstats, pep_table)
             self.convert_to_parquet_format(msstats)
             yield msstats
 
@@ -100,24 +284,37 @@ class Feature(MzTab):
             yield key, df
 
     def generate_slice_feature(
-        self, partitions, file_num=10, protein_str=None, duckdb_max_memory="16GB", duckdb_threads=4
+        self,
+        partitions,
+        file_num=10,
+        protein_filter=None,
+        duckdb_max_memory="16GB",
+        duckdb_threads=4,
+        duckdb_mode=False,
     ):
-        for msstats in self.generate_feature_report(file_num, protein_str, duckdb_max_memory, duckdb_threads):
+        for msstats in self.iter_feature_reports(
+            file_num, protein_filter, duckdb_max_memory, duckdb_threads, duckdb_mode
+        ):
             for key, df in self.slice(msstats, partitions):
                 feature = self.transform_feature(df)
                 yield key, feature
 
     @staticmethod
     def transform_feature(df):
-        return pa.Table.from_pandas(df, schema=FEATURE_SCHEMA)
+        return dataframe_to_table(df, schema=FEATURE_SCHEMA)
 
     def write_feature_to_file(
-        self, output_path, file_num=10, protein_file=None, duckdb_max_memory="16GB", duckdb_threads=4
+        self,
+        output_path,
+        file_num=10,
+        protein_file=None,
+        duckdb_max_memory="16GB",
+        duckdb_threads=4,
+        duckdb_mode=False,
     ):
-        protein_list = extract_protein_list(protein_file) if protein_file else None
-        protein_str = "|".join(protein_list) if protein_list else None
+        protein_filter = ProteinFilter.from_file(protein_file)
         pqwriter = None
-        for feature in self.generate_feature(file_num, protein_str, duckdb_max_memory, duckdb_threads):
+        for feature in self.generate_feature(file_num, protein_filter, duckdb_max_memory, duckdb_threads, duckdb_mode):
             if not pqwriter:
                 pqwriter = pq.ParquetWriter(output_path, feature.schema)
             pqwriter.write_table(feature)
@@ -132,36 +329,26 @@ class Feature(MzTab):
         protein_file=None,
         duckdb_max_memory="16GB",
         duckdb_threads=4,
+        duckdb_mode=False,
     ):
-        pqwriters = {}
-        protein_list = extract_protein_list(protein_file) if protein_file else None
-        protein_str = "|".join(protein_list) if protein_list else None
+        pqwriters = ParquetPartitionWriter(output_folder, filename, partitions)
+        protein_filter = ProteinFilter.from_file(protein_file)
         for key, feature in self.generate_slice_feature(
-            partitions, file_num, protein_str, duckdb_max_memory, duckdb_threads
+            partitions, file_num, protein_filter, duckdb_max_memory, duckdb_threads, duckdb_mode
         ):
-            pqwriters = save_slice_file(feature, pqwriters, output_folder, key, filename)
+            pqwriters.write_table(key, feature)
         close_file(pqwriters)
 
-    def generate_best_scan(self, rows, pep_dict):
-        key = (rows["peptidoform"], rows["precursor_charge"])
-        if key in pep_dict:
-            return [pep_dict[key][1], pep_dict[key][2]]
-        else:
-            return [None, None]
-
-    def add_additional_msg(self, msstats, pep_dict):
-        select_mods = list(self._mods_map.keys())
+    def add_additional_msg(self, msstats, pep_table):
         msstats.loc[:, "pg_global_qvalue"] = msstats["mp_accessions"].map(self._protein_global_qvalue_map)
-        msstats[["scan_reference_file_name", "scan"]] = msstats[["peptidoform", "precursor_charge"]].apply(
-            lambda rows: self.generate_best_scan(rows, pep_dict), axis=1, result_type="expand"
-        )
-        msstats[["peptidoform", "modifications"]] = msstats[["peptidoform"]].apply(
-            lambda row: self.generate_modifications_details(
-                row["peptidoform"], self._mods_map, self._automaton, select_mods
-            ),
-            axis=1,
-            result_type="expand",
+        msstats = join_table_columns(
+            msstats, pep_table, ["peptidoform", "precursor_charge"], ["scan_reference_file_name", "scan"]
         )
+        self.add_feature_msg(msstats)
+        return msstats
+
+    def add_feature_msg(self, msstats):
+        self._modification_parser.transform(msstats)
         msstats["mp_accessions"] = msstats["mp_accessions"].apply(get_protein_accession)
         msstats.loc[:, "additional_intensities"] = None
         msstats.loc[:, "predicted_rt"] = None
@@ -9,15 +9,17 @@ import pyarrow.parquet as pq
 from typing import List
 from pathlib import Path
 from pyopenms import ModificationsDB
-from pyopenms import AASequence
-from quantmsio.core.sdrf import SDRFHandler
+from quantmsio.core.sdrf import SDRFHandler, map_sample_accessions
 from quantmsio.operate.tools import get_ahocorasick, get_modification_details, get_protein_accession
-from pyopenms.Constants import PROTON_MASS_U
 from quantmsio.utils.constants import ITRAQ_CHANNEL, TMT_CHANNELS
 from quantmsio.core.common import MAXQUANT_PSM_MAP, MAXQUANT_PSM_USECOLS, MAXQUANT_FEATURE_MAP, MAXQUANT_FEATURE_USECOLS
+from quantmsio.core.common import PSM_SCHEMA, FEATURE_SCHEMA
 from quantmsio.core.feature import Feature
 from quantmsio.core.psm import Psm
-from quantmsio.utils.file_utils import close_file, extract_protein_list, save_slice_file
+from quantmsio.utils.file_utils import close_file, ParquetPartitionWriter
+from quantmsio.utils.protein_filter import ProteinFilter
+from quantmsio.utils.arrow_utils import struct_list_array, to_pandas_column
+from quantmsio.utils.mass_utils import get_peptidoform_masses
 
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
@@ -71,7 +73,9 @@ class MaxQuant:
                 use_cols.append(col)
         return use_map, use_cols
 
-    def iter_batch(self, file_path: str, label: str = "feature", chunksize: int = 100000, protein_str: str = None):
+    def iter_batch(
+        self, file_path: str, label: str = "feature", chunksize: int = 100000, protein_filter: ProteinFilter = None
+    ):
         col_df = pd.read_csv(file_path, sep="\t", nrows=0)
         use_map, use_cols =  self.extract_col_msg(col_df, label=label)
         for df in pd.read_csv(
@@ -82,8 +86,8 @@ class MaxQuant:
             chunksize=chunksize,
         ):
             df.rename(columns=use_map, inplace=True)
-            if protein_str:
-                df = df[df["mp_accessions"].str.contains(f"{protein_str}", na=False)]
+            if protein_filter:
+                df = protein_filter.filter(df, "mp_accessions")
             df = self.main_operate(df)
             yield df
 
@@ -99,7 +103,7 @@ class MaxQuant:
         df = self.open_from_zip_archive(zip_path, f"{filepath.stem}/evidence.txt", **kwargs)
         return df
 
-    def iter_zip_batch(self, zip_list: List[str], label: str = "feature", protein_str: str = None):
+    def iter_zip_batch(self, zip_list: List[str], label: str = "feature", protein_filter: ProteinFilter = None):
         for zip_file in zip_list:
             col_df = self.read_zip_file(zip_file, nrows=0)
             use_map, use_cols =  self.extract_col_msg(col_df, label=label)
@@ -109,18 +113,15 @@ class MaxQuant:
             )
             df.rename(columns=use_map, inplace=True)
             #df["reference_file_name"] = zip_file.split(".")[0]
-            if protein_str:
-                df = df[df["mp_accessions"].str.contains(f"{protein_str}", na=False)]
+            if protein_filter:
+                df = protein_filter.filter(df, "mp_accessions")
             df = self.main_operate(df)
             yield df
 
     def generete_calculated_mz(self, df):
-        uniq_p = df["peptidoform"].unique()
-        masses_map = {k: AASequence.fromString(k).getMonoWeight() for k in uniq_p}
-        mass_vector = df["peptidoform"].map(masses_map)
-        df.loc[:, "calculated_mz"] = (mass_vector + (PROTON_MASS_U * df["precursor_charge"].values)) / df[
-            "precursor_charge"
-        ].values
+        df.loc[:, "calculated_mz"] = get_peptidoform_masses().calculated_mz(
+            df["peptidoform"], df["precursor_charge"].values
+        )
 
     def _transform_mod(self, match):
         if not match:
@@ -207,40 +208,12 @@ class MaxQuant:
         df["peptidoform"] = df["peptidoform"].apply(trasform_peptidoform)
 
     def generate_intensity_msg(self, df, intensity_cols, additions_intensity_cols):
-        def get_intensities_map(rows):
-            result_intensity = []
-            result_additions_intensity = []
-            reference = rows["reference_file_name"]
-            for col in intensity_cols:
-                channel = channel_map[col]
-                sample_key = reference + "-" + channel
-                result_intensity.append(
-                    {
-                        "sample_accession": self._sample_map[sample_key],
-                        "channel": channel,
-                        "intensity": rows[col],
-                    }
-                )
-            for col in additions_intensity_cols:
-                channel = channel_map[col]
-                sample_key = reference + "-" + channel
-                result_additions_intensity.append(
-                    {
-                        "sample_accession": self._sample_map[sample_key],
-                        "channel": channel,
-                        "additional_intensity": [
-                            {"intensity_name": "normalize_intensity", "intensity_value": rows[col]}
-                        ],
-                    }
-                )
-            if len(result_intensity) > 1 and len(result_additions_intensity) > 1:
-                return result_intensity, result_additions_intensity
-            elif len(result_intensity) > 1:
-                return result_intensity, None
-            elif len(result_additions_intensity) > 1:
-                return None, result_additions_intensity
-            else:
-                return None, None
+        intensities_type = FEATURE_SCHEMA.field("intensities").type
+        additional_intensities_type = FEATURE_SCHEMA.field("additional_intensities").type
+        additional_intensity_type = additional_intensities_type.value_type.field("additional_intensity").type
+
+        def get_sample_accessions(channel):
+            return map_sample_accessions(df["reference_file_name"] + "-" + channel, self._sample_map)
 
         channel_map = {}
         if self.experiment_type != "LFQ":
@@ -255,20 +228,47 @@ class MaxQuant:
                     c = ITRAQ_CHANNEL[self.experiment_type][int(key)]
                     channel_map[col] = c
                     channel_map[col1] = c
-            df[["intensities", "additional_intensities"]] = df[
-                ["reference_file_name"] + intensity_cols + additions_intensity_cols
-            ].apply(get_intensities_map, axis=1, result_type="expand")
+            df.loc[:, "intensities"] = None
+            df.loc[:, "additional_intensities"] = None
+            if len(intensity_cols) > 1:
+                intensities = struct_list_array(
+                    [
+                        {
+                            "sample_accession": get_sample_accessions(channel_map[col]),
+                            "channel": channel_map[col],
+                            "intensity": df[col],
+                        }
+                        for col in intensity_cols
+                    ],
+                    intensities_type,
+                    len(df),
+                )
+                df["intensities"] = to_pandas_column(intensities, df.index)
+            if len(additions_intensity_cols) > 1:
+                additional_intensities = struct_list_array(
+                    [
+                        {
+                            "sample_accession": get_sample_accessions(channel_map[col]),
+                            "channel": channel_map[col],
+                            "additional_intensity": struct_list_array(
+                                [{"intensity_name": "normalize_intensity", "intensity_value": df[col]}],
+                                additional_intensity_type,
+                                len(df),
+                            ),
+                        }
+                        for col in additions_intensity_cols
+                    ],
+                    additional_intensities_type,
+                    len(df),
+                )
+                df["additional_intensities"] = to_pandas_column(additional_intensities, df.index)
         else:
-            df.loc[:, "intensities"] = df[["reference_file_name", "Intensity"]].apply(
-                lambda rows: [
-                    {
-                        "sample_accession": self._sample_map[rows["reference_file_name"] + "-" + "LFQ"],
-                        "channel": "LFQ",
-                        "intensity": rows["Intensity"],
-                    }
-                ],
-                axis=1,
+            intensities = struct_list_array(
+                [{"sample_accession": get_sample_accessions("LFQ"), "channel": "LFQ", "intensity": df["Intensity"]}],
+                intensities_type,
+                len(df),
             )
+            df["intensities"] = to_pandas_column(intensities, df.index)
             df.loc[:, "additional_intensities"] = None
 
     def main_operate(self, df: pd.DataFrame):
@@ -277,16 +277,21 @@ class MaxQuant:
         self.generate_modification_details(df)
         df = df[df["posterior_error_probability"] < 0.05].copy()
         df["is_decoy"] = df["is_decoy"].map({None: "0", np.nan: "0", "+": "1"})
-        df["additional_scores"] = df[["andromeda_score", "andromeda_delta_score"]].apply(
-            lambda row: [
-                {"score_name": "andromeda_score", "score_value": row["andromeda_score"]},
-                {"score_name": "andromeda_delta_score", "score_value": row["andromeda_delta_score"]},
+        additional_scores = struct_list_array(
+            [
+                {"score_name": "andromeda_score", "score_value": df["andromeda_score"]},
+                {"score_name": "andromeda_delta_score", "score_value": df["andromeda_delta_score"]},
             ],
-            axis=1,
+            PSM_SCHEMA.field("additional_scores").type,
+            len(df),
         )
-        df.loc[:, "cv_params"] = df["parent_ion_fraction"].apply(
-            lambda socre: [{"cv_name": "parent_ion_fraction", "cv_value": str(socre)}]
+        df["additional_scores"] = to_pandas_column(additional_scores, df.index)
+        cv_params = struct_list_array(
+            [{"cv_name": "parent_ion_fraction", "cv_value": df["parent_ion_fraction"].astype(str)}],
+            PSM_SCHEMA.field("cv_params").type,
+            len(df),
         )
+        df["cv_params"] = to_pandas_column(cv_params, df.index)
         df.loc[:, "predicted_rt"] = None
         df.loc[:, "ion_mobility"] = None
         return df
@@ -336,7 +341,8 @@ class MaxQuant:
     ):
         self._init_sdrf(sdrf_path)
         pqwriter = None
-        for df in self.iter_batch(evidence_path, chunksize=chunksize, protein_str=protein_file):
+        protein_filter = ProteinFilter.from_file(protein_file)
+        for df in self.iter_batch(evidence_path, chunksize=chunksize, protein_filter=protein_filter):
             self.transform_feature(df)
             Feature.convert_to_parquet_format(df)
             parquet = Feature.transform_feature(df)
@@ -354,7 +360,8 @@ class MaxQuant:
     ):
         self._init_sdrf(sdrf_path)
         pqwriter = None
-        for df in self.iter_zip_batch(zip_list, "feature", protein_str=protein_file):
+        protein_filter = ProteinFilter.from_file(protein_file)
+        for df in self.iter_zip_batch(zip_list, "feature", protein_filter=protein_filter):
             self.transform_feature(df)
             Feature.convert_to_parquet_format(df)
             parquet = Feature.transform_feature(df)
@@ -373,14 +380,13 @@ class MaxQuant:
         chunksize: int = 1000000,
         protein_file=None,
     ):
-        pqwriters = {}
-        protein_list = extract_protein_list(protein_file) if protein_file else None
-        protein_str = "|".join(protein_list) if protein_list else None
+        pqwriters = ParquetPartitionWriter(output_folder, filename, partitions)
+        protein_filter = ProteinFilter.from_file(protein_file)
         self._init_sdrf(sdrf_path)
-        for report in self.iter_batch(evidence_path, chunksize=chunksize, protein_str=protein_str):
+        for report in self.iter_batch(evidence_path, chunksize=chunksize, protein_filter=protein_filter):
             self.transform_feature(report)
             Feature.convert_to_parquet_format(report)
             for key, df in Feature.slice(report, partitions):
                 feature = Feature.transform_feature(df)
-                pqwriters = save_slice_file(feature, pqwriters, output_folder, key, filename)
+                pqwriters.write_table(key, feature)
         close_file(pqwriters=pqwriters)
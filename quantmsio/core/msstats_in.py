@@ -1,31 +1,47 @@
-from quantmsio.core.duckdb import DuckDB
-from quantmsio.core.sdrf import SDRFHandler
-from quantmsio.core.common import MSSTATS_USECOLS, MSSTATS_MAP
+from quantmsio.core.duckdb import DuckDB, sql_literal
+from quantmsio.core.sdrf import SDRFHandler, map_sample_accessions
+from quantmsio.core.common import MSSTATS_USECOLS, MSSTATS_MAP, FEATURE_SCHEMA
 from quantmsio.utils.constants import ITRAQ_CHANNEL, TMT_CHANNELS
 from quantmsio.utils.pride_utils import clean_peptidoform_sequence
 from quantmsio.operate.tools import get_protein_accession
+from quantmsio.utils.arrow_utils import grouped_struct_list_array, struct_list_array, to_pandas_column
 
 
 class MsstatsIN(DuckDB):
-    def __init__(self, report_path, sdrf_path, duckdb_max_memory="16GB", duckdb_threads=4):
-        super(MsstatsIN, self).__init__(report_path, duckdb_max_memory, duckdb_threads)
+    # batches of runs are read with an equality predicate on run_key, the report is sorted by it so DuckDB skips
+    # the row groups of the other runs
+    REPORT_ORDER = "run_key"
+
+    def __init__(self, report_path, sdrf_path, duckdb_max_memory="16GB", duckdb_threads=4, **duckdb_options):
+        """
+        :param duckdb_options: cache_dir, cache_size and direct_view options of DuckDB
+        """
+        super(MsstatsIN, self).__init__(report_path, duckdb_max_memory, duckdb_threads, **duckdb_options)
         self._sdrf = SDRFHandler(sdrf_path)
         self.experiment_type = self._sdrf.get_experiment_type_from_sdrf()
         self._sample_map = self._sdrf.get_sample_map_run()
 
+    def get_report_sql(self) -> str:
+        """
+        The run of every row (Reference without extension) is added as run_key.
+        """
+        return "SELECT *, split_part(\"Reference\", '.', 1) AS run_key FROM ({})".format(super().get_report_sql())
+
     def get_runs(self):
-        references = self._duckdb.sql(f"SELECT Reference FROM report").df()
-        references = references["Reference"].str.split(".").str[0]
-        return list(set(references))
+        runs = self._duckdb.execute("SELECT DISTINCT run_key FROM report ORDER BY run_key").fetchall()
+        return [run for run, in runs]
 
     def iter_runs(self, file_num=10, columns: list = None):
         references = self.get_runs()
         ref_list = [references[i : i + file_num] for i in range(0, len(references), file_num)]
         for refs in ref_list:
-            batch_df = self.query_field("Reference", refs, columns)
+            batch_df = self.query_field("run_key", refs, columns)
             yield batch_df
 
-    def generate_msstats_in(self, file_num=10, protein_str=None):
+    def get_msstats_columns(self):
+        """
+        :return: the report columns to read and their names in the features
+        """
         msstats_map = MSSTATS_MAP.copy()
         usecols = list(MSSTATS_USECOLS)
         if self.experiment_type == "LFQ":
@@ -36,12 +52,40 @@ class MsstatsIN(DuckDB):
         else:
             usecols += ["Charge"]
             msstats_map["Charge"] = "precursor_charge"
+        return usecols, msstats_map
+
+    def get_msstats_sql(self, runs: list, protein_filter=None):
+        """
+        Query of the report rows of some runs, with the columns renamed as in generate_msstats_in. The row number
+        of the rows in the scan (msstats_row) keeps their order in the report.
+        :param runs: reference file names without extension
+        :param protein_filter: ProteinFilter on the ProteinName column
+        :return: SQL query
+        """
+        usecols, msstats_map = self.get_msstats_columns()
+        columns = ["row_number() OVER () AS msstats_row"]
+        for col in usecols:
+            if col == "Reference":
+                columns.append(f"run_key AS {msstats_map[col]}")
+            elif msstats_map[col] == "precursor_charge":
+                columns.append(f'CAST("{col}" AS BIGINT) AS {msstats_map[col]}')
+            else:
+                columns.append(f'"{col}" AS {msstats_map[col]}')
+        if self.experiment_type == "LFQ":
+            columns += ["'LFQ' AS channel", "CAST(NULL AS DOUBLE) AS rt"]
+        where = "run_key IN ({})".format(", ".join(sql_literal(run) for run in runs))
+        if protein_filter:
+            where += f" AND {protein_filter.sql_predicate('ProteinName')}"
+        return f"SELECT {', '.join(columns)} FROM report WHERE {where}"
+
+    def generate_msstats_in(self, file_num=10, protein_filter=None):
+        usecols, msstats_map = self.get_msstats_columns()
         for msstats in self.iter_runs(file_num=file_num, columns=usecols):
             if self.experiment_type == "LFQ":
                 msstats.loc[:, "Channel"] = "LFQ"
                 msstats.loc[:, "RetentionTime"] = None
-            if protein_str:
-                msstats = msstats[msstats["ProteinName"].str.contains(f"{protein_str}", na=False)]
+            if protein_filter:
+                msstats = protein_filter.filter(msstats, "ProteinName")
             msstats.rename(columns=msstats_map, inplace=True)
             self.transform_msstats_in(msstats)
             self.transform_experiment(msstats)
@@ -60,39 +104,37 @@ class MsstatsIN(DuckDB):
         msstats.loc[:, "anchor_protein"] = msstats["pg_accessions"].str[0]
 
     def transform_experiment(self, msstats):
-        intensities_map = {}
-        select_cols = ["map", "reference_file_name", "peptidoform", "precursor_charge", "channel", "intensity"]
+        intensities_type = FEATURE_SCHEMA.field("intensities").type
+        sample_accessions = map_sample_accessions(
+            msstats["reference_file_name"] + "-" + msstats["channel"], self._sample_map
+        )
         if self.experiment_type != "LFQ":
-            msstats.loc[:, "map"] = (
-                msstats["reference_file_name"] + msstats["peptidoform"] + msstats["precursor_charge"].astype(str)
+            # one feature per (reference_file_name, peptidoform, precursor_charge), with the intensities of all
+            # its channels in the order of the rows
+            keys = ["reference_file_name", "peptidoform", "precursor_charge"]
+            groups = msstats.groupby(keys, sort=False, dropna=False).ngroup().to_numpy()
+            intensities = grouped_struct_list_array(
+                {
+                    "sample_accession": sample_accessions,
+                    "channel": msstats["channel"],
+                    "intensity": msstats["intensity"],
+                },
+                intensities_type,
+                groups,
+                groups.max() + 1 if len(groups) else 0,
             )
-
-            def get_intensities_map(rows):
-                key = rows["map"]
-                sample_key = rows["reference_file_name"] + "-" + rows["channel"]
-                if key not in intensities_map:
-                    intensities_map[key] = []
-                intensities_map[key].append(
-                    {
-                        "sample_accession": self._sample_map[sample_key],
-                        "channel": rows["channel"],
-                        "intensity": rows["intensity"],
-                    }
-                )
-
-            msstats[select_cols].apply(get_intensities_map, axis=1)
-            msstats.drop_duplicates(subset=["reference_file_name", "peptidoform", "precursor_charge"], inplace=True)
+            msstats.drop_duplicates(subset=keys, inplace=True)
             msstats.reset_index(inplace=True, drop=True)
-            msstats.loc[:, "intensities"] = msstats["map"].map(intensities_map)
-            msstats.drop(["map"], inplace=True, axis=1)
         else:
-            msstats.loc[:, "intensities"] = msstats[["reference_file_name", "channel", "intensity"]].apply(
-                lambda rows: [
+            intensities = struct_list_array(
+                [
                     {
-                        "sample_accession": self._sample_map[rows["reference_file_name"] + "-" + rows["channel"]],
-                        "channel": rows["channel"],
-                        "intensity": rows["intensity"],
+                        "sample_accession": sample_accessions,
+                        "channel": msstats["channel"],
+                        "intensity": msstats["intensity"],
                     }
                 ],
-                axis=1,
+                intensities_type,
+                len(msstats),
             )
+        msstats["intensities"] = to_pandas_column(intensities, msstats.index)
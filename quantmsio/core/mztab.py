@@ -1,7 +1,14 @@
-import codecs
 import os
 import pandas as pd
-from quantmsio.utils.pride_utils import get_quantmsio_modifications
+import pyarrow as pa
+import pyarrow.csv as csv
+from quantmsio.core.common import MZTAB_NULL_VALUES, MZTAB_INT_COLUMNS, MZTAB_FLOAT_COLUMNS
+from quantmsio.core.mztab_index import MzTabIndex
+from quantmsio.utils.pride_utils import (
+    get_quantmsio_modifications,
+    fetch_modifications_from_mztab_line,
+    fetch_ms_runs_from_mztab_line,
+)
 from quantmsio.operate.tools import get_modification_details
 
 
@@ -20,197 +27,245 @@ def generate_modification_list(modification_str: str, modifications):
     return modification_list
 
 
-def fetch_modifications_from_mztab_line(line: str, _modifications: dict) -> dict:
+MZTAB_BLOCK_SIZE = 16 * 1024 * 1024
+
+# metadata parsed in this process, keyed by (path, size, mtime) of the mzTab file
+_METADATA_CACHE = {}
+
+
+def parse_score_name_from_mztab_line(line_parts: list) -> str:
+    """
+    get the search engine name from a psm_search_engine_score line, e.g.
+      MTD	psm_search_engine_score[1]	[MS, MS:1003115, OpenMS:Target-decoy PSM q-value, ]
+    returns OpenMS.
+    :param line_parts: mztab line split by tabs
+    :return: score name
+    """
+    score_values = line_parts[2].replace("[", "").replace("]", "").split(",")
+    score_name = score_values[2].strip()
+    if ":" in score_name:
+        score_name = score_name.split(":")[0]
+    return score_name
+
+
+def get_mztab_column_type(column: str) -> pa.DataType:
+    """
+    Arrow type used to read a mzTab column. Columns that are not known to be numeric are read as strings, so
+    the type never depends on the rows of the first block.
+    :param column: column name
+    :return: arrow data type
+    """
+    if column in MZTAB_INT_COLUMNS:
+        return pa.int64()
+    if column in MZTAB_FLOAT_COLUMNS or "search_engine_score[" in column:
+        return pa.float64()
+    return pa.string()
+
+
+class MzTabMetadata:
+    """
+    Metadata of a mzTab file parsed once from the MTD section: ms_runs, psm score names, modifications
+    definition and modifications map. The object only holds plain python structures, so it can be pickled
+    and shipped to worker processes.
+    """
+
+    def __init__(self, mztab_path: str, ms_runs: dict, score_names: dict, modifications: dict, mods_map: dict):
+        self.mztab_path = mztab_path
+        self.ms_runs = ms_runs
+        self.score_names = score_names
+        self.modifications = modifications
+        self.mods_map = mods_map
+        # protein score map, only loaded from the PRT section when it is needed
+        self._protein_map = None
+
+    @classmethod
+    def from_lines(cls, mztab_path: str, lines: list):
+        ms_runs = {}
+        score_names = {}
+        modifications = {}
+        mods_map = {}
+        for i, line in enumerate(lines):
+            line_parts = line.split("\t")
+            if len(line_parts) < 3 or line_parts[0] != "MTD":
+                continue
+            if line_parts[1].split("-")[-1] == "location":
+                ms_runs = fetch_ms_runs_from_mztab_line(line, ms_runs)
+            elif "psm_search_engine_score" in line_parts[1]:
+                score_names[parse_score_name_from_mztab_line(line_parts)] = line_parts[1].replace("psm_", "")
+            elif "_mod[" in line_parts[1]:
+                modifications = fetch_modifications_from_mztab_line(line, modifications)
+                if "site" not in line_parts[1] and "position" not in line_parts[1]:
+                    values = line_parts[2].replace("[", "").replace("]", "").split(",")
+                    accession = values[1].strip().upper()
+                    name = values[2].strip()
+                    site = lines[i + 1].rstrip("\r\n").split("\t")[2] if i + 1 < len(lines) else None
+                    mods_map[name] = [accession, site]
+                    mods_map[accession] = [name, site]
+        return cls(mztab_path, ms_runs, score_names, modifications, mods_map)
+
+    def get_protein_map(self):
+        """
+        return: a dict about protein score, loaded from the PRT section on first use
+        """
+        if self._protein_map is None:
+            self._protein_map = MzTab(self.mztab_path)._load_protein_map()
+        return self._protein_map
+
+
+def get_mztab_metadata(mztab_path: str, index: MzTabIndex = None) -> MzTabMetadata:
+    """
+    Parse the MTD section of a mzTab file, the result is memoized per file inside the process.
+    :param mztab_path: mzTab file path
+    :param index: section index of the mzTab file
+    :return: MzTabMetadata
     """
-    get the modifications from a mztab line. An mzTab modification could be a fixed or variable modification.
-    The structure of a fixed is the following:
-      MTD	fixed_mod[1]	[UNIMOD, UNIMOD:4, Carbamidomethyl, ]
-      MTD	fixed_mod[1]-site	C
-      MTD	fixed_mod[1]-position	Anywhere
-    while the structure of a variable modification is the following:
-      MTD	var_mod[1]	[UNIMOD, UNIMOD:21, Phospho, ]
-      MTD	var_mod[1]-site	S
-      MTD   var_mod[1]-position	Anywhere
-
-    :param line: mztab line
-    :param _modifications: modifications dictionary
-    :return: modification dictionary
+    index = index if index is not None else MzTabIndex.open(mztab_path)
+    key = (os.path.abspath(mztab_path), index.file_size, index.file_mtime)
+    if key not in _METADATA_CACHE:
+        section = index.get_section("MTD")
+        with index.open_stream(section["pos"], section["end_pos"]) as f:
+            content = f.read().decode("utf-8")
+        _METADATA_CACHE[key] = MzTabMetadata.from_lines(mztab_path, content.splitlines())
+    return _METADATA_CACHE[key]
+
+
+def set_mztab_metadata(metadata: MzTabMetadata, index: MzTabIndex):
     """
-    line = line.strip()
-    line_parts = line.split("\t")
-    if line_parts[0] == "MTD" and "_mod[" in line_parts[1]:
-        if "site" not in line_parts[1] and "position" not in line_parts[1]:
-            values = line_parts[2].replace("[", "").replace("]", "").split(",")
-            accession = values[1].strip()
-            name = values[2].strip()
-            index = line_parts[1].split("[")[1].split("]")[0]
-            _modifications[accession] = [name, index, None, None]
-        elif "site" in line_parts[1]:
-            index = line_parts[1].split("[")[1].split("]")[0]
-            accession = None
-            for (
-                key,
-                value,
-            ) in _modifications.items():  # for name, age in dictionary.iteritems():  (for Python 2.x)
-                if value[1] == index:
-                    accession = key
-            if accession is None:
-                raise Exception("The accession for the modification is None")
-            _modifications[accession][2] = line_parts[2]
-        elif "position" in line_parts[1]:
-            index = line_parts[1].split("[")[1].split("]")[0]
-            accession = None
-            for key, value in _modifications.items():
-                if value[1] == index:
-                    accession = key
-            if accession is None:
-                raise Exception("The accession for the modification is None")
-            _modifications[accession][3] = line_parts[2]
-    return _modifications
+    Register metadata parsed in another process, e.g. in the initializer of a worker pool.
+    """
+    key = (os.path.abspath(metadata.mztab_path), index.file_size, index.file_mtime)
+    _METADATA_CACHE[key] = metadata
 
 
 class MzTab:
-    def __init__(self, mzTab_path: str) -> None:
+    def __init__(self, mzTab_path: str, index: MzTabIndex = None) -> None:
         self.mztab_path = mzTab_path
-        # psm pos
-        self._psm_pos = None
-        # psm len
-        self._psm_len = None
-        self._psm_end_pos = None
-        # pep pos
-        self._pep_pos = None
-        # pep len
-        self._pep_len = None
-        self._pep_end_pos = None
-        # prt pos
-        self._prt_pos = None
-        # prt len
-        self._prt_len = None
-        self._prt_end_pos = None
-        # load psms columns
-        self._psms_columns = None
-        # load pep columns
-        self._pep_columns = None
-
-    def _get_pos(self, header):
-        if header == "PSH" and self._pep_pos is not None:
-            return self._pep_end_pos
-        elif header == "PEH" and self._prt_pos is not None:
-            return self._prt_end_pos
-        else:
-            return 0
-
-    def __extract_len(self, header):
-        map_tag = {"PSH": "PSM", "PEH": "PEP", "PRH": "PRT"}
-        if os.stat(self.mztab_path).st_size == 0:
-            raise ValueError("File is empty")
-        f = open(self.mztab_path)
-        pos = self._get_pos(header)
-        f.seek(pos)
-        line = f.readline()
-        while not line.startswith(header):
-            pos = f.tell()
-            line = f.readline()
-
-        if header == "PSH":
-            self._psms_columns = line.split("\n")[0].split("\t")
-        if header == "PEH":
-            self._pep_columns = line.split("\n")[0].split("\t")
-
-        line = f.readline()
-        fle_len = 0
-        while line.startswith(map_tag[header]):
-            fle_len += 1
-            line = f.readline()
-        end_pos = f.tell()
-        f.close()
-        return fle_len, pos, end_pos
-
-    def __load_second(self, header, **kwargs):
-        f = open(self.mztab_path)
-        if header == "PSH":
-            f.seek(self._psm_pos)
-            return pd.read_csv(f, sep="\t", nrows=self._psm_len, low_memory=False, **kwargs)
-        elif header == "PEH":
-            f.seek(self._pep_pos)
-            return pd.read_csv(f, sep="\t", nrows=self._pep_len, low_memory=False, **kwargs)
-        else:
-            f.seek(self._prt_pos)
-            return pd.read_csv(f, sep="\t", nrows=self._prt_len, low_memory=False, **kwargs)
-
-    def __set_table_config(self, header, length, pos, end_pos):
-        if header == "PSH":
-            self._psm_pos = pos
-            self._psm_len = length
-            self._psm_end_pos = end_pos
-        elif header == "PEH":
-            self._pep_pos = pos
-            self._pep_len = length
-            self._pep_end_pos = end_pos
-        else:
-            self._prt_pos = pos
-            self._prt_len = length
-            self._prt_end_pos = end_pos
+        # section index (positions, lengths and columns of MTD/PRT/PEP/PSM), loaded on first use
+        self._index = index
+        self._metadata = None
+
+    @property
+    def index(self) -> MzTabIndex:
+        if self._index is None:
+            self._index = MzTabIndex.open(self.mztab_path)
+        return self._index
+
+    @property
+    def metadata(self) -> MzTabMetadata:
+        if self._metadata is None:
+            self._metadata = get_mztab_metadata(self.mztab_path, self.index)
+        return self._metadata
 
     def skip_and_load_csv(self, header, **kwargs):
-        if self._psm_pos is not None and header == "PSH":
-            return self.__load_second(header, **kwargs)
-        if self._pep_pos is not None and header == "PEH":
-            return self.__load_second(header, **kwargs)
-        if self._prt_pos is not None and header == "PRH":
-            return self.__load_second(header, **kwargs)
-        fle_len, pos, end_pos = self.__extract_len(header)
-        if os.stat(self.mztab_path).st_size == 0:
-            raise ValueError("File is empty")
-        f = open(self.mztab_path)
-        f.seek(pos)
-        self.__set_table_config(header, fle_len, pos, end_pos)
-        return pd.read_csv(f, nrows=fle_len, sep="\t", low_memory=False, **kwargs)
+        section = self.index.get_section(header)
+        f = self.index.open_stream(section["pos"], section["end_pos"])
+        return pd.read_csv(f, sep="\t", nrows=section["rows"], low_memory=False, **kwargs)
+
+    def get_section_shards(self, header, shards):
+        """
+        Split the rows of a section into byte ranges of similar size, aligned to the start of the lines.
+        :param header: section header tag
+        :param shards: number of shards
+        :return: list of (start, end) byte ranges
+        """
+        section = self.index.get_section(header)
+        start, end = section["data_pos"], section["end_pos"]
+        if not self.index.random_access:
+            # plain gzip can not be split, every shard would decompress the file from the start
+            return [(start, end)]
+        bounds = [start]
+        for i in range(1, shards):
+            target = start + (end - start) * i // shards
+            with self.index.open_stream(target, end) as f:
+                pos = target + len(f.readline())
+            if pos > bounds[-1]:
+                bounds.append(pos)
+        if end > bounds[-1]:
+            bounds.append(end)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def iter_section_batches(
+        self, header, columns=None, column_types=None, block_size=MZTAB_BLOCK_SIZE, byte_range=None
+    ):
+        """
+        Stream a section (PRH, PEH or PSH) as arrow record batches. The reader starts at the first row of the
+        section and stops at its last row, only the requested columns are parsed.
+        :param header: section header tag
+        :param columns: columns to read, columns not present in the section are ignored
+        :param column_types: arrow types of the columns, by default taken from get_mztab_column_type
+        :param block_size: bytes parsed per batch
+        :param byte_range: only read the rows in this (start, end) range, see get_section_shards
+        :return: generator of pyarrow.RecordBatch
+        """
+        section = self.index.get_section(header)
+        start, end = byte_range if byte_range else (section["data_pos"], section["end_pos"])
+        if section["rows"] == 0 or end <= start:
+            return
+        names = section["columns"]
+        columns = [col for col in columns if col in names] if columns is not None else names
+        types = {col: get_mztab_column_type(col) for col in columns}
+        if column_types:
+            types.update({col: value for col, value in column_types.items() if col in types})
+        read_options = csv.ReadOptions(column_names=names, block_size=block_size)
+        parse_options = csv.ParseOptions(delimiter="\t")
+        convert_options = csv.ConvertOptions(
+            include_columns=columns,
+            column_types=types,
+            null_values=MZTAB_NULL_VALUES,
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=True,
+        )
+        if self.index.compression is None:
+            f = pa.OSFile(self.mztab_path)
+            stream = f.get_stream(start, end - start)
+        else:
+            f = stream = self.index.open_stream(start, end)
+        with f:
+            reader = csv.open_csv(stream, read_options, parse_options, convert_options)
+            for batch in reader:
+                yield batch
+
+    def iter_section_tables(self, header, columns=None, column_types=None, chunksize=1000000, byte_range=None):
+        """
+        Group the record batches of a section into arrow tables of about chunksize rows.
+        """
+        batches = []
+        rows = 0
+        for batch in self.iter_section_batches(header, columns, column_types, byte_range=byte_range):
+            batches.append(batch)
+            rows += batch.num_rows
+            if rows >= chunksize:
+                yield pa.Table.from_batches(batches)
+                batches = []
+                rows = 0
+        if batches:
+            yield pa.Table.from_batches(batches)
 
     def extract_ms_runs(self):
-        if os.stat(self.mztab_path).st_size == 0:
-            raise ValueError("File is empty")
-        f = codecs.open(self.mztab_path, "r", "utf-8")
-        line = f.readline()
-        ms_runs = {}
-        while line.split("\t")[0] == "MTD":
-            if line.split("\t")[1].split("-")[-1] == "location":
-                ms_runs[line.split("\t")[1].split("-")[0]] = line.split("\t")[2].split("//")[-1].split(".")[0]
-            line = f.readline()
-        f.close()
-        return ms_runs
-
-    def get_protein_map(self, protein_str=None):
+        return dict(self.metadata.ms_runs)
+
+    def get_protein_map(self, protein_filter=None):
         """
+        :param protein_filter: ProteinFilter on the ambiguity members of the proteins
         return: a dict about protein score
         """
+        if not protein_filter:
+            return self.metadata.get_protein_map()
+        return self._load_protein_map(protein_filter)
+
+    def _load_protein_map(self, protein_filter=None):
         prt = self.skip_and_load_csv(
             "PRH",
             usecols=["ambiguity_members", "best_search_engine_score[1]"],
         )
-        if protein_str:
-            prt = prt[prt["ambiguity_members"].str.contains(f"{protein_str}", na=False)]
+        if protein_filter:
+            prt = protein_filter.filter(prt, "ambiguity_members")
         prt_score = prt.groupby("ambiguity_members").min()
         protein_map = prt_score.to_dict()["best_search_engine_score[1]"]
         return protein_map
 
     def get_score_names(self):
-        if os.stat(self.mztab_path).st_size == 0:
-            raise ValueError("File is empty")
-        f = codecs.open(self.mztab_path, "r", "utf-8")
-        line = f.readline()
-        score_names = {}
-        while line.split("\t")[0] == "MTD":
-            if "psm_search_engine_score" in line:
-                msgs = line.split("\t")
-                score_values = msgs[2].replace("[", "").replace("]", "").split(",")
-                score_name = score_values[2].strip()
-                if ":" in score_name:
-                    score_name = score_name.split(":")[0]
-                score_names[score_name] = msgs[1].replace("psm_", "")
-            line = f.readline()
-        f.close()
-        return score_names
+        return dict(self.metadata.score_names)
 
     def generate_positions(self, start, end) -> list:
         start = start.split(",")
@@ -218,38 +273,10 @@ class MzTab:
         return [start + ":" + end for start, end in zip(start, end)]
 
     def get_modifications(self):
-        if os.stat(self.mztab_path).st_size == 0:
-            raise ValueError("File is empty")
-        f = codecs.open(self.mztab_path, "r", "utf-8")
-        line = f.readline()
-        mod_dict = {}
-        while line.split("\t")[0] == "MTD":
-            if "_mod[" in line:
-                mod_dict = fetch_modifications_from_mztab_line(line, mod_dict)
-            line = f.readline()
-        f.close()
-        return mod_dict
+        return dict(self.metadata.modifications)
 
     def get_mods_map(self):
-        if os.stat(self.mztab_path).st_size == 0:
-            raise ValueError("File is empty")
-        f = codecs.open(self.mztab_path, "r", "utf-8")
-        line = f.readline()
-        mods_map = {}
-        while line.startswith("MTD"):
-            if "_mod[" in line:
-                line_parts = line.split("\t")
-                if "site" not in line_parts[1] and "position" not in line_parts[1]:
-                    values = line_parts[2].replace("[", "").replace("]", "").split(",")
-                    accession = values[1].strip()
-                    name = values[2].strip()
-                    line = f.readline()
-                    site = line.replace("\n", "").split("\t")[2]
-                    mods_map[name] = [accession.upper(), site]
-                    mods_map[accession.upper().upper()] = [name, site]
-            line = f.readline()
-        f.close()
-        return mods_map
+        return dict(self.metadata.mods_map)
 
     @staticmethod
     def generate_modifications_details(seq, mods_map, automaton, select_mods):
@@ -0,0 +1,310 @@
+"""
+Section index for mzTab files. A single scan of the file records, for every section (MTD, PRT, PEP, PSM, SML),
+the byte offset of the header line, the offsets of the first and last data rows, the number of rows and the
+header columns. The index is persisted in a sidecar file next to the mzTab and validated against the size and
+modification time of the mzTab, so later readers can seek straight to the section they need.
+
+Offsets always refer to the uncompressed content. BGZF-compressed mzTab files (bgzip) also store a list of
+checkpoints (uncompressed offset, BGZF virtual offset), which gives random access to any offset by decompressing
+at most one scan block. Plain gzip files can only be read forward, every seek decompresses from the start.
+"""
+
+import bisect
+import gzip
+import io
+import json
+import logging
+import os
+from Bio import bgzf
+from quantmsio.core.project import create_uuid_filename
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2
+INDEX_EXTENSION = ".index.json"
+SCAN_BLOCK_SIZE = 16 * 1024 * 1024
+
+# header tag -> row tag
+SECTION_TAGS = {"MTD": "MTD", "PRH": "PRT", "PEH": "PEP", "PSH": "PSM", "SMH": "SML"}
+ROW_TAGS = {row: header for header, row in SECTION_TAGS.items()}
+
+
+def get_index_path(mztab_path: str) -> str:
+    return mztab_path + INDEX_EXTENSION
+
+
+def get_compression(mztab_path: str) -> str:
+    """
+    :param mztab_path: mzTab file path
+    :return: None for plain text files, "bgzf" for bgzip files and "gzip" for other gzip files
+    """
+    with open(mztab_path, "rb") as f:
+        header = f.read(14)
+    if header[:2] != b"\x1f\x8b":
+        return None
+    # BGZF blocks are gzip members with a "BC" extra subfield (FLG.FEXTRA set)
+    if len(header) == 14 and header[3] & 4 and header[12:14] == b"BC":
+        return "bgzf"
+    return "gzip"
+
+
+def open_mztab_file(mztab_path: str, compression: str = None):
+    """
+    Open a mzTab file in binary mode, decompressing it on the fly if needed.
+    """
+    if compression == "bgzf":
+        return bgzf.BgzfReader(mztab_path, "rb")
+    if compression == "gzip":
+        return gzip.open(mztab_path, "rb")
+    return open(mztab_path, "rb")
+
+
+class SectionReader(io.RawIOBase):
+    """
+    Raw stream over a byte range of an opened mzTab file, it returns EOF at the end of the range.
+    """
+
+    def __init__(self, handle, length: int):
+        self._handle = handle
+        self._remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        data = self._handle.read(size)
+        buffer[: len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._handle.close()
+        super().close()
+
+
+def parse_header_columns(line: str) -> list:
+    """
+    Split a mzTab header line (PRH, PEH, PSH...) into its column names. Empty column names (trailing tabs) are
+    named as pandas would do it, e.g. "Unnamed: 4".
+    :param line: header line
+    :return: list of column names
+    """
+    columns = line.rstrip("\r\n").split("\t")
+    return [col if col != "" else f"Unnamed: {i}" for i, col in enumerate(columns)]
+
+
+class MzTabIndex:
+    def __init__(
+        self,
+        mztab_path: str,
+        file_size: int,
+        file_mtime: int,
+        sections: dict = None,
+        compression: str = None,
+        checkpoints: list = None,
+    ):
+        self.mztab_path = mztab_path
+        self.file_size = file_size
+        self.file_mtime = file_mtime
+        self.sections = sections if sections is not None else {}
+        self.compression = compression
+        # BGZF only: sorted [uncompressed offset, virtual offset] pairs
+        self.checkpoints = checkpoints if checkpoints is not None else []
+
+    @classmethod
+    def open(cls, mztab_path: str, save: bool = True):
+        """
+        Load the sidecar index of a mzTab file if it is still valid, otherwise scan the file and (re)write it.
+        :param mztab_path: mzTab file path
+        :param save: write the index next to the mzTab file when it has to be built
+        :return: MzTabIndex
+        """
+        index_path = get_index_path(mztab_path)
+        if os.path.exists(index_path):
+            try:
+                index = cls.load(index_path, mztab_path)
+                if index.is_valid():
+                    return index
+                logger.info(f"The index {index_path} is outdated, it will be rebuilt")
+            except (ValueError, KeyError) as e:
+                logger.warning(f"The index {index_path} can not be read ({e}), it will be rebuilt")
+        index = cls.build(mztab_path)
+        if save:
+            try:
+                index.save(index_path)
+            except OSError as e:
+                logger.warning(f"The index {index_path} can not be written: {e}")
+        return index
+
+    @classmethod
+    def build(cls, mztab_path: str):
+        """
+        Scan the mzTab file once and record the position, length and columns of every section.
+        :param mztab_path: mzTab file path
+        :return: MzTabIndex
+        """
+        stat = os.stat(mztab_path)
+        if stat.st_size == 0:
+            raise ValueError("File is empty")
+        compression = get_compression(mztab_path)
+        index = cls(mztab_path, stat.st_size, stat.st_mtime_ns, compression=compression)
+        with open_mztab_file(mztab_path, compression) as f:
+            index._scan(f)
+        if not index.sections:
+            raise ValueError("File is empty")
+        return index
+
+    @classmethod
+    def load(cls, index_path: str, mztab_path: str = None):
+        with open(index_path, encoding="utf-8") as f:
+            content = json.load(f)
+        if content.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported index version {content.get('version')}")
+        return cls(
+            mztab_path if mztab_path else content["mztab_path"],
+            content["file_size"],
+            content["file_mtime"],
+            content["sections"],
+            content["compression"],
+            content["checkpoints"],
+        )
+
+    def save(self, index_path: str = None):
+        index_path = index_path if index_path else get_index_path(self.mztab_path)
+        content = {
+            "version": INDEX_VERSION,
+            "mztab_path": os.path.basename(self.mztab_path),
+            "file_size": self.file_size,
+            "file_mtime": self.file_mtime,
+            "sections": self.sections,
+            "compression": self.compression,
+            "checkpoints": self.checkpoints,
+        }
+        # concurrent conversions of the same mzTab each write their own file, the last one replaces the index
+        tmp_path = create_uuid_filename(index_path, ".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(content, f)
+            os.replace(tmp_path, index_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def is_valid(self) -> bool:
+        if not os.path.exists(self.mztab_path):
+            return False
+        stat = os.stat(self.mztab_path)
+        return stat.st_size == self.file_size and stat.st_mtime_ns == self.file_mtime
+
+    def has_section(self, header: str) -> bool:
+        return header in self.sections
+
+    def get_section(self, header: str) -> dict:
+        """
+        :param header: section header tag (MTD, PRH, PEH, PSH or SMH)
+        :return: dict with pos (header line), data_pos (first row), end_pos (end of last row), rows and columns
+        """
+        if header not in self.sections:
+            raise ValueError(f"The mzTab {self.mztab_path} does not contain a {header} section")
+        return self.sections[header]
+
+    def get_columns(self, header: str) -> list:
+        return self.get_section(header)["columns"]
+
+    @property
+    def random_access(self) -> bool:
+        """
+        False for plain gzip files, where reaching an offset means decompressing everything before it.
+        """
+        return self.compression != "gzip"
+
+    def open_stream(self, start: int, end: int):
+        """
+        Open the (uncompressed) byte range [start, end) of the mzTab file as a buffered binary stream.
+        :param start: uncompressed start offset
+        :param end: uncompressed end offset
+        :return: io.BufferedReader
+        """
+        handle = open_mztab_file(self.mztab_path, self.compression)
+        self._seek(handle, start)
+        return io.BufferedReader(SectionReader(handle, end - start))
+
+    def _seek(self, handle, offset: int):
+        if self.compression == "bgzf":
+            i = bisect.bisect_right([point[0] for point in self.checkpoints], offset) - 1
+            position, virtual_offset = self.checkpoints[i] if i >= 0 else (0, 0)
+            handle.seek(virtual_offset)
+            while position < offset:
+                data = handle.read(min(offset - position, SCAN_BLOCK_SIZE))
+                if not data:
+                    break
+                position += len(data)
+        else:
+            handle.seek(offset)
+
+    def _new_section(self, header: str, pos: int, line: bytes):
+        columns = [] if header == "MTD" else parse_header_columns(line.decode("utf-8"))
+        data_pos = pos if header == "MTD" else pos + len(line)
+        section = {"pos": pos, "data_pos": data_pos, "end_pos": data_pos, "rows": 0, "columns": columns}
+        self.sections[header] = section
+        return section
+
+    def _scan_lines(self, data: bytes, base: int, current: str):
+        pos = base
+        start = 0
+        while start < len(data):
+            end = data.find(b"\n", start)
+            end = len(data) if end == -1 else end + 1
+            line = data[start:end]
+            tag = line[:3].decode("utf-8", errors="replace")
+            if tag == "MTD" and "MTD" not in self.sections:
+                self._new_section("MTD", pos, line)
+            elif tag in SECTION_TAGS and tag != "MTD":
+                self._new_section(tag, pos, line)
+            if tag in ROW_TAGS and ROW_TAGS[tag] in self.sections:
+                current = ROW_TAGS[tag]
+                section = self.sections[current]
+                section["rows"] += 1
+                section["end_pos"] = pos + len(line)
+            pos += len(line)
+            start = end
+        return current
+
+    def _scan(self, f):
+        """
+        Blocks made only of rows of the current section are counted without splitting them into lines, which
+        keeps the scan close to the disk speed on the large PSM sections.
+        """
+        current = None
+        base = 0
+        carry = b""
+        while True:
+            if self.compression == "bgzf":
+                self.checkpoints.append([base + len(carry), f.tell()])
+            block = f.read(SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            data = carry + block
+            last = data.rfind(b"\n")
+            if last == -1:
+                carry = data
+                continue
+            complete, carry = data[: last + 1], data[last + 1 :]
+            row_tag = SECTION_TAGS[current].encode() if current is not None else None
+            if (
+                row_tag is not None
+                and complete.startswith(row_tag)
+                and complete.count(b"\n" + row_tag) == complete.count(b"\n") - 1
+            ):
+                self.sections[current]["rows"] += complete.count(b"\n")
+                self.sections[current]["end_pos"] = base + len(complete)
+            else:
+                current = self._scan_lines(complete, base, current)
+            base += len(complete)
+        if carry:
+            self._scan_lines(carry, base, current)
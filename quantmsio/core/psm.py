@@ -1,32 +1,100 @@
 import re
 import os
+import concurrent.futures
+import multiprocessing
 import pyarrow as pa
 import pyarrow.parquet as pq
-from quantmsio.utils.file_utils import extract_protein_list
+from quantmsio.utils.protein_filter import ProteinFilter
+from quantmsio.utils.arrow_utils import dataframe_to_table, struct_list_array, to_pandas_column
 from quantmsio.utils.pride_utils import (
     get_petidoform_msstats_notation,
-    generate_scan_number,
+    generate_reference_file_names,
+    generate_scan_numbers,
+    decode_spectra_refs,
 )
-from quantmsio.operate.tools import get_ahocorasick, get_protein_accession
+from quantmsio.operate.tools import ModificationParser, get_protein_accession
 from quantmsio.core.common import PSM_USECOLS, PSM_MAP, PSM_SCHEMA, PEP
-from quantmsio.core.mztab import MzTab
+from quantmsio.core.mztab import MzTab, set_mztab_metadata
 import pandas as pd
 
+BEST_SCAN_SCHEMA = pa.schema(
+    [
+        ("peptidoform", pa.string()),
+        ("precursor_charge", pa.int64()),
+        ("scan_reference_file_name", pa.string()),
+        ("scan", pa.string()),
+    ]
+)
+
+# Psm object of a worker process, see init_psm_worker
+_WORKER_PSM = None
+
+
+def init_psm_worker(mztab_path, index, metadata):
+    """
+    Initializer of the worker processes of Psm.write_psm_to_file_parallel. The section index and the metadata
+    are shipped once per worker, so workers neither scan the mzTab nor parse its MTD section again.
+    """
+    global _WORKER_PSM
+    set_mztab_metadata(metadata, index)
+    _WORKER_PSM = Psm(mztab_path, index=index)
+
+
+def convert_psm_shard(byte_range, output_path, chunksize=1000000, protein_filter=None):
+    """
+    Convert the PSM rows of one byte range of the PSM section into a parquet file.
+    :return: output_path, or None if the shard did not produce any PSM
+    """
+    pqwriter = None
+    for p in _WORKER_PSM.generate_report(chunksize=chunksize, protein_filter=protein_filter, byte_range=byte_range):
+        if not pqwriter:
+            pqwriter = pq.ParquetWriter(output_path, p.schema)
+        pqwriter.write_table(p)
+    if pqwriter:
+        pqwriter.close()
+        return output_path
+    return None
+
+
+def select_best_rows(df, keys, score):
+    """
+    Keep the row with the lowest score of every key, the first one when several rows have the same score.
+    :param df: dataframe
+    :param keys: columns identifying a group
+    :param score: column to minimize
+    :return: dataframe with one row per key
+    """
+    df = df.dropna(subset=keys)
+    df = df.sort_values(score, kind="stable", na_position="last")
+    return df.drop_duplicates(subset=keys, keep="first")
+
+
+def get_shard_path(output_path, shard):
+    for extension in [".psm.parquet", ".parquet"]:
+        if output_path.endswith(extension):
+            return f"{output_path[: -len(extension)]}-{shard:05d}{extension}"
+    return f"{output_path}-{shard:05d}"
+
 
 class Psm(MzTab):
-    def __init__(self, mzTab_path):
-        super(Psm, self).__init__(mzTab_path)
-        self._ms_runs = self.extract_ms_runs()
-        self._protein_global_qvalue_map = self.get_protein_map()
-        self._score_names = self.get_score_names()
-        self._modifications = self.get_modifications()
-        self._mods_map = self.get_mods_map()
-        self._automaton = get_ahocorasick(self._mods_map)
-
-    def iter_psm_table(self, chunksize=1000000, protein_str=None):
-        for df in self.skip_and_load_csv("PSH", chunksize=chunksize):
-            if protein_str:
-                df = df[df["accession"].str.contains(f"{protein_str}", na=False)]
+    def __init__(self, mzTab_path, index=None):
+        super(Psm, self).__init__(mzTab_path, index)
+        self._ms_runs = self.metadata.ms_runs
+        self._score_names = self.metadata.score_names
+        self._modifications = self.metadata.modifications
+        self._mods_map = self.metadata.mods_map
+        self._modification_parser = ModificationParser(self._mods_map)
+
+    def _get_psm_usecols(self):
+        return PSM_USECOLS + PEP + list(self._score_names.values())
+
+    def iter_psm_table(self, chunksize=1000000, protein_filter=None, byte_range=None):
+        for table in self.iter_section_tables(
+            "PSH", self._get_psm_usecols(), chunksize=chunksize, byte_range=byte_range
+        ):
+            if protein_filter:
+                table = table.filter(protein_filter.mask(table.column("accession")))
+            df = table.to_pandas()
             no_cols = set(PSM_USECOLS) - set(df.columns)
             for col in no_cols:
                 df.loc[:, col] = None
@@ -36,25 +104,21 @@ class Psm(MzTab):
                     psm_map[key] = "posterior_error_probability"
                     break
             df.rename(columns=psm_map, inplace=True)
-            df.loc[:, "additional_scores"] = df[list(self._score_names.values()) + ["global_qvalue"]].apply(
-                self._genarate_additional_scores, axis=1
-            )
-            df.loc[:, "cv_params"] = df[["consensus_support"]].apply(self._generate_cv_params, axis=1)
-            df.loc[:, "reference_file_name"] = df["spectra_ref"].apply(lambda x: self._ms_runs[x[: x.index(":")]])
+            df["additional_scores"] = to_pandas_column(self._genarate_additional_scores(df), df.index)
+            df["cv_params"] = to_pandas_column(self._generate_cv_params(df), df.index)
+            df[["reference_file_name", "scan"]] = decode_spectra_refs(df["spectra_ref"], self._ms_runs)
             yield df
 
     def _extract_pep_columns(self):
-        if os.stat(self.mztab_path).st_size == 0:
-            raise ValueError("File is empty")
-        f = open(self.mztab_path)
-        pos = self._get_pos("PEH")
-        f.seek(pos)
-        line = f.readline()
-        while not line.startswith("PEH"):
-            line = f.readline()
-        self._pep_columns = line.split("\n")[0].split("\t")
+        self._pep_columns = self.index.get_columns("PEH")
 
-    def extract_from_pep(self, chunksize=2000000):
+    def iter_pep_table(self, chunksize=2000000):
+        """
+        Stream the PEP section with the peptidoform in msstats notation, the charge, the best search engine score,
+        the reference file name (spectra_ref) and the scan number (scan_number) of the best psm of every row.
+        :param chunksize: rows per chunk
+        :return: generator of pandas DataFrame
+        """
         self._extract_pep_columns()
         pep_usecols = [
             "opt_global_cv_MS:1000889_peptidoform_sequence",
@@ -72,46 +136,55 @@ class Psm(MzTab):
                 raise Exception("The peptide table don't have opt_global_cv_MS:1000889_peptidoform_sequence columns")
         if "charge" in not_cols or "best_search_engine_score[1]" in not_cols:
             raise Exception("The peptide table don't have best_search_engine_score[1] or charge columns")
-        pep_map = {}
-        indexs = [self._pep_columns.index(col) for col in live_cols]
-        for pep in self.skip_and_load_csv("PEH", usecols=indexs, chunksize=chunksize):
-            pep.reset_index(drop=True, inplace=True)
+        for table in self.iter_section_tables("PEH", live_cols, chunksize=chunksize):
+            pep = table.to_pandas()
             if "opt_global_cv_MS:1000889_peptidoform_sequence" not in pep.columns:
-                pep.loc[:, "opt_global_cv_MS:1000889_peptidoform_sequence"] = pep[["modifications", "sequence"]].apply(
-                    lambda row: get_petidoform_msstats_notation(
-                        row["sequence"], row["modifications"], self._modifications
-                    ),
-                    axis=1,
-                )
+                # every distinct (sequence, modifications) is only converted once
+                forms = pep[["sequence", "modifications"]].drop_duplicates()
+                forms["opt_global_cv_MS:1000889_peptidoform_sequence"] = [
+                    get_petidoform_msstats_notation(sequence, modifications, self._modifications)
+                    for sequence, modifications in zip(forms["sequence"], forms["modifications"])
+                ]
+                pep = pep.merge(forms, how="left", on=["sequence", "modifications"])
             # check spectra_ref
             if "spectra_ref" not in pep.columns:
                 pep.loc[:, "scan_number"] = None
                 pep.loc[:, "spectra_ref"] = None
             else:
-                pep.loc[:, "scan_number"] = pep["spectra_ref"].apply(generate_scan_number)
-                pep["spectra_ref"] = pep["spectra_ref"].apply(lambda x: self._ms_runs[x.split(":")[0]])
-            pep_msg = pep.iloc[
-                pep.groupby(["opt_global_cv_MS:1000889_peptidoform_sequence", "charge"]).apply(
-                    lambda row: row["best_search_engine_score[1]"].idxmin()
+                spectra_refs = table.column("spectra_ref")
+                pep.loc[:, "scan_number"] = generate_scan_numbers(spectra_refs).to_numpy(zero_copy_only=False)
+                pep["spectra_ref"] = generate_reference_file_names(spectra_refs, self._ms_runs).to_numpy(
+                    zero_copy_only=False
                 )
-            ]
-            pep_msg = pep_msg.set_index(["opt_global_cv_MS:1000889_peptidoform_sequence", "charge"])
-
-            pep_msg.loc[:, "pep_msg"] = pep_msg[["best_search_engine_score[1]", "spectra_ref", "scan_number"]].apply(
-                lambda row: [
-                    row["best_search_engine_score[1]"],
-                    row["spectra_ref"],
-                    row["scan_number"],
-                ],
-                axis=1,
+            yield pep
+
+    def extract_from_pep(self, chunksize=2000000):
+        """
+        Best scan (lowest best_search_engine_score[1]) of every (peptidoform, charge) of the PEP section, the
+        first one on ties.
+        :param chunksize: rows per chunk
+        :return: arrow table with peptidoform (msstats notation), precursor_charge, scan_reference_file_name and
+            scan, one row per (peptidoform, precursor_charge)
+        """
+        keys = ["peptidoform", "precursor_charge"]
+        best_scans = None
+        for pep in self.iter_pep_table(chunksize):
+            pep = pd.DataFrame(
+                {
+                    "peptidoform": pep["opt_global_cv_MS:1000889_peptidoform_sequence"].values,
+                    "precursor_charge": pep["charge"].values,
+                    "score": pep["best_search_engine_score[1]"].values,
+                    "scan_reference_file_name": pep["spectra_ref"].values,
+                    "scan": pep["scan_number"].values,
+                }
             )
-            map_dict = pep_msg.to_dict()["pep_msg"]
-            for key, value in map_dict.items():
-                if key not in pep_map:
-                    pep_map[key] = value
-                elif value[0] < pep_map[key][0]:
-                    pep_map[key] = value
-        return pep_map
+            if best_scans is not None:
+                # the rows of the previous chunks come first, they are kept on ties
+                pep = pd.concat([best_scans, pep], ignore_index=True)
+            best_scans = select_best_rows(pep, keys, "score")
+        if best_scans is None:
+            return BEST_SCAN_SCHEMA.empty_table()
+        return pa.Table.from_pandas(best_scans.drop(columns=["score"]), schema=BEST_SCAN_SCHEMA, preserve_index=False)
 
     @staticmethod
     def slice(df, partitions):
@@ -126,51 +199,44 @@ class Psm(MzTab):
         for key, df in df.groupby(partitions):
             yield key, df
 
-    def generate_report(self, chunksize=1000000, protein_str=None):
-        for df in self.iter_psm_table(chunksize=chunksize, protein_str=protein_str):
+    def generate_report(self, chunksize=1000000, protein_filter=None, byte_range=None):
+        for df in self.iter_psm_table(chunksize=chunksize, protein_filter=protein_filter, byte_range=byte_range):
             self.transform_psm(df)
             self.add_addition_msg(df)
             self.convert_to_parquet_format(df)
             df = self.transform_parquet(df)
             yield df
 
-    def _generate_cv_params(self, rows):
-        cv_list = []
-        if rows["consensus_support"]:
-            struct = {"cv_name": "consesus_support", "cv_value": str(rows["consensus_support"])}
-            cv_list.append(struct)
-        if len(cv_list) > 0:
-            return cv_list
-        else:
-            return None
+    @staticmethod
+    def _generate_cv_params(df):
+        consensus_support = df["consensus_support"]
+        return struct_list_array(
+            [{"cv_name": "consesus_support", "cv_value": consensus_support.astype(str)}],
+            PSM_SCHEMA.field("cv_params").type,
+            len(df),
+            masks=[consensus_support.astype(bool)],
+            empty_as_null=True,
+        )
 
     def transform_psm(self, df):
-        select_mods = list(self._mods_map.keys())
-        df[["peptidoform", "modifications"]] = df[["peptidoform"]].apply(
-            lambda row: self.generate_modifications_details(
-                row["peptidoform"], self._mods_map, self._automaton, select_mods
-            ),
-            axis=1,
-            result_type="expand",
-        )
-        df.loc[:, "scan"] = df["spectra_ref"].apply(generate_scan_number)
-        df.drop(["spectra_ref", "search_engine", "search_engine_score[1]"], inplace=True, axis=1)
+        self._modification_parser.transform(df)
+        df.drop(["spectra_ref", "search_engine", "search_engine_score[1]"], inplace=True, axis=1, errors="ignore")
 
     @staticmethod
     def transform_parquet(df):
-        return pa.Table.from_pandas(df, schema=PSM_SCHEMA)
+        return dataframe_to_table(df, schema=PSM_SCHEMA)
 
-    def _genarate_additional_scores(self, cols):
-        struct_list = []
+    def _genarate_additional_scores(self, df):
+        entries = []
+        masks = []
         for software, score in self._score_names.items():
             software = re.sub(r"[^a-zA-Z0-9\s]", "", software)
             software = software.lower()
-            struct = {"score_name": f"{software}_score", "score_value": cols[score]}
-            struct_list.append(struct)
-        if cols["global_qvalue"]:
-            struct = {"score_name": "global_qvalue", "score_value": cols["global_qvalue"]}
-            struct_list.append(struct)
-        return struct_list
+            entries.append({"score_name": f"{software}_score", "score_value": df[score]})
+            masks.append(None)
+        entries.append({"score_name": "global_qvalue", "score_value": df["global_qvalue"]})
+        masks.append(df["global_qvalue"].astype(bool))
+        return struct_list_array(entries, PSM_SCHEMA.field("additional_scores").type, len(df), masks=masks)
 
     def add_addition_msg(self, df):
         df.loc[:, "predicted_rt"] = None
@@ -180,16 +246,61 @@ class Psm(MzTab):
         df.loc[:, "intensity_array"] = None
 
     def write_psm_to_file(self, output_path, chunksize=1000000, protein_file=None):
-        protein_list = extract_protein_list(protein_file) if protein_file else None
-        protein_str = "|".join(protein_list) if protein_list else None
+        protein_filter = ProteinFilter.from_file(protein_file)
         pqwriter = None
-        for p in self.generate_report(chunksize=chunksize, protein_str=protein_str):
+        for p in self.generate_report(chunksize=chunksize, protein_filter=protein_filter):
             if not pqwriter:
                 pqwriter = pq.ParquetWriter(output_path, p.schema)
             pqwriter.write_table(p)
         if pqwriter:
             pqwriter.close()
 
+    def write_psm_to_file_parallel(
+        self, output_path, workers=4, chunksize=1000000, protein_file=None, shards=None, merge=True
+    ):
+        """
+        Convert the PSM section in a pool of processes. The section is split into byte ranges aligned to the lines
+        and every shard is converted into its own parquet file.
+        :param output_path: output parquet file
+        :param workers: number of processes
+        :param chunksize: Read batch size of every worker
+        :param protein_file: Protein file that meets specific requirements
+        :param shards: number of shards, by default one per worker
+        :param merge: merge the shards, in order, into output_path; otherwise keep one file per shard
+        :return: list of generated parquet files
+        """
+        protein_filter = ProteinFilter.from_file(protein_file)
+        byte_ranges = self.get_section_shards("PSH", shards if shards else workers)
+        shard_paths = [get_shard_path(output_path, i) for i in range(len(byte_ranges))]
+        # the arrow csv readers of this process hold thread pools, which are not safe to fork
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_psm_worker,
+            initargs=(self.mztab_path, self.index, self.metadata),
+        ) as executor:
+            futures = [
+                executor.submit(convert_psm_shard, byte_range, shard_path, chunksize, protein_filter)
+                for byte_range, shard_path in zip(byte_ranges, shard_paths)
+            ]
+            results = [future.result() for future in futures]
+        shard_paths = [path for path in results if path]
+        if not merge:
+            return shard_paths
+        pqwriter = None
+        for path in shard_paths:
+            shard = pq.ParquetFile(path)
+            for i in range(shard.num_row_groups):
+                table = shard.read_row_group(i)
+                if not pqwriter:
+                    pqwriter = pq.ParquetWriter(output_path, table.schema)
+                pqwriter.write_table(table)
+            os.remove(path)
+        if pqwriter:
+            pqwriter.close()
+            return [output_path]
+        return []
+
     @staticmethod
     def convert_to_parquet_format(res):
         res["mp_accessions"] = res["mp_accessions"].apply(get_protein_accession)
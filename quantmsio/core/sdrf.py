@@ -42,6 +42,20 @@ def get_name_from_complex_sdrf_value(sdrf_value: str) -> str:
         return sdrf_value
 
 
+def map_sample_accessions(map_samples: pd.Series, sample_map: dict) -> pd.Series:
+    """
+    Map the "<data file>-<label>" keys of the rows to the sample accessions of the SDRF
+    :param map_samples: keys built like the ones of SDRFHandler.get_sample_map_run
+    :param sample_map: the map returned by SDRFHandler.get_sample_map_run
+    :raises KeyError: if any key is not described in the SDRF, instead of writing a null sample_accession
+    """
+    sample_accessions = map_samples.map(sample_map)
+    missing = sample_accessions.isna()
+    if missing.any():
+        raise KeyError(f"Not found in the SDRF: {sorted(map_samples[missing].astype(str).unique())}")
+    return sample_accessions
+
+
 def get_complex_value_sdrf_column(sdrf_table: DataFrame, column: str) -> list:
     """
     Get the complex values from a SDRF column
@@ -1,6 +1,6 @@
 import os
 import re
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import pandas as pd
 import numpy as np
 import pyarrow as pa
@@ -13,11 +13,12 @@ from quantmsio.core.sdrf import SDRFHandler
 from quantmsio.operate.query import Query, map_spectrum_mz
 from quantmsio.core.openms import OpenMSHandler
 from quantmsio.utils.pride_utils import get_unanimous_name
-from quantmsio.utils.file_utils import load_de_or_ae, save_slice_file, save_file, close_file
+from quantmsio.utils.arrow_utils import to_pandas_column
+from quantmsio.utils.file_utils import load_de_or_ae, save_file, close_file, ParquetPartitionWriter
 
 
 def init_save_info(parquet_path: str):
-    pqwriters = {}
+    pqwriters = None
     pqwriter_no_part = None
     filename = os.path.basename(parquet_path)
     return pqwriters, pqwriter_no_part, filename
@@ -55,13 +56,15 @@ def generate_psms_of_spectrum(
 
 
 def save_parquet_file(
-    partitions, table, output_folder, filename, pqwriters={}, pqwriter_no_part=None, schema=FEATURE_SCHEMA
+    partitions, table, output_folder, filename, pqwriters=None, pqwriter_no_part=None, schema=FEATURE_SCHEMA
 ):
 
     if partitions and len(partitions) > 0:
+        if pqwriters is None:
+            pqwriters = ParquetPartitionWriter(output_folder, filename, partitions)
         for key, df in table.groupby(partitions):
             parquet_table = pa.Table.from_pandas(df, schema=schema)
-            pqwriters = save_slice_file(parquet_table, pqwriters, output_folder, key, filename)
+            pqwriters.write_table(key, parquet_table)
         return pqwriters, pqwriter_no_part
     else:
         parquet_table = pa.Table.from_pandas(table, schema=schema)
@@ -194,6 +197,67 @@ def get_ahocorasick(mods_dict: dict):
     return automaton
 
 
+MODIFICATION_CACHE_SIZE = 500000
+MODIFICATIONS_TYPE = PSM_SCHEMA.field("modifications").type
+
+
+class ModificationParser:
+    """
+    Parse peptidoform columns into the clean peptidoform and the modifications column. Every distinct
+    peptidoform is parsed once, the results are kept in a bounded LRU memo that is shared by all the chunks
+    converted with the same parser.
+    """
+
+    def __init__(self, mods_dict: dict, select_mods: list = None, maxsize: int = MODIFICATION_CACHE_SIZE):
+        self._mods_dict = mods_dict
+        self._automaton = get_ahocorasick(mods_dict)
+        self._select_mods = select_mods if select_mods is not None else list(mods_dict.keys())
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def parse(self, seq: str):
+        """
+        :param seq: peptidoform with modifications, e.g. .(Acetyl)ASPDWGYDDKNGPEQWSK
+        :return: (peptidoform, modification details or None)
+        """
+        if seq in self._cache:
+            self._cache.move_to_end(seq)
+            return self._cache[seq]
+        peptidoform, modification_details = get_modification_details(
+            seq.replace(".", ""), self._mods_dict, self._automaton, self._select_mods
+        )
+        result = (peptidoform, modification_details if len(modification_details) > 0 else None)
+        self._cache[seq] = result
+        if len(self._cache) > self._maxsize:
+            self._cache.popitem(last=False)
+        return result
+
+    def _parse_unique(self, peptidoforms: pd.Series):
+        codes, uniques = pd.factorize(peptidoforms)
+        parsed = [self.parse(seq) for seq in uniques]
+        # missing values are factorized as -1, they point to the extra null entry at the end
+        codes = np.where(codes < 0, len(parsed), codes)
+        return codes, [item[0] for item in parsed] + [None], [item[1] for item in parsed] + [None]
+
+    def parse_column(self, peptidoforms: pd.Series):
+        """
+        :param peptidoforms: peptidoform column
+        :return: clean peptidoform column and modifications as an arrow list<struct> array
+        """
+        codes, peptidoform, modifications = self._parse_unique(peptidoforms)
+        peptidoform = pd.Series(np.array(peptidoform, dtype=object)[codes], index=peptidoforms.index)
+        return peptidoform, pa.array(modifications, type=MODIFICATIONS_TYPE).take(codes)
+
+    def transform(self, df: pd.DataFrame):
+        """
+        Replace the peptidoform column of df by the clean peptidoform and add the modifications column, an arrow
+        backed list<struct> column (see parse_column), no python object is built per row.
+        """
+        peptidoform, modifications = self.parse_column(df["peptidoform"])
+        df["peptidoform"] = peptidoform
+        df["modifications"] = to_pandas_column(modifications, df.index)
+
+
 def get_field_schema(parquet_path):
     schema = pq.read_schema(parquet_path)
     return schema
@@ -203,6 +267,8 @@ PROTEIN_ACCESSION = r"\|([^|]*)\|"
 
 
 def get_protein_accession(proteins: str = None):
+    if not isinstance(proteins, str) and pd.isna(proteins):
+        return None
     proteins = str(proteins)
     if "|" in proteins:
         return re.findall(PROTEIN_ACCESSION, proteins)
@@ -0,0 +1,144 @@
+"""
+Helpers to build the nested list<struct> columns of the quantms.io schemas (additional_scores, cv_params,
+intensities...) directly as arrow arrays from flat columns, instead of building python dicts per row.
+"""
+
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+def _to_child_array(values, value_type: pa.DataType, size: int) -> pa.Array:
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        array = values.combine_chunks() if isinstance(values, pa.ChunkedArray) else values
+        return array if array.type == value_type else array.cast(value_type)
+    if isinstance(values, (pd.Series, np.ndarray, list)):
+        return pa.array(values, type=value_type, from_pandas=True)
+    return pa.repeat(pa.scalar(values, type=value_type), size)
+
+
+def struct_list_array(
+    entries: list, list_type: pa.ListType, size: int, masks: list = None, empty_as_null: bool = False
+) -> pa.ListArray:
+    """
+    Build a list<struct> column where every row holds one struct per entry, e.g. for additional_scores:
+        struct_list_array(
+            [{"score_name": "andromeda_score", "score_value": df["andromeda_score"]}],
+            ADDITIONAL_SCORES_TYPE,
+            len(df),
+        )
+    :param entries: one dict per struct of the lists, it maps every struct field to a column (pandas Series,
+        numpy or arrow array) or to a scalar shared by all the rows
+    :param list_type: arrow list<struct> type of the column
+    :param size: number of rows
+    :param masks: optional boolean arrays, one per entry (or None), the entry is only added to the rows where
+        the mask is True
+    :param empty_as_null: rows without any struct are null instead of empty lists
+    :return: pyarrow.ListArray
+    """
+    struct_type = list_type.value_type
+    selected = np.ones((len(entries), size), dtype=bool)
+    if masks is not None:
+        for i, mask in enumerate(masks):
+            if mask is not None:
+                selected[i] = np.asarray(mask, dtype=bool)
+    # structs are laid out row by row, entry by entry inside a row
+    rows, positions = np.nonzero(selected.T)
+    take_indices = pa.array(positions * size + rows, type=pa.int64())
+    children = []
+    for field in struct_type:
+        arrays = [_to_child_array(entry[field.name], field.type, size) for entry in entries]
+        child = pa.concat_arrays(arrays) if arrays else pa.array([], type=field.type)
+        children.append(child.take(take_indices))
+    values = pa.StructArray.from_arrays(children, fields=list(struct_type))
+    counts = selected.sum(axis=0)
+    offsets = pa.array(np.concatenate([[0], np.cumsum(counts)]), type=pa.int32())
+    mask = pa.array(counts == 0) if empty_as_null else None
+    return pa.ListArray.from_arrays(offsets, values, mask=mask).cast(list_type)
+
+
+def grouped_struct_list_array(fields: dict, list_type: pa.ListType, groups: np.ndarray, size: int) -> pa.ListArray:
+    """
+    Build a list<struct> column with one list per group of rows, e.g. the intensities of the channels of a
+    feature. Every list holds the structs of the rows of its group, in the order of the rows.
+    :param fields: maps every struct field to a column with one value per row, or to a scalar shared by all the rows
+    :param list_type: arrow list<struct> type of the column
+    :param groups: group number of every row, from 0 to size - 1
+    :param size: number of groups
+    :return: pyarrow.ListArray with size rows
+    """
+    groups = np.asarray(groups)
+    order = pa.array(np.argsort(groups, kind="stable"), type=pa.int64())
+    struct_type = list_type.value_type
+    children = [_to_child_array(fields[field.name], field.type, len(groups)).take(order) for field in struct_type]
+    values = pa.StructArray.from_arrays(children, fields=list(struct_type))
+    offsets = pa.array(np.concatenate([[0], np.cumsum(np.bincount(groups, minlength=size))]), type=pa.int32())
+    return pa.ListArray.from_arrays(offsets, values).cast(list_type)
+
+
+def to_pandas_column(array: pa.Array, index=None) -> pd.Series:
+    """
+    Wrap an arrow array into a pandas column without converting its values to python objects.
+    """
+    return pd.Series(pd.arrays.ArrowExtensionArray(array), index=index)
+
+
+def table_to_dataframe(table: pa.Table) -> pd.DataFrame:
+    """
+    Same as table.to_pandas(), except for the list<struct> columns, which stay arrow backed (see to_pandas_column).
+    """
+    nested = [field.name for field in table.schema if _is_struct_list(field.type)]
+    df = table.drop(nested).to_pandas()
+    for name in nested:
+        df[name] = to_pandas_column(table.column(name).combine_chunks(), df.index)
+    return df[table.column_names]
+
+
+def _is_struct_list(data_type: pa.DataType) -> bool:
+    return pa.types.is_list(data_type) and pa.types.is_struct(data_type.value_type)
+
+
+def join_table_columns(df: pd.DataFrame, table: pa.Table, keys: list, columns: list) -> pd.DataFrame:
+    """
+    Add columns of an arrow table to a dataframe with a left join on keys, the keys of the table must be unique.
+    Only the keys take part in the hash join (arrow can not join list columns), the columns are then gathered
+    by row number, so nested columns never leave arrow. The rows of df keep their order, rows without match get
+    nulls.
+    :param df: dataframe, its keys are cast to the types of the table
+    :param table: arrow table with one row per key
+    :param keys: join columns
+    :param columns: columns of the table to add, they replace the columns of df with the same name
+    :return: df with the columns
+    """
+    df = df.drop(columns=[col for col in columns if col in df.columns])
+    left = pa.table({col: pa.array(df[col], from_pandas=True).cast(table.schema.field(col).type) for col in keys})
+    left = left.append_column("_left_row", pa.array(np.arange(len(df))))
+    right = table.select(keys).append_column("_right_row", pa.array(np.arange(len(table))))
+    joined = left.join(right, keys, join_type="left outer").sort_by("_left_row")
+    values = table.select(columns).take(joined.column("_right_row"))
+    for col in columns:
+        column = values.column(col)
+        if pa.types.is_list(column.type):
+            df[col] = to_pandas_column(column.combine_chunks(), df.index)
+        else:
+            df[col] = column.to_pandas().set_axis(df.index)
+    return df
+
+
+def dataframe_to_table(df: pd.DataFrame, schema: pa.Schema = None, preserve_index: bool = None) -> pa.Table:
+    """
+    Same as pa.Table.from_pandas(df, schema=schema) for DataFrames holding arrow backed nested columns. pandas can
+    not parse back the dtype of those columns, they are recorded as object columns in the pandas metadata.
+    """
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=preserve_index)
+    metadata = table.schema.metadata
+    if not metadata or b"pandas" not in metadata:
+        return table
+    pandas_metadata = json.loads(metadata[b"pandas"])
+    for column in pandas_metadata["columns"]:
+        if str(column.get("numpy_type", "")).endswith("[pyarrow]") and "<" in column["numpy_type"]:
+            column["numpy_type"] = "object"
+    metadata = dict(metadata)
+    metadata[b"pandas"] = json.dumps(pandas_metadata).encode("utf-8")
+    return table.replace_schema_metadata(metadata)
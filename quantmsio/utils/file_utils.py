@@ -1,5 +1,8 @@
 import logging
 import os
+import re
+from collections import OrderedDict
+from urllib.parse import quote
 import pyarrow.parquet as pq
 import psutil
 import pandas as pd
@@ -7,6 +10,11 @@ import pandas as pd
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# parquet files kept open at once by a ParquetPartitionWriter, far below the usual limit of 1024 open files
+MAX_OPEN_WRITERS = 256
+# folder name of the null values of a partition column, as written by hive and read by pyarrow
+HIVE_NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
 
 def extract_protein_list(file):
     f = open(file, encoding="utf-8")
@@ -84,17 +92,96 @@ def calculate_buffer_size(file_path: str) -> int:
     return min(int(total_memory * fraction_of_memory), max_buffer_size, file_size)
 
 
-def save_slice_file(parquet_table, pqwriters, output_folder, partitions, filename):
-    folder = [output_folder] + [str(col) for col in partitions]
-    folder = os.path.join(*folder)
-    if not os.path.exists(folder):
-        os.makedirs(folder, exist_ok=True)
-    save_path = os.path.join(*[folder, filename])
-    if not os.path.exists(save_path):
-        pqwriter = pq.ParquetWriter(save_path, parquet_table.schema)
-        pqwriters[partitions] = pqwriter
-    pqwriters[partitions].write_table(parquet_table)
-    return pqwriters
+class ParquetPartitionWriter:
+    """
+    Writer of a dataset partitioned by some columns, e.g. the features of every reference_file_name. The tables of
+    a partition are written to output_folder/col1=value1/col2=value2/filename, a hive-style dataset that
+    pyarrow, DuckDB or Spark read with its partitions. At most max_open_writers files are open at once: the least
+    recently used writer is closed, which completes its file, when a new partition needs one. A partition written
+    again after its writer was closed goes to a new part file, filename-1.parquet, filename-2.parquet... The part
+    files left in a partition folder by an earlier run are removed when the partition is first written.
+    """
+
+    def __init__(self, output_folder: str, filename: str, partitions: list, max_open_writers: int = MAX_OPEN_WRITERS):
+        """
+        :param output_folder: root folder of the dataset
+        :param filename: name of the parquet file of every partition
+        :param partitions: partition columns, in the order of the keys
+        :param max_open_writers: maximum number of open parquet writers
+        """
+        self.output_folder = output_folder
+        self.filename = filename
+        self.partitions = list(partitions)
+        self.max_open_writers = max(int(max_open_writers), 1)
+        # open writers, the least recently used first
+        self._writers = OrderedDict()
+        # number of files written per partition
+        self._parts = {}
+
+    def get_partition_folder(self, key) -> str:
+        """
+        :param key: values of the partition columns, a scalar for a single column
+        :return: hive-style folder of the partition, the values are URI encoded
+        """
+        values = key if isinstance(key, tuple) else (key,)
+        folders = [
+            "{}={}".format(col, HIVE_NULL_PARTITION if pd.isna(value) else quote(str(value), safe=""))
+            for col, value in zip(self.partitions, values)
+        ]
+        return os.path.join(self.output_folder, *folders)
+
+    def get_part_path(self, key, part: int) -> str:
+        """
+        :param key: values of the partition columns
+        :param part: number of the files already written for the partition
+        :return: path of the next file of the partition
+        """
+        filename = self.filename
+        if part:
+            root, extension = os.path.splitext(filename)
+            filename = "{}-{}{}".format(root, part, extension)
+        return os.path.join(self.get_partition_folder(key), filename)
+
+    def remove_stale_parts(self, key):
+        """
+        Remove the part files of an earlier run from the folder of a partition, they would be read with the new
+        files of the dataset. The base file is overwritten by the first writer of the partition.
+        :param key: values of the partition columns
+        """
+        folder = self.get_partition_folder(key)
+        if not os.path.isdir(folder):
+            return
+        root, extension = os.path.splitext(self.filename)
+        pattern = re.compile(r"{}-\d+{}".format(re.escape(root), re.escape(extension)))
+        for name in os.listdir(folder):
+            if pattern.fullmatch(name):
+                os.remove(os.path.join(folder, name))
+
+    def write_table(self, key, table):
+        """
+        :param key: values of the partition columns of the rows of the table
+        :param table: pyarrow table
+        """
+        key = key if isinstance(key, tuple) else (key,)
+        if key in self._writers:
+            self._writers.move_to_end(key)
+        else:
+            while len(self._writers) >= self.max_open_writers:
+                _, pqwriter = self._writers.popitem(last=False)
+                pqwriter.close()
+            part = self._parts.get(key, 0)
+            if part == 0:
+                self.remove_stale_parts(key)
+            save_path = self.get_part_path(key, part)
+            os.makedirs(os.path.dirname(save_path), exist_ok=True)
+            self._writers[key] = pq.ParquetWriter(save_path, table.schema)
+            self._parts[key] = part + 1
+        self._writers[key].write_table(table)
+
+    def close(self):
+        while self._writers:
+            _, pqwriter = self._writers.popitem(last=False)
+            pqwriter.close()
 
 
 def save_file(parquet_table, pqwriter, output_folder, filename):
@@ -107,9 +194,15 @@ def save_file(parquet_table, pqwriter, output_folder, filename):
     return pqwriter
 
 
-def close_file(pqwriters: dict = None, pqwriter: object = None):
+def close_file(pqwriters=None, pqwriter: object = None):
+    """
+    :param pqwriters: ParquetPartitionWriter, or a dict of parquet writers
+    :param pqwriter: parquet writer
+    """
     if pqwriter:
         pqwriter.close()
-    else:
+    elif isinstance(pqwriters, dict):
         for pqwriter in pqwriters.values():
             pqwriter.close()
+    elif pqwriters is not None:
+        pqwriters.close()
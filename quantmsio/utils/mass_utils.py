@@ -0,0 +1,280 @@
+"""
+Monoisotopic masses and canonical notations of peptidoforms (e.g. AAC(UniMod:4)K). Peptidoforms made of standard
+residues with at most one modification per residue (and an optional N-terminal one) are computed with NumPy from
+a residue and modification mass table taken from pyopenms. Parsing the other peptidoforms with pyopenms is slow,
+so they are parsed once: the results are kept in memory and in an on-disk cache shared by all the runs and
+projects, and large sets of new peptidoforms are parsed in a pool of processes.
+"""
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import diskcache
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyopenms
+from pyopenms import AASequence, EmpiricalFormula, ModificationsDB, Residue, ResidueDB, ResidueModification
+from pyopenms.Constants import PROTON_MASS_U
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STANDARD_RESIDUES = "ACDEFGHIKLMNOPQRSTUVWY"
+PEPTIDOFORM_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "quantmsio", "peptidoforms")
+PARSE_CHUNK_SIZE = 20000
+# below this number of new peptidoforms, starting the pool costs more than it saves
+POOL_MIN_PEPTIDOFORMS = 100000
+
+# shared services, keyed by cache folder
+_SERVICES = {}
+
+
+def parse_peptidoforms(peptidoforms: list) -> list:
+    """
+    :param peptidoforms: peptidoforms in a notation understood by AASequence.fromString
+    :return: list of (monoisotopic mass, canonical notation)
+    """
+    result = []
+    for peptidoform in peptidoforms:
+        sequence = AASequence.fromString(peptidoform)
+        result.append((sequence.getMonoWeight(), sequence.toString()))
+    return result
+
+
+def calculated_mz(masses, charges) -> np.ndarray:
+    """
+    :param masses: monoisotopic masses of the peptidoforms
+    :param charges: precursor charges
+    :return: m/z of the precursors
+    """
+    charges = np.asarray(charges, dtype=float)
+    return (np.asarray(masses, dtype=float) + PROTON_MASS_U * charges) / charges
+
+
+class ResidueMassTable:
+    """
+    Vectorized masses and notations of peptidoforms written as residues followed by modifications in round
+    brackets, e.g. (UniMod:1)AAC(UniMod:4)K or M(Oxidation)K. Modifications are looked up in ModificationsDB once
+    per (modification, residue) pair. Peptidoforms with other residues, several modifications on a residue,
+    terminal dots or nested brackets are left to AASequence.
+    """
+
+    def __init__(self):
+        self._residue_db = ResidueDB()
+        self._residue_masses = np.full(256, np.nan)
+        for letter in STANDARD_RESIDUES:
+            residue = self._residue_db.getResidue(letter)
+            self._residue_masses[ord(letter)] = residue.getMonoWeight(Residue.ResidueType.Internal)
+        self._water_mass = EmpiricalFormula("H2O").getMonoWeight()
+        self._modifications_db = ModificationsDB()
+        self._modifications = {}
+
+    def get_modification(self, name: str, residue: str, n_term: bool = False):
+        """
+        :param name: modification as written in the peptidoform, e.g. UniMod:4 or Carbamidomethyl
+        :param residue: modified residue, the first residue for N-terminal modifications
+        :param n_term: N-terminal modification
+        :return: (mass difference, modification id), (nan, None) when the modification is unknown
+        """
+        key = (name, residue, n_term)
+        if key not in self._modifications and (not residue or residue not in STANDARD_RESIDUES):
+            self._modifications[key] = (np.nan, None)
+        if key not in self._modifications:
+            specificity = ResidueModification.TermSpecificity
+            try:
+                if not n_term:
+                    # AASequence weighs modified residues from their formula, not from the rounded mass difference
+                    modification = self._modifications_db.getModification(name, residue, specificity.ANYWHERE)
+                    unmodified = self._residue_db.getResidue(residue)
+                    modified = self._residue_db.getModifiedResidue(unmodified, modification.getFullId())
+                    mass = modified.getMonoWeight(Residue.ResidueType.Internal) - self._residue_masses[ord(residue)]
+                else:
+                    modification = self._modifications_db.getModification(name, residue, specificity.N_TERM)
+                    mass = modification.getDiffMonoMass()
+                self._modifications[key] = (mass, modification.getId())
+            except RuntimeError:
+                self._modifications[key] = (np.nan, None)
+        return self._modifications[key]
+
+    def compute(self, peptidoforms: list):
+        """
+        :param peptidoforms: peptidoforms
+        :return: numpy array of the monoisotopic masses, nan for the peptidoforms left to AASequence, and numpy
+            array of the canonical notations
+        """
+        size = len(peptidoforms)
+        # the peptidoforms are cut at the opening brackets: (UniMod:1)M(UniMod:35)K -> "", "UniMod:1)M", "UniMod:35)K"
+        parts = pc.split_pattern(pa.array(peptidoforms, type=pa.string()), "(")
+        counts = pc.list_value_length(parts).fill_null(0).to_numpy()
+        parents = pc.list_parent_indices(parts).to_numpy()
+        pieces = pc.list_flatten(parts)
+        if len(pieces) == 0:
+            return np.full(size, np.nan), np.full(size, None, dtype=object)
+        first = np.zeros(len(pieces), dtype=bool)
+        first[(np.cumsum(counts) - counts)[counts > 0]] = True
+        # the following pieces hold a modification and the residues up to the next modification
+        matches = pc.extract_regex(pieces, r"^(?P<name>[^)]*)\)(?P<residues>[^)]*)$")
+        valid = first | matches.is_valid().to_numpy(zero_copy_only=False)
+        is_first = pa.array(first)
+        names = pc.if_else(is_first, pa.scalar(None, pa.string()), pc.struct_field(matches, [0]))
+        residues = pc.if_else(is_first, pieces, pc.struct_field(matches, [1]).fill_null(""))
+
+        # residue masses summed per piece, unknown residues give nan
+        buffers = residues.buffers()
+        offsets = np.frombuffer(buffers[1], dtype=np.int32)[residues.offset : residues.offset + len(residues) + 1]
+        lengths = np.diff(offsets)
+        codes = np.frombuffer(buffers[2], dtype=np.uint8)[offsets[0] : offsets[-1]] if buffers[2] else []
+        values = np.append(self._residue_masses[codes], 0.0)
+        residue_masses = np.add.reduceat(values, offsets[:-1] - offsets[0])
+        residue_masses[lengths == 0] = 0.0
+
+        # the modified residue ends the previous piece, N-terminal modifications follow an empty first piece and
+        # are checked against the first residue
+        n_term = np.append(False, first[:-1] & (lengths[:-1] == 0))
+        padded = np.append(codes, 0).astype(np.uint8)
+        starts = np.where(lengths > 0, padded[offsets[:-1] - offsets[0]], 0)
+        ends = np.where(lengths > 0, padded[np.maximum(offsets[1:] - offsets[0] - 1, 0)], 0)
+        modified = np.where(n_term, starts, np.append(0, ends[:-1]))
+        # several modifications on the same residue
+        valid[1:] &= first[1:] | first[:-1] | (lengths[:-1] > 0)
+
+        # modifications are looked up once per distinct (name, residue, N-terminal) key
+        names = names.dictionary_encode()
+        name_indices = names.indices.fill_null(-1).to_numpy()
+        modified_pieces = name_indices >= 0
+        keys = (name_indices.astype(np.int64) * 256 + modified) * 2 + n_term
+        unique_keys, inverse = np.unique(keys[modified_pieces], return_inverse=True)
+        dictionary = names.dictionary.to_pylist()
+        modifications = [
+            self.get_modification(dictionary[key // 512], chr(key // 2 % 256) if key // 2 % 256 else "", key % 2 == 1)
+            for key in unique_keys.tolist()
+        ]
+        modification_masses = np.zeros(len(pieces))
+        modification_masses[modified_pieces] = np.array([mass for mass, _ in modifications], dtype=float)[inverse]
+        indices = np.zeros(len(pieces), dtype=np.int64)
+        indices[modified_pieces] = inverse
+        modification_ids = pa.array([name for _, name in modifications] + [None], type=pa.string()).take(
+            pa.array(indices, mask=~modified_pieces)
+        )
+
+        piece_masses = np.where(valid, residue_masses + modification_masses, np.nan)
+        masses = np.bincount(parents, weights=piece_masses, minlength=size) + self._water_mass
+        masses[np.bincount(parents, weights=lengths, minlength=size) == 0] = np.nan
+
+        # N-terminal modifications are written after a dot by AASequence.toString
+        piece_notations = pc.if_else(
+            is_first,
+            pc.if_else(pa.array(np.append(n_term[1:], False)), ".", residues),
+            pc.binary_join_element_wise("(", modification_ids, ")", residues, ""),
+        )
+        list_offsets = pa.array(np.concatenate([[0], np.cumsum(counts)]), type=pa.int32())
+        notations = pc.binary_join(pa.ListArray.from_arrays(list_offsets, piece_notations), "")
+        return masses, notations.to_numpy(zero_copy_only=False)
+
+
+class PeptidoformMasses:
+    def __init__(self, cache_dir: str = PEPTIDOFORM_CACHE_DIR, workers: int = None):
+        """
+        :param cache_dir: folder of the on-disk cache, None only keeps the results in memory
+        :param workers: number of processes used to parse the new peptidoforms, by default one per cpu
+        """
+        # masses depend on the pyopenms element and modification databases
+        self._cache_dir = os.path.join(cache_dir, pyopenms.__version__) if cache_dir else None
+        self._cache = None
+        self._workers = workers if workers else os.cpu_count()
+        self._memory = {}
+        self._mass_table = None
+
+    @property
+    def mass_table(self) -> ResidueMassTable:
+        if self._mass_table is None:
+            self._mass_table = ResidueMassTable()
+        return self._mass_table
+
+    @property
+    def cache(self):
+        if self._cache is None and self._cache_dir is not None:
+            try:
+                self._cache = diskcache.Cache(self._cache_dir)
+            except OSError as e:
+                logger.warning(f"The peptidoform cache {self._cache_dir} can not be opened ({e}), it is disabled")
+                self._cache_dir = None
+        return self._cache
+
+    def lookup(self, peptidoforms) -> dict:
+        """
+        Compute the peptidoforms with the residue mass table, the ones it can not handle are kept in memory and in
+        the on-disk cache, the new ones are parsed with AASequence.
+        :param peptidoforms: peptidoforms, nulls are ignored
+        :return: dict peptidoform -> (monoisotopic mass, canonical notation)
+        """
+        keys = list({peptidoform for peptidoform in peptidoforms if isinstance(peptidoform, str)})
+        masses, notations = self.mass_table.compute(keys)
+        resolved = ~np.isnan(masses)
+        result = dict(zip(np.array(keys, dtype=object)[resolved], zip(masses[resolved], notations[resolved])))
+        others = [key for key, done in zip(keys, resolved) if not done]
+        missing = [key for key in others if key not in self._memory]
+        cache = self.cache
+        if missing and cache is not None:
+            with cache.transact():
+                found = {key: cache.get(key) for key in missing}
+            self._memory.update({key: value for key, value in found.items() if value is not None})
+            missing = [key for key, value in found.items() if value is None]
+        if missing:
+            parsed = dict(zip(missing, self._parse(missing)))
+            self._memory.update(parsed)
+            if cache is not None:
+                with cache.transact():
+                    for key, value in parsed.items():
+                        cache.set(key, value)
+        result.update({key: self._memory[key] for key in others})
+        return result
+
+    def _parse(self, peptidoforms: list) -> list:
+        if self._workers <= 1 or len(peptidoforms) < POOL_MIN_PEPTIDOFORMS:
+            return parse_peptidoforms(peptidoforms)
+        logger.info(f"Parsing {len(peptidoforms)} new peptidoforms with {self._workers} processes")
+        chunks = [peptidoforms[i : i + PARSE_CHUNK_SIZE] for i in range(0, len(peptidoforms), PARSE_CHUNK_SIZE)]
+        # the converters hold DuckDB and arrow thread pools, which are not safe to fork
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            return [value for values in executor.map(parse_peptidoforms, chunks) for value in values]
+
+    def get_masses_and_notations(self, peptidoforms: pd.Series):
+        """
+        :param peptidoforms: peptidoform column
+        :return: numpy array of the monoisotopic masses and Series of the canonical notations, aligned to the column
+        """
+        codes, uniques = pd.factorize(peptidoforms)
+        masses, notations = self.mass_table.compute(uniques)
+        others = np.flatnonzero(np.isnan(masses))
+        if len(others):
+            values = self.lookup(uniques[others])
+            masses[others] = [values[key][0] for key in uniques[others]]
+            notations[others] = [values[key][1] for key in uniques[others]]
+        masses = np.append(masses, np.nan)
+        notations = np.append(notations, None)
+        return masses[codes], pd.Series(notations[codes], index=peptidoforms.index)
+
+    def calculated_mz(self, peptidoforms: pd.Series, charges) -> np.ndarray:
+        """
+        :param peptidoforms: peptidoform column
+        :param charges: precursor charges
+        :return: m/z of the precursors
+        """
+        masses, _ = self.get_masses_and_notations(peptidoforms)
+        return calculated_mz(masses, charges)
+
+
+def get_peptidoform_masses(cache_dir: str = PEPTIDOFORM_CACHE_DIR) -> PeptidoformMasses:
+    """
+    :param cache_dir: folder of the on-disk cache
+    :return: PeptidoformMasses shared by all the converters of the process
+    """
+    if cache_dir not in _SERVICES:
+        _SERVICES[cache_dir] = PeptidoformMasses(cache_dir)
+    return _SERVICES[cache_dir]
@@ -8,6 +8,8 @@ import re
 import time
 from collections import defaultdict
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from Bio import SeqIO
 
 logging.basicConfig(level=logging.INFO)
@@ -77,6 +79,64 @@ def generate_scan_number(spectra_ref: str):
         return ",".join(re.findall(r"=(\d+)", spectra_ref))
 
 
+def _to_arrow_array(values) -> pa.Array:
+    if isinstance(values, pd.Series):
+        values = pa.array(values, from_pandas=True)
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    return values
+
+
+def generate_scan_numbers(spectra_refs) -> pa.Array:
+    """
+    Columnar version of generate_scan_number. Thermo native ids (controllerType=0 controllerNumber=1) give the
+    scan= number, the other forms (index=, scan=, ...) give all their numbers joined by commas.
+    :param spectra_refs: spectra_ref column as pandas Series or arrow array
+    :return: arrow string array
+    """
+    values = _to_arrow_array(spectra_refs)
+    if not pa.types.is_string(values.type):
+        # plain scan numbers, e.g. the scan column of a DIA-NN report
+        return pc.cast(values, pa.string())
+    thermo = pc.match_substring(values, "controllerType=0 controllerNumber=1")
+    thermo_scan = pc.struct_field(pc.extract_regex(values, r"scan=(?P<scan>\d+)"), [0])
+    numbers = pc.replace_substring_regex(values, r".*?=(\d+)", r",\1")
+    # drop the text after the last number and the leading comma
+    numbers = pc.utf8_ltrim(pc.replace_substring_regex(numbers, r"^((?:,\d+)*).*$", r"\1"), ",")
+    numbers = pc.if_else(pc.match_substring_regex(values, r"=\d"), numbers, "")
+    return pc.if_else(thermo, thermo_scan, numbers)
+
+
+def generate_reference_file_names(spectra_refs, ms_runs: dict) -> pa.Array:
+    """
+    Map the ms_run[n] prefix of the spectra_ref column to the reference file names.
+    :param spectra_refs: spectra_ref column as pandas Series or arrow array
+    :param ms_runs: ms_run[n] -> reference file name, see MzTab.extract_ms_runs
+    :return: arrow string array
+    """
+    values = pc.cast(_to_arrow_array(spectra_refs), pa.string())
+    runs = pc.struct_field(pc.extract_regex(values, r"^(?P<run>[^:]*):"), [0])
+    run_names = pa.array(list(ms_runs.values()), type=pa.string())
+    return run_names.take(pc.index_in(runs, value_set=pa.array(list(ms_runs.keys()), type=pa.string())))
+
+
+def decode_spectra_refs(spectra_refs: pd.Series, ms_runs: dict) -> pd.DataFrame:
+    """
+    Decode the spectra_ref column, e.g. ms_run[1]:controllerType=0 controllerNumber=1 scan=4327
+    :param spectra_refs: spectra_ref column
+    :param ms_runs: ms_run[n] -> reference file name
+    :return: DataFrame with reference_file_name and scan columns, with the index of spectra_refs
+    """
+    values = _to_arrow_array(spectra_refs)
+    return pd.DataFrame(
+        {
+            "reference_file_name": generate_reference_file_names(values, ms_runs).to_numpy(zero_copy_only=False),
+            "scan": generate_scan_numbers(values).to_numpy(zero_copy_only=False),
+        },
+        index=spectra_refs.index,
+    )
+
+
 def get_pubmed_id_pride_json(pride_json: dict) -> str:
     """
     Parse the PubMed ID from the PRIDE JSON file
@@ -0,0 +1,112 @@
+"""
+Filter rows by the proteins they map to. Protein columns hold one or several accessions separated by ";" or ","
+(e.g. "sp|P12345|ALB_HUMAN;sp|P67890|XYZ_HUMAN"), every row is split into accession tokens once and the tokens
+are tested against a hash set, so P1234 no longer selects P12345 as the regex filter did.
+"""
+
+import ahocorasick
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from quantmsio.core.duckdb import sql_identifier, sql_literal
+from quantmsio.utils.file_utils import extract_protein_list
+
+# separators of the accessions of a protein group and of the parts of an uniprot accession (sp|P12345|ALB_HUMAN)
+ACCESSION_SEPARATORS = "[;,]"
+TOKEN_SEPARATORS = "[;,|]"
+
+
+class ProteinFilter:
+    def __init__(self, proteins: list, prefix: bool = False):
+        """
+        :param proteins: protein accessions to keep, e.g. P12345 or sp|P12345|ALB_HUMAN
+        :param prefix: also keep the accessions starting with one of the proteins, e.g. P12345-2 for P12345
+        """
+        self.proteins = sorted({protein.strip() for protein in proteins if protein and protein.strip()})
+        self.prefix = prefix
+        self._value_set = pa.array(self.proteins, type=pa.string())
+        self._automaton = None
+        if prefix and self.proteins:
+            self._automaton = ahocorasick.Automaton()
+            for protein in self.proteins:
+                self._automaton.add_word(protein, len(protein))
+            self._automaton.make_automaton()
+
+    @classmethod
+    def from_file(cls, protein_file: str, prefix: bool = False):
+        """
+        :param protein_file: text file with one protein accession per line
+        :return: ProteinFilter, or None when no file is given or the file is empty
+        """
+        proteins = extract_protein_list(protein_file) if protein_file else None
+        if not proteins:
+            return None
+        return cls(proteins, prefix)
+
+    def _match_tokens(self, tokens: pa.Array) -> np.ndarray:
+        if self._automaton is None:
+            return pc.fill_null(pc.is_in(tokens, value_set=self._value_set), False).to_numpy(zero_copy_only=False)
+        # accessions repeat a lot, every distinct token is only searched once
+        encoded = tokens.dictionary_encode()
+        matches = np.array([self._starts_with_protein(token) for token in encoded.dictionary.to_pylist()], dtype=bool)
+        indices = encoded.indices.to_numpy(zero_copy_only=False)
+        return matches[indices] if len(matches) else np.zeros(len(tokens), dtype=bool)
+
+    def _starts_with_protein(self, token: str) -> bool:
+        for end, length in self._automaton.iter(token):
+            if end + 1 == length:
+                return True
+        return False
+
+    def mask(self, accessions) -> np.ndarray:
+        """
+        :param accessions: protein column as pandas Series or arrow array
+        :return: boolean numpy array, True for the rows with at least one accession in the filter
+        """
+        if isinstance(accessions, pd.Series):
+            accessions = pa.array(accessions, from_pandas=True)
+        if isinstance(accessions, pa.ChunkedArray):
+            accessions = accessions.combine_chunks()
+        accessions = pc.cast(accessions, pa.string())
+        result = np.zeros(len(accessions), dtype=bool)
+        for pattern in [ACCESSION_SEPARATORS, TOKEN_SEPARATORS]:
+            tokens = pc.split_pattern_regex(accessions, pattern)
+            rows = pc.list_parent_indices(tokens).to_numpy(zero_copy_only=False)
+            matched = self._match_tokens(pc.utf8_trim_whitespace(pc.list_flatten(tokens)))
+            result[rows[matched]] = True
+        return result
+
+    def filter(self, df: pd.DataFrame, column: str) -> pd.DataFrame:
+        return df[self.mask(df[column])]
+
+    def sql_predicate(self, column: str) -> str:
+        """
+        DuckDB predicate equivalent to mask, for the WHERE clause of queries. The column is split into the same
+        trimmed tokens as mask and the tokens are semi-joined with the proteins, a hash join: a list of proteins
+        in the predicate would be scanned for every row. In prefix mode the tokens are cut to every distinct
+        length of the proteins before the join, there is no pattern per protein.
+        :param column: protein column
+        :return: SQL expression
+        """
+        if not self.proteins:
+            return "FALSE"
+        proteins = ", ".join(f"({sql_literal(protein)})" for protein in self.proteins)
+        splits = [
+            f"string_split_regex({sql_identifier(column)}, {sql_literal(pattern)})"
+            for pattern in [ACCESSION_SEPARATORS, TOKEN_SEPARATORS]
+        ]
+        tokens = "unnest(list_transform(list_concat({}, {}), x -> regexp_replace(x, '^\\s+|\\s+$', '', 'g')))".format(
+            *splits
+        )
+        if self.prefix:
+            lengths = ", ".join(f"({length})" for length in sorted({len(protein) for protein in self.proteins}))
+            return (
+                f"EXISTS (SELECT 1 FROM (SELECT {tokens} AS protein_token) AS t, "
+                f"(VALUES {lengths}) AS l(protein_length) "
+                f"WHERE left(t.protein_token, l.protein_length) IN (SELECT * FROM (VALUES {proteins})))"
+            )
+        return (
+            f"EXISTS (SELECT 1 FROM (SELECT {tokens} AS protein_token) AS t "
+            f"WHERE t.protein_token IN (SELECT * FROM (VALUES {proteins})))"
+        )
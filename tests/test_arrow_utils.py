@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from unittest import TestCase
+from quantmsio.core.common import PSM_SCHEMA
+from quantmsio.utils.arrow_utils import grouped_struct_list_array, struct_list_array
+
+
+class TestArrowUtils(TestCase):
+    def test_struct_list_array(self):
+        scores = pd.DataFrame({"qvalue": [0.01, None, 0.03], "global_qvalue": [0.0, 0.2, None]})
+        additional_scores = struct_list_array(
+            [
+                {"score_name": "qvalue", "score_value": scores["qvalue"]},
+                {"score_name": "global_qvalue", "score_value": scores["global_qvalue"]},
+            ],
+            PSM_SCHEMA.field("additional_scores").type,
+            len(scores),
+            masks=[None, scores["global_qvalue"].astype(bool)],
+        )
+        self.assertEqual(additional_scores.type, PSM_SCHEMA.field("additional_scores").type)
+        self.assertEqual(additional_scores.value_lengths().to_pylist(), [1, 2, 2])
+        self.assertIsNone(additional_scores[1].as_py()[0]["score_value"])
+        cv_params = struct_list_array(
+            [{"cv_name": "consensus_support", "cv_value": "1.0"}],
+            PSM_SCHEMA.field("cv_params").type,
+            len(scores),
+            masks=[scores["qvalue"].notna()],
+            empty_as_null=True,
+        )
+        self.assertEqual(cv_params.null_count, 1)
+        scores = grouped_struct_list_array(
+            {"score_name": "qvalue", "score_value": [0.1, 0.2, 0.3, 0.4]},
+            PSM_SCHEMA.field("additional_scores").type,
+            np.array([1, 0, 1, 1]),
+            3,
+        )
+        self.assertEqual(scores.value_lengths().to_pylist(), [1, 3, 0])
+        self.assertTrue(np.allclose([score["score_value"] for score in scores[1].as_py()], [0.1, 0.3, 0.4]))
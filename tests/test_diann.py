@@ -1,11 +1,43 @@
+import os
+import tempfile
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from .common import datafile
 from unittest import TestCase
-from quantmsio.core.diann import DiaNNConvert
+from quantmsio.core.common import DIANN_MAP
+from quantmsio.core.diann import DiaNNConvert, MS_INFO_SUFFIX, index_ms_info_files, plan_run_batches
 from quantmsio.core.feature import Feature
+from quantmsio.utils.protein_filter import ProteinFilter
 from ddt import data
 from ddt import ddt
 
 
+def write_report(report_path, runs, rts):
+    """
+    DIA-NN report with the first rows of the example report moved to the given runs and retention times (minutes).
+    """
+    report = pd.read_csv(datafile("DIANN/diann_report.tsv"), sep="\t", nrows=len(runs))
+    report["Run"] = runs
+    report["File.Name"] = [run + ".mzML" for run in runs]
+    report["RT"] = rts
+    report.to_csv(report_path, sep="\t", index=False)
+
+
+def write_ms_info(folder, run, rts):
+    """
+    ms_info file of a run with spectra at the given retention times (seconds), scan i has the observed mz 100 * i.
+    """
+    scans = [str(i) for i in range(1, len(rts) + 1)]
+    schema = pa.schema(
+        [("scan", pa.string()), ("ms_level", pa.int64()), ("rt", pa.float64()), ("observed_mz", pa.float64())]
+    )
+    table = pa.table([scans, [2] * len(rts), rts, [100.0 * int(scan) for scan in scans]], schema=schema)
+    pq.write_table(table, os.path.join(folder, run + MS_INFO_SUFFIX))
+
+
 @ddt
 class TestFeatureHandler(TestCase):
     test_datas = [
@@ -22,6 +54,7 @@ class TestFeatureHandler(TestCase):
         sdrf_file = datafile(test_data[1])
         mzml = datafile(test_data[2])
         D = DiaNNConvert(report_file, sdrf_file)
+        self.addCleanup(D.destroy_duckdb_database)
         for report in D.main_report_df(0.05, mzml, 2):
             D.add_additional_msg(report)
             Feature.convert_to_parquet_format(report)
@@ -33,8 +66,110 @@ class TestFeatureHandler(TestCase):
         sdrf_file = datafile(test_data[1])
         mzml = datafile(test_data[2])
         D = DiaNNConvert(report_file, sdrf_file)
+        self.addCleanup(D.destroy_duckdb_database)
         for report in D.main_report_df(0.05, mzml, 2):
             D.add_additional_msg(report)
             Feature.convert_to_parquet_format(report)
             for _, df in Feature.slice(report, ["reference_file_name", "precursor_charge"]):
                 Feature.transform_feature(df)
+
+    @data(*test_datas)
+    def test_report_from_database(self, test_data):
+        report_file = datafile(test_data[0])
+        sdrf_file = datafile(test_data[1])
+        D = DiaNNConvert(report_file, sdrf_file)
+        self.addCleanup(D.destroy_duckdb_database)
+        runs = D.get_unique_references("Run")
+        report = D.get_report_from_database(runs, 0.005)
+        self.assertEqual(report.column_names, list(DIANN_MAP.values()))
+        self.assertTrue(report.num_rows > 0)
+        self.assertLess(max(report.column("qvalue").to_pylist()), 0.005)
+        self.assertEqual(report.column("pg_accessions").null_count, 0)
+
+    @data(*test_datas)
+    def test_batch_sql_filters(self, test_data):
+        report_file = datafile(test_data[0])
+        D = DiaNNConvert(report_file)
+        self.addCleanup(D.destroy_duckdb_database)
+        runs = D.get_unique_references("Run")
+        report = D.get_report_from_database(runs).to_pandas()
+        for prefix in [False, True]:
+            protein_filter = ProteinFilter(["P62258", "Q16891", "P0DMV9", "P49"], prefix=prefix)
+            # the q-value and protein conditions of get_batch_sql against the same filters applied in python
+            filtered = D.get_report_from_database(runs, 0.0001, protein_filter).to_pandas()
+            expected = protein_filter.filter(report[report["qvalue"] < 0.0001], "pg_accessions")
+            self.assertGreater(len(filtered), 0)
+            self.assertTrue(filtered.equals(expected.reset_index(drop=True)))
+        self.assertEqual(D.get_report_from_database(runs, 0.0001, ProteinFilter([])).num_rows, 0)
+
+    @data(*test_datas)
+    def test_parquet_report(self, test_data):
+        report_file = datafile(test_data[0])
+        sdrf_file = datafile(test_data[1])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            parquet_file = os.path.join(tmp_dir, "report.parquet")
+            duckdb.execute(
+                f"COPY (SELECT * FROM read_csv_auto('{report_file}', delim='\\t')) TO '{parquet_file}' (FORMAT PARQUET)"
+            )
+            D = DiaNNConvert(parquet_file, sdrf_file)
+            self.addCleanup(D.destroy_duckdb_database)
+            # the parquet report is queried in place, no database is created
+            self.assertIsNone(D._duckdb_name)
+            runs = D.get_unique_references("Run")
+            T = DiaNNConvert(report_file, sdrf_file)
+            self.addCleanup(T.destroy_duckdb_database)
+            self.assertTrue(D.get_pg_matrix_from_database(runs).equals(T.get_pg_matrix_from_database(runs)))
+
+    def test_report_with_ms_info(self):
+        # (run, rt in minutes, scan of the closest spectrum), the earlier spectrum is kept on equal distances
+        rows = [
+            ("run_a", 0.5, "1"),
+            ("run_a", 1.25, "1"),
+            ("run_a", 1.5, "1"),
+            ("run_a", 1.75, "2"),
+            ("run_a", 2.0, "2"),
+            ("run_a", 3.5, "3"),
+            ("run_b", 1.2, "1"),
+            ("run_b", 1.0, "2"),
+            ("run_b", 0.25, "2"),
+            ("run_c", 1.0, None),
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_file = os.path.join(tmp_dir, "report.tsv")
+            write_report(report_file, [run for run, _, _ in rows], [rt for _, rt, _ in rows])
+            write_ms_info(tmp_dir, "run_a", [60.0, 120.0, 180.0])
+            # spectra are not sorted by retention time in the ms_info files
+            write_ms_info(tmp_dir, "run_b", [90.0, 30.0])
+            write_ms_info(tmp_dir, "run_c", [])
+            D = DiaNNConvert(report_file)
+            self.addCleanup(D.destroy_duckdb_database)
+            ms_info_index = index_ms_info_files(tmp_dir)
+            report = D.get_report_with_ms_info(["run_a", "run_b", "run_c"], ms_info_index, 1.0).to_pandas()
+        expected = sorted(rows, key=lambda row: (row[0], row[1]))
+        self.assertEqual(list(zip(report["run"], report["rt"], report["scan"])), expected)
+        observed_mzs = [100.0 * int(scan) if scan else None for _, _, scan in expected]
+        self.assertEqual(report["observed_mz"].replace({np.nan: None}).tolist(), observed_mzs)
+
+    def test_plan_run_batches(self):
+        spectra = {"run_a": 1000, "run_b": 10, "run_c": 10, "run_d": 10, "run_e": 10, "run_f": 700, "run_g": 5}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for run, count in spectra.items():
+                write_ms_info(tmp_dir, run, [float(i) for i in range(count)])
+            # neither a ms_info file nor a run
+            write_ms_info(tmp_dir, "run_h", [1.0])
+            os.rename(os.path.join(tmp_dir, "run_h" + MS_INFO_SUFFIX), os.path.join(tmp_dir, "run_h.parquet"))
+            ms_info_index = index_ms_info_files(tmp_dir)
+            self.assertEqual(list(ms_info_index), sorted(spectra))
+            for run, info in ms_info_index.items():
+                self.assertEqual(info["rows"], pq.read_table(info["path"]).num_rows)
+                self.assertEqual(info["rows"], spectra[run])
+                self.assertEqual(info["size"], os.path.getsize(info["path"]))
+        for file_num in [1, 2, 3, 10]:
+            batches = plan_run_batches(ms_info_index, file_num)
+            runs = [run for batch in batches for run in batch]
+            self.assertEqual(sorted(runs), sorted(spectra))
+            self.assertTrue(all(0 < len(batch) <= file_num for batch in batches))
+        # the largest run is alone in its batch, the small ones are grouped up to file_num runs
+        self.assertEqual(
+            plan_run_batches(ms_info_index, 3), [["run_a"], ["run_b", "run_c", "run_d"], ["run_e", "run_f", "run_g"]]
+        )
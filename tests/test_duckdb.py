@@ -0,0 +1,72 @@
+import os
+import tempfile
+from unittest import TestCase
+from quantmsio.core.duckdb import DuckDB, evict_duckdb_cache, parse_size
+
+
+def write_report(report_path, rows):
+    with open(report_path, "w") as f:
+        f.write("Run\tIntensity\n")
+        for run, intensity in rows:
+            f.write(f"{run}\t{intensity}\n")
+
+
+class TestDuckDBCache(TestCase):
+    def test_parse_size(self):
+        self.assertEqual(parse_size(1024), 1024)
+        self.assertEqual(parse_size("250"), 250)
+        self.assertEqual(parse_size("500MB"), 500 * 1000**2)
+        self.assertEqual(parse_size(" 1.5gb "), 1500 * 1000**2)
+        self.assertEqual(parse_size("2KiB"), 2000)
+
+    def test_evict_duckdb_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            paths = [os.path.join(cache_dir, f"report-{i}.duckdb") for i in range(4)]
+            for i, path in enumerate(paths):
+                with open(path, "wb") as f:
+                    f.write(b"0" * 100)
+                # report-0 is the least recently used
+                os.utime(path, (1000 * (i + 1), 1000 * (i + 1)))
+            other = os.path.join(cache_dir, "notes.txt")
+            with open(other, "wb") as f:
+                f.write(b"0" * 1000)
+            evict_duckdb_cache(cache_dir, "250B")
+            self.assertEqual(sorted(os.listdir(cache_dir)), ["notes.txt", "report-2.duckdb", "report-3.duckdb"])
+            # the database in use is kept even if it is the least recently used
+            os.utime(paths[2], (500, 500))
+            evict_duckdb_cache(cache_dir, 150, keep=paths[2])
+            self.assertEqual(sorted(os.listdir(cache_dir)), ["notes.txt", "report-2.duckdb"])
+            evict_duckdb_cache(cache_dir, 0, keep=paths[2])
+            self.assertEqual(sorted(os.listdir(cache_dir)), ["notes.txt", "report-2.duckdb"])
+
+    def test_cache_key(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_path = os.path.join(tmp_dir, "report.tsv")
+            cache_dir = os.path.join(tmp_dir, "cache")
+            write_report(report_path, [("run_a", 1.0), ("run_b", 2.0)])
+            D = DuckDB(report_path, cache_dir=cache_dir)
+            cache_path = D.get_cache_path()
+            self.assertEqual(os.listdir(cache_dir), [os.path.basename(cache_path)])
+            D.destroy_duckdb_database()
+            # the same report reuses the database
+            with self.assertLogs(level="INFO") as logs:
+                D = DuckDB(report_path, cache_dir=cache_dir)
+            self.assertTrue(any("Reuse the duckdb database" in line for line in logs.output))
+            self.assertEqual(D.get_cache_path(), cache_path)
+            self.assertEqual(D.get_unique_references("Run"), ["run_a", "run_b"])
+            self.assertEqual(D.connection.execute("SELECT sum(Intensity) FROM report").fetchone()[0], 3.0)
+            D.destroy_duckdb_database()
+            self.assertTrue(os.path.exists(cache_path))
+            # a new modification time or new rows change the key, the report is ingested again
+            stat = os.stat(report_path)
+            os.utime(report_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            touched_path = D.get_cache_path()
+            self.assertNotEqual(touched_path, cache_path)
+            with open(report_path, "a") as f:
+                f.write("run_c\t3.0\n")
+            os.utime(report_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            D = DuckDB(report_path, cache_dir=cache_dir)
+            self.assertNotIn(D.get_cache_path(), [cache_path, touched_path])
+            self.assertEqual(sorted(D.get_unique_references("Run")), ["run_a", "run_b", "run_c"])
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            D.destroy_duckdb_database()
@@ -1,6 +1,11 @@
 from .common import datafile
 from unittest import TestCase
-from quantmsio.core.feature import Feature
+import os
+import tempfile
+from contextlib import closing
+import numpy as np
+import pyarrow as pa
+from quantmsio.core.feature import Feature, PSM_KEYS
 from ddt import data
 from ddt import ddt
 
@@ -31,17 +36,30 @@ class TestFeatureHandler(TestCase):
         msstats_file = datafile(test_data[1])
         sdrf_file = datafile(test_data[2])
         F = Feature(mztab_file, sdrf_file, msstats_file)
-        F.extract_psm_msg()
+        psm_table, _ = F.extract_psm_msg()
+        keys = psm_table.select(["reference_file_name", "peptidoform", "precursor_charge"]).to_pandas()
+        self.assertFalse(keys.duplicated().any())
+        chunked_table, _ = F.extract_psm_msg(chunksize=1000)
+        self.assertTrue(
+            chunked_table.sort_by([(col, "ascending") for col in keys.columns]).equals(
+                psm_table.sort_by([(col, "ascending") for col in keys.columns])
+            )
+        )
 
-    # @data(*test_datas)
-    # def test_merge_msstats_and_psm(self, test_data):
-    #     mztab_file = datafile(test_data[0])
-    #     msstats_file = datafile(test_data[1])
-    #     sdrf_file = datafile(test_data[2])
-    #     F = Feature(mztab_file, sdrf_file, msstats_file)
-    #     map_dict = F.extract_psm_msg()
-    #     for msstats in F.transform_msstats_in():
-    #         F.merge_msstats_and_psm(msstats, map_dict)
+    @data(*test_datas)
+    def test_merge_msstats_and_psm(self, test_data):
+        mztab_file = datafile(test_data[0])
+        msstats_file = datafile(test_data[1])
+        sdrf_file = datafile(test_data[2])
+        F = Feature(mztab_file, sdrf_file, msstats_file)
+        psm_table, _ = F.extract_psm_msg()
+        # closing the generator removes the duckdb database of the report when an assertion fails
+        with closing(F.transform_msstats_in()) as reports:
+            for msstats in reports:
+                merged = F.merge_msstats_and_psm(msstats.copy(), psm_table)
+                self.assertEqual(len(merged), len(msstats))
+                expected = msstats.merge(psm_table.select(PSM_KEYS + ["calculated_mz"]).to_pandas(), how="left")
+                self.assertTrue(np.allclose(merged["calculated_mz"], expected["calculated_mz"], equal_nan=True))
 
     # @data(*test_datas)
     # def test_generate_feature(self, test_data):
@@ -51,3 +69,36 @@ class TestFeatureHandler(TestCase):
     #     F = Feature(mztab_file, sdrf_file, msstats_file)
     #     for _ in F.generate_feature():
     #         print("ok")
+
+    @data(*test_datas)
+    def test_generate_feature_duckdb(self, test_data):
+        mztab_file = datafile(test_data[0])
+        msstats_file = datafile(test_data[1])
+        sdrf_file = datafile(test_data[2])
+        F = Feature(mztab_file, sdrf_file, msstats_file)
+        with closing(F.generate_feature()) as batches:
+            features = pa.concat_tables(batches)
+        with closing(F.generate_feature(duckdb_mode=True)) as batches:
+            duckdb_features = pa.concat_tables(batches)
+        self.assertTrue(duckdb_features.schema.equals(features.schema))
+        columns = ["reference_file_name", "peptidoform", "precursor_charge", "scan", "calculated_mz"]
+        self.assertTrue(
+            duckdb_features.select(columns)
+            .sort_by([(col, "ascending") for col in columns])
+            .equals(features.select(columns).sort_by([(col, "ascending") for col in columns]))
+        )
+
+    @data(*test_datas)
+    def test_duckdb_cache(self, test_data):
+        mztab_file = datafile(test_data[0])
+        msstats_file = datafile(test_data[1])
+        sdrf_file = datafile(test_data[2])
+        with closing(Feature(mztab_file, sdrf_file, msstats_file).generate_feature()) as batches:
+            features = pa.concat_tables(batches)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(2):
+                F = Feature(mztab_file, sdrf_file, msstats_file, cache_dir=cache_dir)
+                self.assertTrue(pa.concat_tables(F.generate_feature()).equals(features))
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+        F = Feature(mztab_file, sdrf_file, msstats_file, direct_view=True)
+        self.assertEqual(pa.concat_tables(F.generate_feature()).num_rows, features.num_rows)
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from unittest import TestCase
+from quantmsio.utils.file_utils import ParquetPartitionWriter, close_file
+
+
+class TestParquetPartitionWriter(TestCase):
+    def test_write_partitions(self):
+        runs = ["run_a", "run/b", "run_c", "run_a", "run_c", "run_a"]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pqwriters = ParquetPartitionWriter(tmp_dir, "test.feature.parquet", ["reference_file_name"], 2)
+            for i, run in enumerate(runs):
+                table = pa.table({"reference_file_name": [run], "intensity": [float(i)]})
+                pqwriters.write_table((run,), table)
+                self.assertLessEqual(len(pqwriters._writers), 2)
+            close_file(pqwriters)
+            # run_a was closed when run_c was opened, its last rows went to a new part file
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(tmp_dir, "reference_file_name=run_a"))),
+                ["test.feature-1.parquet", "test.feature.parquet"],
+            )
+            dataset = ds.dataset(tmp_dir, format="parquet", partitioning="hive")
+            table = dataset.to_table().sort_by("intensity")
+            self.assertEqual(table.column("reference_file_name").to_pylist(), runs)
+            self.assertEqual(table.column("intensity").to_pylist(), [float(i) for i in range(len(runs))])
+
+    def test_rewrite_partitions(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pqwriters = ParquetPartitionWriter(tmp_dir, "test.feature.parquet", ["reference_file_name"], 1)
+            for i, run in enumerate(["run_a", "run_b", "run_a", "run_b"]):
+                pqwriters.write_table(run, pa.table({"reference_file_name": [run], "intensity": [float(i)]}))
+            close_file(pqwriters)
+            folder = os.path.join(tmp_dir, "reference_file_name=run_a")
+            self.assertEqual(sorted(os.listdir(folder)), ["test.feature-1.parquet", "test.feature.parquet"])
+            other = os.path.join(folder, "notes.parquet")
+            pq.write_table(pa.table({"intensity": [0.0]}), other)
+            # the new run writes each partition at once, the part files of the first run must not be read
+            pqwriters = ParquetPartitionWriter(tmp_dir, "test.feature.parquet", ["reference_file_name"], 1)
+            for i, run in enumerate(["run_a", "run_b"]):
+                pqwriters.write_table(run, pa.table({"reference_file_name": [run], "intensity": [float(i + 10)]}))
+            close_file(pqwriters)
+            self.assertEqual(sorted(os.listdir(folder)), ["notes.parquet", "test.feature.parquet"])
+            os.remove(other)
+            table = ds.dataset(tmp_dir, format="parquet", partitioning="hive").to_table().sort_by("intensity")
+            self.assertEqual(table.column("reference_file_name").to_pylist(), ["run_a", "run_b"])
+            self.assertEqual(table.column("intensity").to_pylist(), [10.0, 11.0])
@@ -0,0 +1,50 @@
+import tempfile
+import numpy as np
+import pandas as pd
+from pyopenms import AASequence
+from unittest import TestCase
+from quantmsio.utils.mass_utils import PeptidoformMasses, ResidueMassTable
+
+
+class TestMassUtils(TestCase):
+    def test_peptidoform_masses(self):
+        peptidoforms = pd.Series(["PEPTIDE", "AAC(UniMod:4)K", None, ".(Acetyl)PEPTIDE"])
+        expected = [AASequence.fromString(p).getMonoWeight() if p else np.nan for p in peptidoforms]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            masses, notations = PeptidoformMasses(tmp_dir).get_masses_and_notations(peptidoforms)
+            self.assertTrue(np.allclose(masses, expected, equal_nan=True))
+            self.assertEqual(notations.tolist(), ["PEPTIDE", "AAC(Carbamidomethyl)K", None, ".(Acetyl)PEPTIDE"])
+            # only the peptidoforms parsed with AASequence are cached on disk
+            cached = PeptidoformMasses(tmp_dir)
+            self.assertEqual(list(cached.cache), [".(Acetyl)PEPTIDE"])
+            self.assertEqual(cached.lookup([".(Acetyl)PEPTIDE"]), {".(Acetyl)PEPTIDE": (expected[3], notations[3])})
+            cached.cache.close()
+
+    def test_residue_mass_table(self):
+        # oxidation is also defined on lysine (hydroxylysine)
+        peptidoforms = [
+            "(UniMod:1)M(UniMod:35)K",
+            "AAC(UniMod:4)K",
+            "PEPS(Phospho)K",
+            "(UniMod:27)EAK",
+            "PEPK(Oxidation)R",
+            "PEPTIDE",
+        ]
+        masses, notations = ResidueMassTable().compute(peptidoforms + ["C(UniMod:4)(UniMod:35)K", "AXK"])
+        for peptidoform, mass, notation in zip(peptidoforms, masses, notations):
+            sequence = AASequence.fromString(peptidoform)
+            self.assertAlmostEqual(mass, sequence.getMonoWeight(), places=9)
+            self.assertEqual(notation, sequence.toString())
+        # left to AASequence
+        self.assertTrue(np.isnan(masses[-2:]).all())
+
+    def test_residue_mass_table_fallback(self):
+        # acetylation is only defined at the N-terminus of alanine, the table rejects it on the residue and the
+        # lookup falls back to AASequence, which moves it to the N-terminus
+        masses, notations = ResidueMassTable().compute(["A(Acetyl)PEK"])
+        self.assertTrue(np.isnan(masses[0]))
+        self.assertIsNone(notations[0])
+        sequence = AASequence.fromString("A(Acetyl)PEK")
+        result = PeptidoformMasses(None).lookup(["A(Acetyl)PEK", "PEPK"])
+        self.assertEqual(result["A(Acetyl)PEK"], (sequence.getMonoWeight(), ".(Acetyl)APEK"))
+        self.assertAlmostEqual(result["PEPK"][0], AASequence.fromString("PEPK").getMonoWeight(), places=9)
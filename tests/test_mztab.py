@@ -0,0 +1,125 @@
+import gzip
+import os
+import pickle
+import pandas as pd
+import pyarrow as pa
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from .common import datafile
+from unittest import TestCase
+from Bio import bgzf
+from quantmsio.core.mztab import MzTab, get_mztab_metadata
+from quantmsio.core.mztab_index import MzTabIndex, get_index_path
+from quantmsio.operate.tools import MODIFICATIONS_TYPE, ModificationParser, get_ahocorasick
+
+
+class TestMzTabIndex(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mztab_path = os.path.join(self.tmp_dir, "PXD040438.mzTab")
+        shutil.copyfile(datafile("DDA-lfq/PXD040438.mzTab"), self.mztab_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_build_index(self):
+        index = MzTabIndex.open(self.mztab_path)
+        self.assertTrue(os.path.exists(get_index_path(self.mztab_path)))
+        self.assertEqual(index.get_section("MTD")["rows"], 197)
+        self.assertEqual(index.get_section("PRH")["rows"], 1372)
+        self.assertEqual(index.get_section("PEH")["rows"], 2192)
+        self.assertEqual(index.get_section("PSH")["rows"], 9911)
+        self.assertEqual(index.get_columns("PSH")[:3], ["PSH", "sequence", "PSM_ID"])
+        with open(self.mztab_path, "rb") as f:
+            f.seek(index.get_section("PSH")["data_pos"])
+            self.assertTrue(f.readline().startswith(b"PSM\t"))
+
+    def test_reload_index(self):
+        index = MzTabIndex.open(self.mztab_path)
+        reloaded = MzTabIndex.open(self.mztab_path)
+        self.assertEqual(index.sections, reloaded.sections)
+        with open(self.mztab_path, "a") as f:
+            f.write("COM\tchanged\n")
+        self.assertFalse(reloaded.is_valid())
+        self.assertTrue(MzTabIndex.open(self.mztab_path).is_valid())
+
+    def test_concurrent_save(self):
+        index = MzTabIndex.open(self.mztab_path)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: index.save(), range(64)))
+        # no temporary file is left behind
+        files = sorted(["PXD040438.mzTab", os.path.basename(get_index_path(self.mztab_path))])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), files)
+        self.assertEqual(MzTabIndex.open(self.mztab_path).sections, index.sections)
+
+    def test_skip_and_load_csv(self):
+        mztab = MzTab(self.mztab_path)
+        psm = mztab.skip_and_load_csv("PSH", usecols=["sequence", "charge"])
+        self.assertEqual(len(psm), 9911)
+        pep = mztab.skip_and_load_csv("PEH")
+        self.assertEqual(len(pep), 2192)
+
+    def test_metadata(self):
+        metadata = get_mztab_metadata(self.mztab_path)
+        self.assertIs(metadata, MzTab(self.mztab_path).metadata)
+        self.assertEqual(metadata.ms_runs["ms_run[1]"], "03COVID")
+        self.assertEqual(metadata.score_names, {"OpenMS": "search_engine_score[1]"})
+        self.assertEqual(metadata.mods_map["Carbamidomethyl"], ["UNIMOD:4", "C"])
+        restored = pickle.loads(pickle.dumps(metadata))
+        self.assertEqual(restored.mods_map, metadata.mods_map)
+
+    def test_iter_section_batches(self):
+        mztab = MzTab(self.mztab_path)
+        columns = ["sequence", "charge", "opt_global_q-value", "not_a_column"]
+        rows = 0
+        for batch in mztab.iter_section_batches("PSH", columns, block_size=64 * 1024):
+            self.assertEqual(batch.schema.names, ["sequence", "charge", "opt_global_q-value"])
+            self.assertEqual(batch.schema.field("charge").type, pa.int64())
+            rows += batch.num_rows
+        self.assertEqual(rows, 9911)
+
+    def test_bgzf_mztab(self):
+        bgzf_path = self.mztab_path + ".gz"
+        with open(self.mztab_path, "rb") as f_in, bgzf.BgzfWriter(bgzf_path, "wb") as f_out:
+            f_out.write(f_in.read())
+        plain = MzTab(self.mztab_path)
+        compressed = MzTab(bgzf_path)
+        self.assertEqual(compressed.index.compression, "bgzf")
+        self.assertEqual(compressed.index.sections, plain.index.sections)
+        self.assertEqual(compressed.metadata.ms_runs, plain.metadata.ms_runs)
+        byte_range = compressed.get_section_shards("PSH", 3)[1]
+        self.assertEqual(byte_range, plain.get_section_shards("PSH", 3)[1])
+        columns = ["sequence", "spectra_ref"]
+        expected = pa.Table.from_batches(list(plain.iter_section_batches("PSH", columns, byte_range=byte_range)))
+        result = pa.Table.from_batches(list(compressed.iter_section_batches("PSH", columns, byte_range=byte_range)))
+        self.assertTrue(result.equals(expected))
+
+    def test_gzip_mztab(self):
+        gzip_path = self.mztab_path + ".gz"
+        with open(self.mztab_path, "rb") as f_in, gzip.open(gzip_path, "wb") as f_out:
+            f_out.write(f_in.read())
+        compressed = MzTab(gzip_path)
+        self.assertEqual(compressed.index.compression, "gzip")
+        self.assertEqual(len(compressed.get_section_shards("PSH", 3)), 1)
+        self.assertEqual(len(compressed.skip_and_load_csv("PEH")), 2192)
+
+    def test_modification_parser(self):
+        mztab = MzTab(self.mztab_path)
+        mods_map = mztab.get_mods_map()
+        psm = mztab.skip_and_load_csv("PSH", usecols=["opt_global_cv_MS:1000889_peptidoform_sequence"])
+        peptidoforms = psm["opt_global_cv_MS:1000889_peptidoform_sequence"]
+        parser = ModificationParser(mods_map, maxsize=100)
+        peptidoform, modifications = parser.parse_column(peptidoforms)
+        self.assertEqual(modifications.type, MODIFICATIONS_TYPE)
+        self.assertLessEqual(len(parser._cache), 100)
+        automaton = get_ahocorasick(mods_map)
+        for i in range(0, len(peptidoforms), 500):
+            expected = MzTab.generate_modifications_details(peptidoforms[i], mods_map, automaton, list(mods_map.keys()))
+            self.assertEqual(peptidoform[i], expected[0])
+            self.assertEqual(modifications[i].as_py(), expected[1])
+        df = pd.DataFrame({"peptidoform": peptidoforms})
+        parser.transform(df)
+        self.assertEqual(df["peptidoform"].tolist(), peptidoform.tolist())
+        self.assertTrue(pa.array(df["modifications"]).equals(modifications))
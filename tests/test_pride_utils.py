@@ -0,0 +1,18 @@
+import pandas as pd
+from unittest import TestCase
+from quantmsio.utils.pride_utils import decode_spectra_refs, generate_scan_number
+
+
+class TestPrideUtils(TestCase):
+    def test_decode_spectra_refs(self):
+        spectra_refs = pd.Series(
+            [
+                "ms_run[1]:controllerType=0 controllerNumber=1 scan=4327",
+                "ms_run[2]:index=12",
+                "ms_run[2]:scan=5 index=7",
+            ]
+        )
+        ms_runs = {"ms_run[1]": "a05058", "ms_run[2]": "a05059"}
+        decoded = decode_spectra_refs(spectra_refs, ms_runs)
+        self.assertEqual(decoded["reference_file_name"].tolist(), ["a05058", "a05059", "a05059"])
+        self.assertEqual(decoded["scan"].tolist(), [generate_scan_number(ref) for ref in spectra_refs])
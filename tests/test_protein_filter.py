@@ -0,0 +1,38 @@
+import duckdb
+import pandas as pd
+from unittest import TestCase
+from quantmsio.core.duckdb import sql_literal
+from quantmsio.utils.protein_filter import ProteinFilter
+
+
+class TestProteinFilter(TestCase):
+    def test_mask(self):
+        accessions = pd.Series(["sp|P1234|A_HUMAN;sp|P2|B_HUMAN", "P12345", None, "P9, P1234-2"])
+        protein_filter = ProteinFilter(["P1234"])
+        self.assertEqual(protein_filter.mask(accessions).tolist(), [True, False, False, False])
+        protein_filter = ProteinFilter(["P1234"], prefix=True)
+        self.assertEqual(protein_filter.mask(accessions).tolist(), [True, True, False, True])
+
+    def test_sql_predicate(self):
+        accessions = [
+            "sp|P1234|A_HUMAN;sp|P2|B_HUMAN",
+            "P12345",
+            None,
+            "P9, P1234-2",
+            " P1234 ",
+            "\tQ9,sp| P1234-3 |C",
+            "",
+            "P123",
+            "O'1",
+        ]
+        database = duckdb.connect()
+        rows = ", ".join("({}, {})".format(i, sql_literal(value)) for i, value in enumerate(accessions))
+        # a column name with a double quote must be quoted as an identifier
+        database.execute(f'CREATE TABLE proteins AS SELECT * FROM (VALUES {rows}) AS t(i, "protein ""group""")')
+        for prefix in [False, True]:
+            protein_filter = ProteinFilter(["P1234", "Q9", "O'1"], prefix=prefix)
+            predicate = protein_filter.sql_predicate('protein "group"')
+            sql = "SELECT coalesce({}, FALSE) FROM proteins ORDER BY i".format(predicate)
+            matches = [match for match, in database.execute(sql).fetchall()]
+            self.assertEqual(matches, protein_filter.mask(pd.Series(accessions)).tolist())
+        database.close()
@@ -1,6 +1,10 @@
+import os
+import tempfile
+import pyarrow.parquet as pq
 from .common import datafile
 from unittest import TestCase
 from quantmsio.core.psm import Psm
+from quantmsio.utils.protein_filter import ProteinFilter
 
 
 class TestPSMHandler(TestCase):
@@ -10,3 +14,31 @@ class TestPSMHandler(TestCase):
         psm = Psm(mztab_path)
         for _ in psm.generate_report():
             print("ok")
+
+    def test_write_psm_to_file_parallel(self):
+        mztab_path = datafile("DDA-lfq/PXD040438.mzTab")
+        psm = Psm(mztab_path)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, "test.psm.parquet")
+            psm.write_psm_to_file_parallel(output_path, workers=2, shards=4, chunksize=1000)
+            merged = pq.read_table(output_path)
+            serial_path = os.path.join(tmp_dir, "serial.psm.parquet")
+            psm.write_psm_to_file(serial_path, chunksize=1000)
+            self.assertTrue(merged.equals(pq.read_table(serial_path)))
+            shard_paths = psm.write_psm_to_file_parallel(output_path, workers=2, shards=4, merge=False)
+            self.assertEqual(len(shard_paths), 4)
+
+    def test_extract_from_pep(self):
+        mztab_path = datafile("DDA-lfq/PXD040438.mzTab")
+        psm = Psm(mztab_path)
+        best_scans = psm.extract_from_pep()
+        keys = best_scans.select(["peptidoform", "precursor_charge"]).to_pandas()
+        self.assertFalse(keys.duplicated().any())
+        self.assertTrue(psm.extract_from_pep(chunksize=500).equals(best_scans))
+
+    def test_generate_report_protein_filter(self):
+        mztab_path = datafile("DDA-lfq/PXD040438.mzTab")
+        psm = Psm(mztab_path)
+        protein_filter = ProteinFilter(["P02768"])
+        for table in psm.generate_report(protein_filter=protein_filter):
+            self.assertTrue(all("P02768" in accessions for accessions in table.column("mp_accessions").to_pylist()))
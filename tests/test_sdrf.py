@@ -1,6 +1,8 @@
 from unittest import TestCase
 
-from quantmsio.core.sdrf import SDRFHandler
+import pandas as pd
+
+from quantmsio.core.sdrf import SDRFHandler, map_sample_accessions
 
 from .common import datafile
 
@@ -39,3 +41,12 @@ class TestSDRFHandler(TestCase):
 
         experiment_type = sdrf_handler.get_experiment_type_from_sdrf()
         print(experiment_type)
+
+    def test_map_sample_accessions(self):
+        file = datafile("/examples/DDA-lfq/PXD040438.sdrf.tsv")
+        sample_map = SDRFHandler(file).get_sample_map_run()
+        key = next(iter(sample_map))
+        sample_accessions = map_sample_accessions(pd.Series([key, key]), sample_map)
+        self.assertEqual(sample_accessions.tolist(), [sample_map[key]] * 2)
+        with self.assertRaisesRegex(KeyError, "missing-LFQ"):
+            map_sample_accessions(pd.Series([key, "missing-LFQ"]), sample_map)